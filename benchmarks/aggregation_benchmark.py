@@ -0,0 +1,86 @@
+"""Attention softmax + neighbor aggregation of the coo and segment backends on the user-item and user-user graphs.
+
+    python benchmarks/aggregation_benchmark.py --data_dir=./data/yelp_10
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from layers.sparse_aggregation import AGGREGATION_BACKENDS, make_aggregation  # noqa: E402
+from util.data_module_v2 import DataModule  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+
+def make_step(aggregation, edge_values, embeddings, jit_compile):
+    """Forward and backward pass of softmax + aggregation, as used in one gcn layer"""
+
+    @tf.function(jit_compile=jit_compile)
+    def step():
+        with tf.GradientTape() as tape:
+            attention = aggregation.softmax(tf.math.exp(edge_values))
+            loss = tf.reduce_sum(tf.square(aggregation.matmul(attention, embeddings)))
+        return tape.gradient(loss, [edge_values, embeddings])
+
+    return step
+
+
+def time_step(step, repeats):
+    """Milliseconds per call after a warm up call (tracing and compilation)"""
+    step()
+    timings = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        gradients = step()
+        # gradients of gathers are IndexedSlices, wait for every result
+        [tf.convert_to_tensor(gradient).numpy() for gradient in gradients]
+        timings.append((time.perf_counter() - begin) * 1000.0)
+    return float(np.median(timings)), float(np.percentile(timings, 90))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sparse aggregation backends")
+    parser.add_argument("--data_dir", type=str, default="./data/yelp_10", help="dataset directory")
+    parser.add_argument("--dims", type=int, default=64, metavar="N", help="embedding size")
+    parser.add_argument("--repeats", type=int, default=20, metavar="N", help="timed calls per configuration")
+    parser.add_argument("--output", type=str, default=None, help="write the results as json")
+    args = parser.parse_args()
+
+    data_module = DataModule(args.data_dir)
+    data_module.load()
+    num_users, num_items = len(data_module.user_map), len(data_module.item_map)
+    graphs = {
+        "user_item": (data_module.train_data["user_consumed_items"]["indices"], [num_users, num_items]),
+        "user_user": (data_module.user_links["indices"], [num_users, num_users]),
+    }
+
+    rng = np.random.default_rng(0)
+    results = []
+    for graph, (indices, dense_shape) in graphs.items():
+        edge_values = tf.Variable(rng.normal(size=len(indices)).astype(np.float32))
+        embeddings = tf.Variable(rng.normal(size=(dense_shape[1], args.dims)).astype(np.float32))
+        for backend in AGGREGATION_BACKENDS:
+            # sparse tensor ops have no XLA kernels
+            for jit_compile in [False, True] if backend == "segment" else [False]:
+                aggregation = make_aggregation(backend, indices, dense_shape)
+                median_ms, p90_ms = time_step(make_step(aggregation, edge_values, embeddings, jit_compile), args.repeats)
+                result = {"graph": graph, "edges": len(indices), "backend": backend, "jit_compile": jit_compile, "median_ms": median_ms, "p90_ms": p90_ms}
+                log.info(", ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}" for key, value in result.items()))
+                results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"data_dir": args.data_dir, "dims": args.dims, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    main()
@@ -0,0 +1,91 @@
+"""Recall vs latency of the IVF index against exact top-k over exported embeddings.
+
+    python src/main.py --model_name=DiffnetPlus ... --export_dir=./export/DiffnetPlus
+    python benchmarks/ann_benchmark.py --export_dir=./export/DiffnetPlus
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from serving.ann_index import IVFIndex, top_k  # noqa: E402
+from serving.export import ITEM_EMBEDDINGS_FILE, USER_EMBEDDINGS_FILE  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+
+def time_queries(search, queries, batch_size):
+    """Results of search over queries in batches and the latency of every batch in ms"""
+    items, latencies = [], []
+    for start in range(0, len(queries), batch_size):
+        begin = time.perf_counter()
+        items.append(search(queries[start : start + batch_size]))
+        latencies.append((time.perf_counter() - begin) * 1000.0)
+    return np.concatenate(items), np.array(latencies)
+
+
+def recall(approximate, exact):
+    """Mean fraction of the exact top k found in the approximate top k"""
+    hits = [len(np.intersect1d(a, e)) for a, e in zip(approximate, exact)]
+    return float(np.mean(hits)) / exact.shape[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall vs latency of the approximate item index")
+    parser.add_argument("--export_dir", type=str, required=True, help="directory written by main.py --export_dir")
+    parser.add_argument("--k", type=int, default=10, metavar="N", help="number of items retrieved per query")
+    parser.add_argument("--num_queries", type=int, default=2000, metavar="N", help="number of users used as queries")
+    parser.add_argument("--batch_size", type=int, default=32, metavar="N", help="queries per search call")
+    parser.add_argument("--num_lists", type=int, nargs="+", default=[64, 256], metavar="N")
+    parser.add_argument("--num_probes", type=int, nargs="+", default=[1, 4, 8, 16, 32], metavar="N")
+    parser.add_argument("--pq_subspaces", type=int, nargs="+", default=[0, 8], metavar="N")
+    parser.add_argument("--seed", type=int, default=0, metavar="N")
+    parser.add_argument("--output", type=str, default=None, help="write the results as json")
+    args = parser.parse_args()
+
+    user_embeddings = np.load(os.path.join(args.export_dir, USER_EMBEDDINGS_FILE), mmap_mode="r")
+    item_embeddings = np.load(os.path.join(args.export_dir, ITEM_EMBEDDINGS_FILE))
+    rng = np.random.default_rng(args.seed)
+    queries = np.asarray(user_embeddings[np.sort(rng.choice(len(user_embeddings), min(args.num_queries, len(user_embeddings)), replace=False))])
+
+    exact, exact_latencies = time_queries(lambda batch: top_k(batch @ item_embeddings.T, args.k)[0], queries, args.batch_size)
+    log.info(f"exact: {np.mean(exact_latencies):.2f} ms per batch of {args.batch_size}")
+    results = [{"index": "exact", "recall": 1.0, "mean_ms": float(np.mean(exact_latencies)), "p99_ms": float(np.percentile(exact_latencies, 99))}]
+
+    for num_lists in args.num_lists:
+        for pq_subspaces in args.pq_subspaces:
+            begin = time.perf_counter()
+            index = IVFIndex(num_lists=num_lists, pq_subspaces=pq_subspaces, seed=args.seed).build(item_embeddings)
+            build_seconds = time.perf_counter() - begin
+            for num_probes in args.num_probes:
+                if num_probes > num_lists:
+                    continue
+                index.num_probes = num_probes
+                approximate, latencies = time_queries(lambda batch: index.search(batch, args.k)[0], queries, args.batch_size)
+                result = {
+                    "index": "ivf",
+                    "num_lists": num_lists,
+                    "num_probes": num_probes,
+                    "pq_subspaces": pq_subspaces,
+                    "build_seconds": build_seconds,
+                    "recall": recall(approximate, exact),
+                    "mean_ms": float(np.mean(latencies)),
+                    "p99_ms": float(np.percentile(latencies, 99)),
+                }
+                log.info(", ".join(f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}" for key, value in result.items()))
+                results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"num_items": len(item_embeddings), "k": args.k, "batch_size": args.batch_size, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    main()
@@ -0,0 +1,80 @@
+"""Training throughput of main.py at every --num_replicas, arguments not listed here go to main.py.
+
+The logical CPU devices of the replicas can only be set up before the TensorFlow runtime is initialized, so every
+replica count runs in its own process. 0 replicas trains without a distribution strategy and is the baseline of
+the speedups.
+
+    python benchmarks/distributed_scaling.py --output=scaling.json --data_dir=./data/yelp_10 --epochs=3
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import parse_args, run  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+
+def run_worker(num_replicas, run_arguments, output):
+    """Train with num_replicas in this process and write the throughput of the epochs after the first"""
+    final_info = run(parse_args(run_arguments + [f"--num_replicas={num_replicas}"]))
+    epochs = final_info["epoch"]
+    # the first epoch includes tracing
+    timed_epochs = epochs[1:] or epochs
+    rows_per_sec = [epoch_info["profile"]["counters"].get("train_rows", 0) / epoch_info["time"] for epoch_info in timed_epochs]
+    result = {
+        "num_replicas": num_replicas,
+        "steps_per_sec": float(np.median([epoch_info["steps_per_sec"] for epoch_info in timed_epochs])),
+        "rows_per_sec": float(np.median(rows_per_sec)),
+        "train_loss": epochs[-1]["train_loss"],
+        "epochs": len(epochs),
+    }
+    with open(output, "w") as f:
+        json.dump(result, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data parallel training throughput over the number of replicas")
+    parser.add_argument("--replicas", type=int, nargs="+", default=[0, 1, 2, 4, 8], metavar="N", help="replica counts to compare, 0 is the single device baseline")
+    parser.add_argument("--output", type=str, default=None, help="write the results as json")
+    parser.add_argument("--worker", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--worker_output", type=str, default=None, help=argparse.SUPPRESS)
+    args, run_arguments = parser.parse_known_args()
+
+    if args.worker is not None:
+        run_worker(args.worker, run_arguments, args.worker_output)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_replicas in args.replicas:
+            worker_output = os.path.join(tmp_dir, f"replicas_{num_replicas}.json")
+            command = [sys.executable, os.path.abspath(__file__), f"--worker={num_replicas}", f"--worker_output={worker_output}"] + run_arguments
+            log.info(f"Training with {num_replicas} replicas")
+            subprocess.run(command, check=True)
+            with open(worker_output) as f:
+                results.append(json.load(f))
+
+    baseline = next((result for result in results if result["num_replicas"] == 0), results[0])
+    for result in results:
+        result["speedup"] = result["rows_per_sec"] / max(baseline["rows_per_sec"], 1e-9)
+        result["efficiency"] = result["speedup"] / max(result["num_replicas"], 1)
+        print(" ".join(f"{name}={value:.5g}" if isinstance(value, float) else f"{name}={value}" for name, value in result.items()))
+    if args.output:
+        environment = {"python": platform.python_version(), "machine": platform.machine(), "cpu_count": os.cpu_count()}
+        with open(args.output, "w") as f:
+            json.dump({"arguments": run_arguments, "environment": environment, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s")
+    main()
@@ -0,0 +1,49 @@
+"""Training throughput and test metrics of main.py at every --precision, arguments not listed here go to main.py.
+
+    python benchmarks/precision_benchmark.py --output=precision.json --epochs=5 --model_name=DiffnetPlus
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import parse_args, run  # noqa: E402
+from models.base_model import PRECISIONS  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+REPORTED_METRICS = ["train_loss", "val_loss", "test_loss", "rmse", "hr_10", "ndcg_10"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the training precisions")
+    parser.add_argument("--precisions", type=str, nargs="+", default=PRECISIONS, choices=PRECISIONS, help="precisions to compare")
+    parser.add_argument("--output", type=str, default=None, help="write the results as json")
+    args, run_arguments = parser.parse_known_args()
+
+    results = []
+    for precision in args.precisions:
+        final_info = run(parse_args(run_arguments + [f"--precision={precision}"]))
+        epochs = final_info["epoch"]
+        # the first epoch includes tracing
+        steps_per_sec = [epoch_info["steps_per_sec"] for epoch_info in (epochs[1:] or epochs)]
+        result = {"precision": precision, "steps_per_sec": float(np.median(steps_per_sec))}
+        result.update({name: epochs[-1][name] for name in REPORTED_METRICS if name in epochs[-1]})
+        log.info(f"{precision}: {result}")
+        results.append(result)
+
+    for result in results:
+        print(" ".join(f"{name}={value:.5g}" if isinstance(value, float) else f"{name}={value}" for name, value in result.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": run_arguments, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s")
+    main()
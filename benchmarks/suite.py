@@ -0,0 +1,293 @@
+"""Hot path benchmarks on a synthetic dataset: data loading, batch assembly, a training step, a forward pass and
+the ranking metrics, with the peak RSS and the RSS growth of every stage. Results are written as JSON tagged with the git commit,
+--compare reports the ratio to an earlier result and fails on regressions.
+
+    python benchmarks/suite.py --num_users=20000 --num_items=10000 --output=bench.json
+    python benchmarks/suite.py --num_users=20000 --num_items=10000 --compare=bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from main import make_train_step  # noqa: E402
+from metrics.evaluate import evaluate_hit_rate_and_ndcg_2, evaluate_hit_rate_and_ndcg_at_k, evaluate_sampled_ranking  # noqa: E402
+from metrics.full_ranking import evaluate_full_ranking  # noqa: E402
+from models.diffnet_plus import DiffnetPlus  # noqa: E402
+from models.diffnet_plus_mod import DiffnetPlusMod  # noqa: E402
+from util.data_module_v2 import DataModule  # noqa: E402
+from util.input_pipeline import make_train_dataset  # noqa: E402
+from util.synthetic_data import DEGREE_DISTRIBUTIONS, generate_dataset  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+
+def peak_rss_mb():
+    """Peak RSS of the process so far, it never decreases"""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def process_status_mb(field):
+    """A memory field of /proc/self/status (VmRSS, VmHWM) in megabytes, None without procfs"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Restart the VmHWM peak of the process at its current RSS, False where the kernel does not support it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_calls(function, repeats, warmup=1):
+    """Wall time in milliseconds of every call after warmup calls (tracing, caches)"""
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - begin) * 1000.0)
+    return timings
+
+
+def run_stage(function, repeats, warmup=1):
+    """Timings of function and the memory of the stage.
+
+    stage_peak_rss_mb is the peak RSS while the stage runs (None where the peak cannot be reset) and rss_delta_mb
+    the RSS the stage leaves behind. process_peak_rss_mb is the peak of the process so far, which includes the
+    earlier stages.
+    """
+    rss_before = process_status_mb("VmRSS")
+    peak_reset = reset_peak_rss()
+    timings = time_calls(function, repeats, warmup=warmup)
+    rss_after = process_status_mb("VmRSS")
+    return {
+        "median_ms": float(np.median(timings)),
+        "p90_ms": float(np.percentile(timings, 90)),
+        "min_ms": float(np.min(timings)),
+        "repeats": len(timings),
+        "stage_peak_rss_mb": process_status_mb("VmHWM") if peak_reset else None,
+        "rss_delta_mb": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+        "process_peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_stages(args, data_dir):
+    stages = {}
+
+    # a cold load parses the sources and writes the cache, a warm load reads the memory-mapped cache
+    def load(use_cache):
+        data_module = DataModule(data_dir, num_negatives=args.num_negatives, num_evaluate=args.num_evaluate, batch_size=args.batch_size, use_cache=use_cache, seed=args.seed)
+        data_module.load()
+        return data_module
+
+    stages["load_parse"] = run_stage(lambda: load(use_cache=False), 1, warmup=0)
+    load(use_cache=True)
+    stages["load_cached"] = run_stage(lambda: load(use_cache=True), args.repeats, warmup=0)
+    data_module = load(use_cache=True)
+
+    stages["train_data_batch_generator"] = run_stage(lambda: sum(1 for _ in data_module.train_data_batch_generator()), args.repeats, warmup=0)
+    stages["train_arrays"] = run_stage(data_module.train_arrays, args.repeats, warmup=0)
+
+    model_class = DiffnetPlusMod if args.model_name == "DiffnetPlusMod" else DiffnetPlus
+    train_data = data_module.train_data
+    model = model_class(
+        gcn_layers=args.gcn_layers,
+        dims=args.dims,
+        num_users=len(data_module.user_map),
+        num_items=len(data_module.item_map),
+        user_review_embeddings=data_module.user_embeddings,
+        item_review_embeddings=data_module.item_embeddings,
+        user_consumed_items=train_data["user_consumed_items"],
+        item_consumed_users=train_data["item_consumed_items"],
+        user_links=data_module.user_links,
+        item_links=data_module.item_links,
+        aggregation=args.aggregation,
+    )
+
+    # one training step on the first batch, as compiled by main.py
+    optimizer = tf.keras.optimizers.Adam(learning_rate=0.0005)
+    epoch_loss_avg = tf.keras.metrics.Mean()
+    train_step = make_train_step(model, optimizer, epoch_loss_avg)
+    batch = next(iter(make_train_dataset(*data_module.train_arrays())))
+
+    def train_epoch_batch():
+        train_step(*batch)
+        # wait for the update
+        epoch_loss_avg.result().numpy()
+
+    stages["train_epoch_batch"] = run_stage(train_epoch_batch, args.repeats, warmup=2)
+
+    propagate = tf.function(lambda: model.propagate(training=False))
+    stages["forward_propagate"] = run_stage(lambda: [embeddings.numpy() for embeddings in propagate()], args.repeats)
+
+    # ranking metrics on the model's scores of the test positives and sampled negatives
+    test_input_users, test_input_items, _, test_user_index_dict = data_module.get_test_data_positive()
+    positive_predictions = model([test_input_users, test_input_items]).numpy()
+
+    def score_negatives_per_pair():
+        negative_predictions = {}
+        for input_users, input_items, user_batch_list in data_module.get_test_data_negative():
+            predictions = np.reshape(model([input_users, input_items]), (-1, args.num_evaluate))
+            negative_predictions.update(zip(user_batch_list, predictions))
+        return negative_predictions
+
+    stages["score_negatives_per_pair"] = run_stage(score_negatives_per_pair, args.repeats, warmup=0)
+    negative_predictions = score_negatives_per_pair()
+    stages["evaluate_hit_rate_and_ndcg_2"] = run_stage(
+        lambda: evaluate_hit_rate_and_ndcg_2(test_user_index_dict, positive_predictions, negative_predictions, top_k=10), args.repeats, warmup=0
+    )
+    stages["evaluate_hit_rate_and_ndcg_at_k"] = run_stage(
+        lambda: evaluate_hit_rate_and_ndcg_at_k(test_user_index_dict, positive_predictions, negative_predictions), args.repeats, warmup=0
+    )
+    user_gcn_embeddings, item_gcn_embeddings = model.get_gcn_embeddings()
+    # scoring included, the streaming counterpart of score_negatives_per_pair and evaluate_hit_rate_and_ndcg_at_k
+    stages["evaluate_sampled_ranking"] = run_stage(
+        lambda: evaluate_sampled_ranking(user_gcn_embeddings, item_gcn_embeddings, data_module.test_data["ratings"], data_module.test_data["negatives"]), args.repeats
+    )
+    stages["evaluate_full_ranking"] = run_stage(
+        lambda: evaluate_full_ranking(user_gcn_embeddings, item_gcn_embeddings, data_module.test_data["ratings"], data_module.train_data["ratings"]), args.repeats
+    )
+    return stages
+
+
+def compare(results, baseline_path, threshold):
+    """Log the median time ratio of every stage to a baseline result, returns the stages slower than threshold"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline["config"] != results["config"]:
+        log.warning(f"Baseline {baseline_path} was run with a different configuration, ratios are not comparable")
+    regressions = []
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        ratio = stage["median_ms"] / max(baseline["stages"][name]["median_ms"], 1e-9)
+        log.info(f"{name}: {ratio:.2f}x of {baseline.get('commit')}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data loading, training and evaluation hot paths")
+    parser.add_argument("--num_users", type=int, default=20000, metavar="N", help="synthetic users")
+    parser.add_argument("--num_items", type=int, default=10000, metavar="N", help="synthetic items")
+    parser.add_argument("--ratings_per_user", type=int, default=10, metavar="N", help="mean ratings per user")
+    parser.add_argument("--links_per_user", type=int, default=5, metavar="N", help="mean social links per user")
+    parser.add_argument("--degree_distribution", type=str, default="powerlaw", choices=DEGREE_DISTRIBUTIONS, help="distribution of the node degrees")
+    parser.add_argument("--exponent", type=float, default=2.0, help="tail exponent of the power-law degrees")
+    parser.add_argument("--review_dims", type=int, default=150, metavar="N", help="review embedding size")
+    parser.add_argument("--data_dir", type=str, default=None, help="generate the dataset here and keep it, a temporary directory otherwise")
+    parser.add_argument("--model_name", type=str, default="DiffnetPlusMod", choices=["DiffnetPlus", "DiffnetPlusMod"], help="model")
+    parser.add_argument("--aggregation", type=str, default="coo", help="sparse aggregation backend")
+    parser.add_argument("--dims", type=int, default=64, metavar="N", help="embedding size")
+    parser.add_argument("--gcn_layers", type=int, default=2, metavar="N", help="GCN layers")
+    parser.add_argument("--batch_size", type=int, default=512, metavar="N", help="users per training batch")
+    parser.add_argument("--num_negatives", type=int, default=8, metavar="N", help="training negatives per user")
+    parser.add_argument("--num_evaluate", type=int, default=1000, metavar="N", help="sampled test negatives per user")
+    parser.add_argument("--repeats", type=int, default=5, metavar="N", help="timed calls per stage")
+    parser.add_argument("--seed", type=int, default=0, metavar="N", help="seed of the dataset and the samplers")
+    parser.add_argument("--output", type=str, default=None, help="write the results as json")
+    parser.add_argument("--compare", type=str, default=None, help="results of an earlier run to compare against")
+    parser.add_argument("--regression_threshold", type=float, default=1.2, help="median time ratio to the baseline reported as a regression")
+    args = parser.parse_args()
+
+    config = {
+        name: getattr(args, name)
+        for name in [
+            "num_users",
+            "num_items",
+            "ratings_per_user",
+            "links_per_user",
+            "degree_distribution",
+            "exponent",
+            "review_dims",
+            "model_name",
+            "aggregation",
+            "dims",
+            "gcn_layers",
+            "batch_size",
+            "num_negatives",
+            "num_evaluate",
+            "seed",
+        ]
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        begin = time.perf_counter()
+        generate_dataset(
+            data_dir,
+            args.num_users,
+            args.num_items,
+            ratings_per_user=args.ratings_per_user,
+            links_per_user=args.links_per_user,
+            review_dims=args.review_dims,
+            degree_distribution=args.degree_distribution,
+            exponent=args.exponent,
+            seed=args.seed,
+        )
+        log.info(f"Generated the dataset in {time.perf_counter() - begin:.1f}s")
+        stages = run_stages(args, data_dir)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "tensorflow": tf.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": stages,
+    }
+    for name, stage in stages.items():
+        stage_peak = stage["stage_peak_rss_mb"] if stage["stage_peak_rss_mb"] is not None else float("nan")
+        rss_delta = stage["rss_delta_mb"] if stage["rss_delta_mb"] is not None else float("nan")
+        print(f"{name:32s} median={stage['median_ms']:10.2f}ms p90={stage['p90_ms']:10.2f}ms stage_peak_rss={stage_peak:8.1f}MB rss_delta={rss_delta:+8.1f}MB")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.regression_threshold)
+        if regressions:
+            log.error(f"Regressions over {args.regression_threshold}x: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s")
+    main()
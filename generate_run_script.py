@@ -10,7 +10,14 @@ evals = [1000]
 epochs = [100]
 
 
-with open("./run_script.sh", "w") as f:
+def configurations():
+    """main.py arguments of every configuration of the grid"""
     for model, dim, size, rate, layer, n_val, n_eval, e in itertools.product(model_name, dims, batch_size, lr, gcn, neg, evals, epochs):
-        f.write(f"python src/main.py --model_name={model} --batch_size={size} --dims={dim} --lr={rate} --gcn_layers={layer} --epochs={e} --num_negatives={n_val} --num_evaluate={n_eval}\n")
-        f.write("sleep 5\n")
+        yield [f"--model_name={model}", f"--batch_size={size}", f"--dims={dim}", f"--lr={rate}", f"--gcn_layers={layer}", f"--epochs={e}", f"--num_negatives={n_val}", f"--num_evaluate={n_eval}"]
+
+
+if __name__ == "__main__":
+    with open("./run_script.sh", "w") as f:
+        for arguments in configurations():
+            f.write(f"python src/main.py {' '.join(arguments)}\n")
+            f.write("sleep 5\n")
@@ -0,0 +1,36 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+from serving.ann_index import IVFIndex
+from serving.export import ITEM_EMBEDDINGS_FILE
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an approximate nearest-neighbor index over exported item embeddings")
+    parser.add_argument("--export_dir", type=str, required=True, help="directory written by main.py --export_dir")
+    parser.add_argument("--output", type=str, default=None, help="index file, defaults to <export_dir>/ann_index.npz")
+    parser.add_argument("--num_lists", type=int, default=256, metavar="N", help="number of k-means inverted lists")
+    parser.add_argument("--num_probes", type=int, default=8, metavar="N", help="inverted lists scanned per query")
+    parser.add_argument("--pq_subspaces", type=int, default=0, metavar="N", help="product quantization subspaces, 0 scores candidates exactly")
+    parser.add_argument("--rerank", type=int, default=4, metavar="N", help="with product quantization, rerank * n candidates are scored exactly")
+    parser.add_argument("--iterations", type=int, default=20, metavar="N", help="k-means iterations")
+    parser.add_argument("--seed", type=int, default=None, metavar="N", help="seed of the k-means initialization")
+    args = parser.parse_args()
+
+    item_embeddings = np.load(os.path.join(args.export_dir, ITEM_EMBEDDINGS_FILE), mmap_mode="r")
+    index = IVFIndex(num_lists=args.num_lists, num_probes=args.num_probes, pq_subspaces=args.pq_subspaces, rerank=args.rerank, seed=args.seed)
+    index.build(item_embeddings, iterations=args.iterations)
+
+    output = args.output or os.path.join(args.export_dir, "ann_index.npz")
+    index.save(output)
+    log.info(f"Saved index to {output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s")
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import logging
+
+from util.synthetic_data import DEGREE_DISTRIBUTIONS, generate_dataset
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic dataset for main.py --data_dir")
+    parser.add_argument("--data_dir", type=str, required=True, help="output directory")
+    parser.add_argument("--num_users", type=int, default=100000, metavar="N", help="number of users")
+    parser.add_argument("--num_items", type=int, default=50000, metavar="N", help="number of items")
+    parser.add_argument("--ratings_per_user", type=int, default=10, metavar="N", help="mean ratings per user")
+    parser.add_argument("--links_per_user", type=int, default=5, metavar="N", help="mean social links per user")
+    parser.add_argument("--links_per_item", type=int, default=3, metavar="N", help="mean links per item")
+    parser.add_argument("--review_dims", type=int, default=150, metavar="N", help="review embedding size")
+    parser.add_argument("--degree_distribution", type=str, default="powerlaw", choices=DEGREE_DISTRIBUTIONS, help="distribution of the node degrees and popularities")
+    parser.add_argument("--exponent", type=float, default=2.0, help="tail exponent of the power-law degrees")
+    parser.add_argument("--community_size", type=int, default=100, metavar="N", help="mean number of nodes per link community")
+    parser.add_argument("--mixing", type=float, default=0.1, help="probability of a link outside its source's community")
+    parser.add_argument("--reciprocity", type=float, default=0.5, help="probability of a link to be flagged as reciprocal")
+    parser.add_argument("--chunk_size", type=int, default=100000, metavar="N", help="nodes generated and written at a time")
+    parser.add_argument("--seed", type=int, default=None, metavar="N", help="random seed")
+    args = parser.parse_args()
+
+    generate_dataset(
+        args.data_dir,
+        args.num_users,
+        args.num_items,
+        ratings_per_user=args.ratings_per_user,
+        links_per_user=args.links_per_user,
+        links_per_item=args.links_per_item,
+        review_dims=args.review_dims,
+        degree_distribution=args.degree_distribution,
+        exponent=args.exponent,
+        community_size=args.community_size,
+        mixing=args.mixing,
+        reciprocity=args.reciprocity,
+        chunk_size=args.chunk_size,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s")
+    main()
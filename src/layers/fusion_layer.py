@@ -6,11 +6,18 @@ class FusionLayer(tf.keras.layers.Layer):
         super(FusionLayer, self).__init__(*args, **kwargs)
 
     def build(self, input_shape):
-        self.free_embeddings = tf.Variable(
-            tf.random_normal_initializer(mean=0.0, stddev=0.01)(shape=input_shape, dtype=tf.float32),
-            trainable=True,
+        # a layer weight, under a mixed precision policy it is stored in float32 and cast to the compute dtype
+        self.free_embeddings = self.add_weight(
             name="free_embeddings",
+            shape=input_shape,
+            initializer=tf.random_normal_initializer(mean=0.0, stddev=0.01),
+            trainable=True,
         )
+        super(FusionLayer, self).build(input_shape)
 
-    def call(self, inputs):
-        return inputs + self.free_embeddings
+    def call(self, inputs, nodes=None):
+        """Fused embeddings of all nodes, or of the given nodes for inputs of their rows only"""
+        if nodes is None:
+            return inputs + self.free_embeddings
+        # gathered from the float32 variable, not auto cast to the compute dtype
+        return inputs + tf.cast(tf.gather(self.free_embeddings, nodes), inputs.dtype)
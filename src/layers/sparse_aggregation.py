@@ -0,0 +1,73 @@
+import numpy as np
+import tensorflow as tf
+
+AGGREGATION_BACKENDS = ["coo", "segment"]
+
+
+def segment_softmax(values, rows, num_rows):
+    """Softmax of the edge values over the edges of every row"""
+    row_max = tf.math.unsorted_segment_max(values, rows, num_rows)
+    exp_values = tf.math.exp(values - tf.gather(row_max, rows))
+    row_sum = tf.math.unsorted_segment_sum(exp_values, rows, num_rows)
+    return exp_values / tf.gather(row_sum, rows)
+
+
+def segment_matmul(weights, embeddings, rows, cols, num_rows):
+    """Product of the sparse matrix given by the edges (rows, cols, weights) with dense embeddings"""
+    weighted_neighbors = tf.gather(embeddings, cols) * tf.expand_dims(weights, 1)
+    return tf.math.unsorted_segment_sum(weighted_neighbors, rows, num_rows)
+
+
+class COOAggregation:
+    """Row softmax and aggregation with a tf.SparseTensor, sparse softmax and sparse_dense_matmul.
+
+    The attention of an edge set is a SparseTensor. tf.sparse.softmax expects canonical (row major sorted) indices
+    and returns its values in that order, while the graphs keep their rows in order of first appearance, so the
+    indices are sorted once here and the edge values are gathered into that order.
+    """
+
+    def __init__(self, indices, dense_shape):
+        indices = np.asarray(indices)
+        order = np.lexsort((indices[:, 1], indices[:, 0]))
+        self.order = None if np.array_equal(order, np.arange(len(order))) else tf.constant(order)
+        self.indices = indices[order]
+        self.dense_shape = dense_shape
+
+    def softmax(self, values):
+        if self.order is not None:
+            values = tf.gather(values, self.order)
+        return tf.sparse.softmax(tf.SparseTensor(indices=self.indices, values=values, dense_shape=self.dense_shape))
+
+    def matmul(self, attention, embeddings):
+        return tf.sparse.sparse_dense_matmul(attention, embeddings)
+
+
+class SegmentAggregation:
+    """Row softmax and aggregation with segment reductions over the row ids of the edges.
+
+    The attention of an edge set is the dense vector of per edge weights in COO order. The softmax is a segment
+    max / exp / segment sum over rows and the aggregation a gather of the neighbor rows, weighted and summed per
+    row, so no SparseTensor is built or reordered and every op has an XLA kernel. Row and column ids are int32
+    when the shape fits.
+    """
+
+    def __init__(self, indices, dense_shape):
+        indices = np.asarray(indices)
+        index_dtype = np.int32 if max(dense_shape) <= np.iinfo(np.int32).max else np.int64
+        self.rows = tf.constant(indices[:, 0].astype(index_dtype))
+        self.cols = tf.constant(indices[:, 1].astype(index_dtype))
+        self.num_rows = int(dense_shape[0])
+
+    def softmax(self, values):
+        return segment_softmax(values, self.rows, self.num_rows)
+
+    def matmul(self, attention, embeddings):
+        return segment_matmul(attention, embeddings, self.rows, self.cols, self.num_rows)
+
+
+def make_aggregation(backend, indices, dense_shape):
+    if backend == "coo":
+        return COOAggregation(indices, dense_shape)
+    if backend == "segment":
+        return SegmentAggregation(indices, dense_shape)
+    raise ValueError(f"Unknown aggregation backend: {backend}")
@@ -1,4 +1,6 @@
 import argparse
+import contextlib
+import hashlib
 import json
 import logging
 import logging.config
@@ -10,12 +12,41 @@ from datetime import datetime
 import numpy as np
 import tensorflow as tf
 
-from metrics.evaluate import evaluate_hit_rate_and_ndcg_2
+from layers.sparse_aggregation import AGGREGATION_BACKENDS
+from metrics.evaluate import evaluate_sampled_ranking
+from metrics.full_ranking import evaluate_full_ranking
+from models.base_model import PRECISIONS
 from models.diffnet_plus import DiffnetPlus
 from models.diffnet_plus_mod import DiffnetPlusMod
+from serving.export import export_embeddings
+from util.batching import bucket_boundaries
+from util.checkpointing import TrainingCheckpoints
 from util.data_module_v2 import DataModule
+from util.distributed import cpu_replica_strategy
+from util.input_pipeline import make_sampled_train_dataset, make_train_dataset, subgraph_signature
+from util.instrumentation import Instrumentation, StepProfiler, parse_step_range
+from util.neighbor_sampler import NeighborSampler
+from util.negative_sampler import SAMPLER_DISTRIBUTIONS
+from util.tf_helper import enable_xla_autoclustering
 
 LOG_DIR = "./logs"
+DATA_DIR = "./data/yelp_10"
+EVALUATION_CUTOFFS = [5, 10, 15]
+# early stopping metrics that improve when they decrease, all others improve when they increase
+MINIMIZED_METRICS = ["train_loss", "val_loss", "test_loss", "mse", "rmse"]
+
+
+def epoch_result_metrics(eval_mode):
+    """Names of the metrics in the results of an epoch, the losses and the test ranking metrics of eval_mode"""
+    ranking_metrics = ["hr", "ndcg", "recall"] if eval_mode == "full" else ["hr", "ndcg"]
+    names = MINIMIZED_METRICS + [f"{name}_{k}" for name in ranking_metrics for k in EVALUATION_CUTOFFS]
+    return names + ["mrr"] if eval_mode == "full" else names
+
+
+def arguments_digest(args):
+    """Short hash of all parsed arguments, tells apart the result files of configurations sharing the hyperparameters in their name"""
+    encoded = json.dumps(vars(args), sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()[:10]
 
 
 def setup_logging():
@@ -34,36 +65,218 @@ def setup_logging():
 
 
 # @profile(stream=fp)
-# @tf.function
-def train_epoch_batch(model, optimizer, epoch_loss_avg, input_users, input_items, label_ratings):
-    logging.getLogger(__name__)
-
-    with tf.GradientTape() as tape:
-        y_predict = model([input_users, input_items], training=True)
-        # compute loss
-        loss_value = tf.nn.l2_loss(label_ratings - y_predict, name="training_loss")
+def make_train_step(model, optimizer, epoch_loss_avg, run_eagerly=False, jit_compile=False, subgraph_signature=None):
+    log = logging.getLogger(__name__)
 
-    grads = tape.gradient(loss_value, model.trainable_variables)
-    optimizer.apply_gradients(zip(grads, model.trainable_variables))
-    epoch_loss_avg.update_state(loss_value)
-    del y_predict, grads
+    # the stages are only timed when run eagerly, compiled they are name scopes of the profiler trace
+    instrumentation = model.instrumentation
+
+    def train_epoch_batch(input_users, input_items, label_ratings, label_weights, subgraph=None):
+        if not tf.executing_eagerly():
+            log.info(f"Tracing train step for batch shape: {input_users.shape}")
+            instrumentation.count("train_step_traces")
+
+        with tf.GradientTape() as tape, instrumentation.timer("forward"):
+            if subgraph is None:
+                y_predict = model([input_users, input_items], training=True)
+            else:
+                # neighbor sampled training, propagate over the computation subgraph of the batch only
+                y_predict = model.call_subgraph(subgraph, training=True)
+            # compute loss, padded rows have a zero weight
+            loss_value = tf.nn.l2_loss((label_ratings - y_predict) * label_weights, name="training_loss")
+
+        with instrumentation.timer("backward"):
+            grads = tape.gradient(loss_value, model.trainable_variables)
+        with instrumentation.timer("optimizer"):
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        epoch_loss_avg.update_state(loss_value)
+
+    if run_eagerly:
+        return train_epoch_batch
+    # variable batch dimension, the step is traced once (plus once more while the optimizer creates its slots)
+    input_signature = [
+        tf.TensorSpec([None, 1], tf.int64),
+        tf.TensorSpec([None, 1], tf.int64),
+        tf.TensorSpec([None, 1], tf.float32),
+        tf.TensorSpec([None, 1], tf.float32),
+    ]
+    if subgraph_signature is not None:
+        input_signature.append(subgraph_signature)
+    return tf.function(train_epoch_batch, input_signature=input_signature, jit_compile=jit_compile)
+
+
+def make_distributed_train_step(model, optimizer, epoch_loss_avg, strategy):
+    """Data parallel training step of the full graph model over the replicas of strategy.
+
+    Only the batch rows are split: the propagation and its back propagation run once per step, not sharded, and its
+    embedding tables are shared by the replicas. Every replica gathers and scores its share of the rows and takes
+    the gradient of its loss with respect to the tables. The loss of a replica is the l2 loss summed over its rows,
+    the sum over the replicas is the loss of the single device step. The table gradients only have rows for the
+    gathered users and items, they are summed over the replicas as IndexedSlices, back propagated through the
+    propagation once and every replica applies the resulting weight gradients to its copy of the weights.
+    """
+    log = logging.getLogger(__name__)
+    instrumentation = model.instrumentation
+
+    def replica_loss(user_gcn_embeddings, item_gcn_embeddings, input_users, input_items, label_ratings, label_weights):
+        context = tf.distribute.get_replica_context()
+        replica = tf.cast(context.replica_id_in_sync_group, tf.int32)
+        num_rows = tf.shape(input_users)[0]
+        start = num_rows * replica // context.num_replicas_in_sync
+        end = num_rows * (replica + 1) // context.num_replicas_in_sync
+
+        with tf.GradientTape() as tape:
+            tape.watch([user_gcn_embeddings, item_gcn_embeddings])
+            y_predict = model.predict_from_embeddings(user_gcn_embeddings, item_gcn_embeddings, input_users[start:end], input_items[start:end])
+            # padded rows have a zero weight
+            loss_value = tf.nn.l2_loss((label_ratings[start:end] - y_predict) * label_weights[start:end], name="training_loss")
+        # IndexedSlices of the gathered rows
+        user_grads, item_grads = tape.gradient(loss_value, [user_gcn_embeddings, item_gcn_embeddings])
+        return loss_value, user_grads, item_grads
+
+    def train_epoch_batch(input_users, input_items, label_ratings, label_weights):
+        if not tf.executing_eagerly():
+            log.info(f"Tracing data parallel train step for batch shape: {input_users.shape}")
+            instrumentation.count("train_step_traces")
+
+        # variables created while tracing (layer weights, optimizer slots) are mirrored
+        with strategy.scope():
+            with tf.GradientTape() as tape, instrumentation.timer("forward"):
+                model.weights_version.assign_add(1)
+                user_gcn_embeddings, item_gcn_embeddings = model.propagate(training=True)
+
+            with instrumentation.timer("replicas"):
+                losses, user_grads, item_grads = strategy.run(replica_loss, args=(user_gcn_embeddings, item_gcn_embeddings, input_users, input_items, label_ratings, label_weights))
+                loss_value = strategy.reduce(tf.distribute.ReduceOp.SUM, losses, axis=None)
+                # the sparse gradients are concatenated, only the gathered rows move between the devices
+                embedding_grads = [strategy.reduce(tf.distribute.ReduceOp.SUM, grads, axis=None) for grads in [user_grads, item_grads]]
+
+            with instrumentation.timer("backward"):
+                # outside of the replicas the propagation reads the first copy of every mirrored variable
+                primary_variables = [strategy.experimental_local_results(variable)[0] for variable in model.trainable_variables]
+                grads = tape.gradient([user_gcn_embeddings, item_gcn_embeddings], primary_variables, output_gradients=embedding_grads)
+            with instrumentation.timer("optimizer"):
+                # the gradients are already summed over the replicas
+                strategy.run(lambda: optimizer.apply_gradients(zip(grads, model.trainable_variables), experimental_aggregate_gradients=False))
+        epoch_loss_avg.update_state(loss_value)
+
+    input_signature = [
+        tf.TensorSpec([None, 1], tf.int64),
+        tf.TensorSpec([None, 1], tf.int64),
+        tf.TensorSpec([None, 1], tf.float32),
+        tf.TensorSpec([None, 1], tf.float32),
+    ]
+    return tf.function(train_epoch_batch, input_signature=input_signature)
 
 
 # @profile(stream=fp)
-# @tf.function
-def train_epoch(epoch, model, optimizer, epoch_loss_avg, data_module):
+def train_epoch(epoch, train_step, train_dataset, instrumentation=None, profiler=None):
+    """Run train_step over the batches of train_dataset, timing the batch assembly and the steps"""
     log = logging.getLogger(__name__)
+    instrumentation = Instrumentation() if instrumentation is None else instrumentation
+
+    steps = 0
+    batches = iter(train_dataset)
+    while True:
+        with instrumentation.timer("data"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        steps += 1
+        log.debug(f"Current epoch: {epoch} and step: {steps}")
+        instrumentation.count("train_rows", int(batch[0].shape[0]))
+        step_context = profiler.step() if profiler is not None else contextlib.nullcontext()
+        with step_context, instrumentation.timer("step"):
+            train_step(*batch)
+    instrumentation.count("train_steps", steps)
+    return steps
+
+
+def evaluate(model, data_module, args):
+    """Test losses and ranking metrics, as the entries of an epoch's results"""
+    log = logging.getLogger(__name__)
+    instrumentation = model.instrumentation
+
+    user_gcn_embeddings, item_gcn_embeddings = model.get_gcn_embeddings()
+    if args.eval_mode == "sampled":
+        # positives and sampled negatives scored in bulk from the embedding tables, a chunk of users at a time
+        with instrumentation.timer("sampled_ranking"):
+            metrics = evaluate_sampled_ranking(
+                user_gcn_embeddings,
+                item_gcn_embeddings,
+                data_module.test_data["ratings"],
+                data_module.test_data["negatives"],
+                cutoffs=EVALUATION_CUTOFFS,
+            )
+        ranking_metrics = {name: value for name, value in metrics.items() if name not in ["test_loss", "mse", "rmse"]}
+        test_loss, mse_val, rmse_val = metrics["test_loss"], metrics["mse"], metrics["rmse"]
+    else:
+        # test
+        with instrumentation.timer("test_loss"):
+            test_loss_avg = tf.keras.metrics.Mean()
+            (
+                test_input_users,
+                test_input_items,
+                test_label_ratings,
+                test_user_index_dict,
+            ) = data_module.get_test_data_positive()
+            test_y_predict = model([test_input_users, test_input_items])
+            test_loss_value = tf.nn.l2_loss(test_label_ratings - test_y_predict, name="test_loss")
+            test_loss_avg.update_state(test_loss_value)
+
+        with instrumentation.timer("full_ranking"):
+            ranking_metrics = evaluate_full_ranking(
+                user_gcn_embeddings,
+                item_gcn_embeddings,
+                data_module.test_data["ratings"],
+                data_module.train_data["ratings"],
+                cutoffs=EVALUATION_CUTOFFS,
+                users_per_chunk=args.eval_users_per_chunk,
+            )
 
-    for step, (input_users, input_items, label_ratings) in enumerate(data_module.train_data_batch_generator(), start=1):
-        log.debug(f"Current epoch: {epoch} and step: {step}")
-        train_epoch_batch(model, optimizer, epoch_loss_avg, input_users, input_items, label_ratings)  # type: ignore
-
+        # errors
+        rmse = tf.keras.metrics.RootMeanSquaredError()
+        rmse.update_state(test_label_ratings, test_y_predict)
 
-# @profile(stream=fp)
-def main():
+        # mse
+        mse = tf.keras.losses.MeanSquaredError()
+        mse_val = mse(test_label_ratings, test_y_predict).numpy()
+        test_loss, rmse_val = test_loss_avg.result().numpy(), rmse.result().numpy()
+
+    # # metrics hit_rate and ndcg
+    # hit_rate, ndcg = evaluate_hit_rate_and_ndcg(test_user_index_dict, test_label_ratings, test_y_predict, top_k=top_k)
+    # log.info(f"Test Loss: {test_loss_avg.result()}  Test HR: {hit_rate} Test NDCG: {ndcg}")
+    metrics = {}
+    metrics["test_loss"] = float(test_loss)
+    metrics["mse"] = float(mse_val)
+    metrics["rmse"] = float(rmse_val)
+    for name, value in ranking_metrics.items():
+        metrics[name] = float(value)
+    log.info(f"Test loss: {test_loss} MSE: {mse_val} RMSE: {rmse_val}")
+    for k in EVALUATION_CUTOFFS:
+        log.info(f"\t Test HR({k}): {ranking_metrics[f'hr_{k}']}\tTest NDCG({k}): {ranking_metrics[f'ndcg_{k}']}")
+        if args.eval_mode == "full":
+            log.info(f"\t Test Recall({k}): {ranking_metrics[f'recall_{k}']}")
+    if args.eval_mode == "full":
+        log.info(f"\t Test MRR: {ranking_metrics['mrr']}")
+    return metrics
+
+
+def should_stop_early(history, metric, patience):
+    """True when metric did not improve on the best before in the last patience epoch results reporting it"""
+    values = [epoch_info[metric] for epoch_info in history if metric in epoch_info]
+    if patience <= 0 or len(values) <= patience:
+        return False
+    if metric in MINIMIZED_METRICS:
+        return min(values[-patience:]) >= min(values[:-patience])
+    return max(values[-patience:]) <= max(values[:-patience])
+
+
+def parse_args(argv=None):
     # Training settings
     parser = argparse.ArgumentParser(description="Social Recommendation: GraphRec model")
     parser.add_argument("--model_name", type=str, default="DiffnetPlusMod", metavar="N", help="Model")
+    parser.add_argument("--data_dir", type=str, default=DATA_DIR, help="dataset directory, e.g. one written by generate_dataset.py")
     parser.add_argument(
         "--batch_size",
         type=int,
@@ -74,6 +287,21 @@ def main():
     parser.add_argument("--dims", type=int, default=64, metavar="N", help="embedding size")
     parser.add_argument("--lr", type=float, default=0.0005, metavar="LR", help="learning rate")
     parser.add_argument("--gcn_layers", type=int, default=2, metavar="N", help="GCN layers")
+    parser.add_argument("--per_layer_attention", action="store_true", help="learn separate node attention parameters for every GCN layer")
+    parser.add_argument(
+        "--aggregation",
+        type=str,
+        default="coo",
+        choices=AGGREGATION_BACKENDS,
+        help="sparse softmax and neighbor aggregation backend, segment runs entirely on XLA compatible ops",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="float32",
+        choices=PRECISIONS,
+        help="compute dtype of the dense review embedding layers (mixed bfloat16 keeps float32 weights), the graph propagation stays float32",
+    )
     parser.add_argument("--epochs", type=int, default=1, metavar="N", help="number of epochs to train")
     parser.add_argument(
         "--num_negatives",
@@ -89,8 +317,149 @@ def main():
         metavar="N",
         help="number of false positive ratings in test for evaluation",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--negative_sampler",
+        type=str,
+        default="uniform",
+        choices=SAMPLER_DISTRIBUTIONS,
+        help="distribution of the training negatives",
+    )
+    parser.add_argument(
+        "--resample_every",
+        type=int,
+        default=1,
+        metavar="N",
+        help="redraw the training negatives every N epochs, 0 keeps the negatives drawn at load time",
+    )
+    parser.add_argument("--seed", type=int, default=None, metavar="N", help="seed of the negative samplers and batch shuffling")
+    parser.add_argument(
+        "--eval_mode",
+        type=str,
+        default="sampled",
+        choices=["sampled", "full"],
+        help="rank the test items against num_evaluate sampled negatives or against the full item catalog",
+    )
+    parser.add_argument(
+        "--eval_users_per_chunk",
+        type=int,
+        default=1024,
+        metavar="N",
+        help="users scored against all items at once in full ranking evaluation",
+    )
+    parser.add_argument("--eval_every", type=int, default=1, metavar="N", help="compute the test losses and ranking metrics every N epochs and after the last one")
+    parser.add_argument(
+        "--early_stopping_patience",
+        type=int,
+        default=0,
+        metavar="N",
+        help="stop when --early_stopping_metric did not improve in the last N epochs reporting it, 0 disables early stopping",
+    )
+    parser.add_argument(
+        "--early_stopping_metric",
+        type=str,
+        default="val_loss",
+        help="epoch result early stopping watches and --keep_best ranks the checkpoints by, the validation loss by default. The test metrics (e.g. ndcg_10) select the model on the test set and bias its reported metrics",
+    )
+    parser.add_argument("--export_dir", type=str, default=None, help="export the final embeddings for serving to this directory")
+    parser.add_argument("--no_cache", action="store_true", help="parse the data directory instead of using the binary dataset cache")
+    parser.add_argument("--run_eagerly", action="store_true", help="run the training step eagerly instead of as a tf.function")
+    parser.add_argument(
+        "--jit_compile",
+        action="store_true",
+        help="compile the training step with XLA, as a whole with --aggregation=segment and with auto-clustering otherwise (when calling run() in a process that already used TensorFlow, export TF_XLA_FLAGS=--tf_xla_cpu_global_jit)",
+    )
+    parser.add_argument(
+        "--num_replicas",
+        type=int,
+        default=0,
+        metavar="N",
+        help="data parallel training with tf.distribute.MirroredStrategy over N logical CPU devices of this host, the replicas split the batch rows while the propagation runs once per step. 0 trains on the default device",
+    )
+    parser.add_argument("--shuffle_batches", action="store_true", help="shuffle the order of the (per user) training batches every epoch")
+    parser.add_argument(
+        "--num_buckets",
+        type=int,
+        default=4,
+        metavar="N",
+        help="number of padded batch shapes for the XLA compiled training step, 0 disables padding",
+    )
+    parser.add_argument(
+        "--neighbor_fanouts",
+        type=int,
+        nargs="+",
+        default=None,
+        metavar="N",
+        help="train on sampled computation subgraphs, neighbors sampled per node and edge set at every hop from the batch (one per GCN layer, 0 keeps all)",
+    )
+    parser.add_argument("--checkpoint_dir", type=str, default=None, help="checkpoint the model, optimizer and training state to this directory after every epoch")
+    parser.add_argument("--resume", action="store_true", help="resume training from the latest checkpoint in --checkpoint_dir")
+    parser.add_argument("--keep_best", type=int, default=3, metavar="N", help="number of best checkpoints by --early_stopping_metric kept in --checkpoint_dir")
+    parser.add_argument("--restore_best", action="store_true", help="restore the weights of the best checkpoint after training, before the export, and report their metrics as best_epoch_metrics")
+    parser.add_argument(
+        "--profile_steps",
+        type=parse_step_range,
+        default=None,
+        metavar="FIRST:LAST",
+        help="capture a tf.profiler trace of the training steps FIRST to LAST (counted over all epochs of the run) for TensorBoard",
+    )
+    parser.add_argument("--profile_dir", type=str, default=f"{LOG_DIR}/profile", help="directory of the --profile_steps trace")
+    args = parser.parse_args(argv)
+    if args.eval_every < 1:
+        parser.error("--eval_every must be at least 1")
+    if args.early_stopping_metric not in epoch_result_metrics(args.eval_mode):
+        parser.error(f"--early_stopping_metric must be one of the epoch results: {', '.join(epoch_result_metrics(args.eval_mode))}")
+    if (args.resume or args.restore_best) and args.checkpoint_dir is None:
+        parser.error("--resume and --restore_best need --checkpoint_dir")
+    if args.neighbor_fanouts is not None and len(args.neighbor_fanouts) != args.gcn_layers:
+        parser.error(f"--neighbor_fanouts needs one fanout per GCN layer ({args.gcn_layers})")
+    if args.num_replicas < 0:
+        parser.error("--num_replicas must not be negative")
+    if args.num_replicas > 0 and (args.neighbor_fanouts is not None or args.run_eagerly):
+        parser.error("--num_replicas trains the compiled full graph step, it excludes --neighbor_fanouts and --run_eagerly")
+    return args
+
+
+def load_data_module(args):
+    data_module = DataModule(
+        args.data_dir,
+        num_negatives=args.num_negatives,
+        num_evaluate=args.num_evaluate,
+        batch_size=args.batch_size,
+        use_cache=not args.no_cache,
+        negative_sampler=args.negative_sampler,
+        seed=args.seed,
+    )
+    data_module.load()
+    return data_module
+
 
+def build_model(args, data_module):
+    """The --model_name model over the graphs of a loaded DataModule"""
+    model_class = DiffnetPlusMod if args.model_name == "DiffnetPlusMod" else DiffnetPlus
+    train_data = data_module.train_data
+    return model_class(
+        gcn_layers=args.gcn_layers,
+        dims=args.dims,
+        num_users=len(data_module.user_map),
+        num_items=len(data_module.item_map),
+        user_review_embeddings=data_module.user_embeddings,
+        item_review_embeddings=data_module.item_embeddings,
+        user_consumed_items=train_data["user_consumed_items"],
+        item_consumed_users=train_data["item_consumed_items"],
+        user_links=data_module.user_links,
+        item_links=data_module.item_links,
+        per_layer_attention=args.per_layer_attention,
+        aggregation=args.aggregation,
+        precision=args.precision,
+    )
+
+
+# @profile(stream=fp)
+def run(args, epoch_callback=None):
+    """Train and evaluate with the parsed arguments and return the results.
+
+    epoch_callback(epoch, epoch_info) is called after every epoch, training stops early when it returns False.
+    """
     ## hyperparameter
     dims = args.dims
     gcn_layers = args.gcn_layers
@@ -105,18 +474,36 @@ def main():
     final_info["hyperparameters"] = {
         "dims": args.dims,
         "gcn_layers": args.gcn_layers,
+        "per_layer_attention": args.per_layer_attention,
+        "aggregation": args.aggregation,
+        "precision": args.precision,
+        "neighbor_fanouts": args.neighbor_fanouts,
         "epochs": args.epochs,
         "batch_size": args.batch_size,
         "num_negatives": args.num_negatives,
         "num_evaluate": args.num_evaluate,
         "learning_rate": args.lr,
+        "train_mode": "eager" if args.run_eagerly else ("xla" if args.jit_compile else "function"),
+        "num_replicas": args.num_replicas,
+        "num_buckets": args.num_buckets,
+        "negative_sampler": args.negative_sampler,
+        "resample_every": args.resample_every,
+        "seed": args.seed,
+        "eval_mode": args.eval_mode,
+        "eval_every": args.eval_every,
+        "early_stopping_patience": args.early_stopping_patience,
+        "early_stopping_metric": args.early_stopping_metric,
+        "checkpoint_dir": args.checkpoint_dir,
+        "profile_steps": args.profile_steps,
     }
+    # in the name of the result file
+    final_info["arguments_digest"] = arguments_digest(args)
 
     log = logging.getLogger(__name__)
 
-    data_dir = "./data/yelp_10"
+    data_dir = args.data_dir
     if not os.path.isdir(data_dir):
-        log.error("Data directory not found")
+        log.error(f"Data directory not found: {data_dir}")
         sys.exit()
 
     final_info["data_dir"] = data_dir
@@ -124,153 +511,201 @@ def main():
     log.info(
         f"Current config: dims: {dims} gcn_layers: {gcn_layers} epochs: {epochs} batch_size: {batch_size} num_negatives: {num_negatives} and num_evaluate={num_evaluate} and learning_rate={learning_rate}"
     )
+    # sparse tensor ops have no XLA kernels, the coo backend is compiled in clusters around them. Sampled subgraphs
+    # have a different shape every batch, they are never compiled as a whole
+    jit_compile_step = args.jit_compile and not args.run_eagerly and args.aggregation == "segment" and args.neighbor_fanouts is None and args.num_replicas == 0
+    # XLA reads its flags when TensorFlow first sets up its devices, clustering is enabled before the replicas and the data
+    if args.jit_compile and not args.run_eagerly and not jit_compile_step:
+        enable_xla_autoclustering()
+
+    # the logical devices of the replicas are set up before anything initializes the TensorFlow runtime
+    strategy = cpu_replica_strategy(args.num_replicas) if args.num_replicas > 0 else None
+
     # load data
     log.info(f"Loading dataset for dir: {data_dir}")
 
-    data_module = DataModule(
-        data_dir,
-        num_negatives=num_negatives,
-        num_evaluate=num_evaluate,
-        batch_size=batch_size,
-    )
-    data_module.load()
+    data_module = load_data_module(args)
     log.info("Data loaded successful!!!!!!")
-    train_data = data_module.train_data
 
-    if args.model_name == "DiffnetPlusMod":
-        final_info["model"] = "DiffnetPlusMod"
-        model = DiffnetPlusMod(
-            gcn_layers=gcn_layers,
-            dims=dims,
-            num_users=len(data_module.user_map),
-            num_items=len(data_module.item_map),
-            user_review_embeddings=data_module.user_embeddings,
-            item_review_embeddings=data_module.item_embeddings,
-            user_consumed_items=train_data["user_consumed_items"],
-            item_consumed_users=train_data["item_consumed_items"],
-            user_links=data_module.user_links,
-            item_links=data_module.item_links,
-        )
+    # the model and optimizer variables of data parallel training are mirrored over the replicas
+    with strategy.scope() if strategy is not None else contextlib.nullcontext():
+        model = build_model(args, data_module)
+        optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+    final_info["model"] = type(model).__name__
+    # per epoch breakdown of where the time goes
+    instrumentation = Instrumentation()
+    model.instrumentation = instrumentation
+    profiler = StepProfiler(*args.profile_steps, args.profile_dir) if args.profile_steps is not None else None
+
+    # compiled training step, XLA compiles its clusters for every distinct batch shape so batches are padded to a few fixed shapes
+    train_arrays = data_module.train_arrays()
+    batch_boundaries = None
+    if args.jit_compile and not args.run_eagerly and args.neighbor_fanouts is None:
+        batch_boundaries = bucket_boundaries(np.diff(train_arrays[-1]), args.num_buckets)
+
+    neighbor_sampler = None
+    train_subgraph_signature = None
+    if args.neighbor_fanouts is not None:
+        neighbor_sampler = NeighborSampler(model.edge_sets(), model.num_users, model.num_items, args.neighbor_fanouts, seed=args.seed)
+        train_subgraph_signature = subgraph_signature(neighbor_sampler)
+    epoch_loss_avg = tf.keras.metrics.Mean()
+    if strategy is not None:
+        train_step = make_distributed_train_step(model, optimizer, epoch_loss_avg, strategy)
     else:
-        final_info["model"] = "DiffnetPlus"
-        model = DiffnetPlus(
-            gcn_layers=gcn_layers,
-            dims=dims,
-            num_users=len(data_module.user_map),
-            num_items=len(data_module.item_map),
-            user_review_embeddings=data_module.user_embeddings,
-            item_review_embeddings=data_module.item_embeddings,
-            user_consumed_items=train_data["user_consumed_items"],
-            item_consumed_users=train_data["item_consumed_items"],
-            user_links=data_module.user_links,
-            item_links=data_module.item_links,
+        train_step = make_train_step(
+            model, optimizer, epoch_loss_avg, run_eagerly=args.run_eagerly, jit_compile=jit_compile_step, subgraph_signature=train_subgraph_signature
         )
+    log.info(
+        f"Training mode: {final_info['hyperparameters']['train_mode']} with batch buckets: {batch_boundaries}, neighbor fanouts: {args.neighbor_fanouts} and replicas: {args.num_replicas}"
+    )
 
-    # optimizer
-    optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
+    final_info["epoch"] = list()
+    start_epoch = 1
+    checkpoints = None
+    train_negative_sampler = data_module.train_data["negative_sampler"]
+    if args.checkpoint_dir:
+        # the best checkpoints are ranked by the metric early stopping selects the model with
+        checkpoints = TrainingCheckpoints(
+            args.checkpoint_dir,
+            model,
+            optimizer,
+            keep_best=args.keep_best,
+            metric=args.early_stopping_metric,
+            minimize=args.early_stopping_metric in MINIMIZED_METRICS,
+        )
+        restored = checkpoints.restore_latest() if args.resume else None
+        if restored is not None:
+            last_epoch, training_state, negatives = restored
+            start_epoch = last_epoch + 1
+            final_info["epoch"] = training_state["history"]
+            data_module.set_train_negatives(negatives)
+            train_arrays = data_module.train_arrays()
+            if training_state["next_negatives_state"] is not None:
+                train_negative_sampler.set_state(training_state["next_negatives_state"])
+            if training_state["resample_pending"]:
+                # the checkpointed run ended on a resampling epoch and skipped the swap, do it now
+                data_module.resample_train_negatives()
+                train_arrays = data_module.train_arrays()
+            if neighbor_sampler is not None:
+                neighbor_sampler.set_state(training_state["neighbor_sampler_state"])
+            log.info(f"Resuming training at epoch {start_epoch}")
+        elif args.resume:
+            log.warning(f"No checkpoint found in {args.checkpoint_dir}, training from scratch")
+
+    # the negatives of the next resampling are drawn in the background while the current ones are trained on, the
+    # sampler state they are drawn from is checkpointed so that a resumed run draws the same ones
+    next_negatives_state = train_negative_sampler.get_state() if args.resample_every > 0 else None
+    next_train_negatives = train_negative_sampler.sample_async() if args.resample_every > 0 else None
 
     ## train the model
-    final_info["epoch"] = list()
-    for epoch in range(1, epochs + 1):
+    for epoch in range(start_epoch, epochs + 1):
         epoch_info = {}
-        epoch_loss_avg = tf.keras.metrics.Mean()
+        epoch_loss_avg.reset_state()
+        instrumentation.reset()
         start_time = time.time()
-        train_epoch(epoch, model, optimizer, epoch_loss_avg, data_module)  # type: ignore
+        # a different batch order every epoch
+        epoch_seed = None if args.seed is None else args.seed + epoch
+        if neighbor_sampler is None:
+            train_dataset = make_train_dataset(*train_arrays, boundaries=batch_boundaries, shuffle=args.shuffle_batches, seed=epoch_seed)
+        else:
+            train_dataset = make_sampled_train_dataset(*train_arrays, neighbor_sampler, shuffle=args.shuffle_batches, seed=epoch_seed)
+            # the sampled steps normalize the review embeddings of their nodes with the moments of the epoch start
+            with instrumentation.timer("review_moments"):
+                model.update_review_moments()
+        with instrumentation.timer("train"):
+            steps = train_epoch(epoch, train_step, train_dataset, instrumentation=instrumentation, profiler=profiler)
         epoch_time = time.time() - start_time
 
-        # validation
-        validation_loss_avg = tf.keras.metrics.Mean()
-        (
-            validation_input_users,
-            validation_input_items,
-            validation_label_ratings,
-        ) = data_module.get_validation_data()
-        validation_y_predict = model([validation_input_users, validation_input_items])
-        validation_loss_value = tf.nn.l2_loss(validation_label_ratings - validation_y_predict, name="validation_loss")
-        validation_loss_avg.update_state(validation_loss_value)
+        # validation loss every epoch, it is cheap next to the test ranking
+        with instrumentation.timer("validation"):
+            validation_loss_avg = tf.keras.metrics.Mean()
+            (
+                validation_input_users,
+                validation_input_items,
+                validation_label_ratings,
+            ) = data_module.get_validation_data()
+            validation_y_predict = model([validation_input_users, validation_input_items])
+            validation_loss_value = tf.nn.l2_loss(validation_label_ratings - validation_y_predict, name="validation_loss")
+            validation_loss_avg.update_state(validation_loss_value)
 
         # metrics hit_rate and ndcg
         # hit_rate, ndcg = evaluate_hit_rate_and_ndcg(validation_user_index_dict, validation_label_ratings, validation_y_predict.numpy())
 
-        # test
-        test_loss_avg = tf.keras.metrics.Mean()
-        (
-            test_input_users,
-            test_input_items,
-            test_label_ratings,
-            test_user_index_dict,
-        ) = data_module.get_test_data_positive()
-        test_y_predict = model([test_input_users, test_input_items])
-        test_loss_value = tf.nn.l2_loss(test_label_ratings - test_y_predict, name="test_loss")
-        test_loss_avg.update_state(test_loss_value)
-
-        test_negative_predictions_user_dict = {}
-        for (
-            input_users,
-            input_items,
-            user_batch_list,
-        ) in data_module.get_test_data_negative():
-            negative_predictions = model([input_users, input_items])
-            negative_predictions_user_index = np.reshape(negative_predictions, (-1, num_evaluate))
-
-            for index, user in enumerate(user_batch_list):
-                test_negative_predictions_user_dict[user] = negative_predictions_user_index[index]
-
-        hit_rate_5, ndcg_5 = evaluate_hit_rate_and_ndcg_2(
-            test_user_index_dict,
-            test_y_predict.numpy(),
-            test_negative_predictions_user_dict,
-            top_k=5,
-        )
-        hit_rate_10, ndcg_10 = evaluate_hit_rate_and_ndcg_2(
-            test_user_index_dict,
-            test_y_predict.numpy(),
-            test_negative_predictions_user_dict,
-            top_k=10,
-        )
-        hit_rate_15, ndcg_15 = evaluate_hit_rate_and_ndcg_2(
-            test_user_index_dict,
-            test_y_predict.numpy(),
-            test_negative_predictions_user_dict,
-            top_k=15,
-        )
-
-        # errors
-        rmse = tf.keras.metrics.RootMeanSquaredError()
-        rmse.update_state(test_label_ratings, test_y_predict)
-
-        # mse
-        mse = tf.keras.losses.MeanSquaredError()
-        mse_val = mse(test_label_ratings, test_y_predict).numpy()
-
-        # # metrics hit_rate and ndcg
-        # hit_rate, ndcg = evaluate_hit_rate_and_ndcg(test_user_index_dict, test_label_ratings, test_y_predict, top_k=top_k)
-        # log.info(f"Test Loss: {test_loss_avg.result()}  Test HR: {hit_rate} Test NDCG: {ndcg}")
         epoch_info["time"] = epoch_time
+        epoch_info["steps_per_sec"] = steps / epoch_time
         epoch_info["train_loss"] = float(epoch_loss_avg.result().numpy())
         epoch_info["val_loss"] = float(validation_loss_avg.result().numpy())
-        epoch_info["test_loss"] = float(test_loss_avg.result().numpy())
-        epoch_info["mse"] = float(mse_val)
-        epoch_info["rmse"] = float(rmse.result().numpy())
-        epoch_info["hr_5"] = float(hit_rate_5)
-        epoch_info["hr_10"] = float(hit_rate_10)
-        epoch_info["hr_15"] = float(hit_rate_15)
-        epoch_info["ndcg_5"] = float(ndcg_5)
-        epoch_info["ndcg_10"] = float(ndcg_10)
-        epoch_info["ndcg_15"] = float(ndcg_15)
-        log.info(f"Epoch: {epoch}: Time Elapsed:{epoch_time} Loss: {epoch_loss_avg.result()} Validation Loss: {validation_loss_avg.result()}")
-        log.info(f"Test loss: {test_loss_avg.result()} MSE: {mse_val} RMSE: {rmse.result()}")
-        log.info(f"\t Test HR(5): {hit_rate_5}\tTest NDCG(5): {ndcg_5}")
-        log.info(f"\t Test HR(10): {hit_rate_10}\tTest NDCG(10): {ndcg_10}")
-        log.info(f"\t Test HR(15): {hit_rate_15}\tTest NDCG(15): {ndcg_15}")
+        log.info(f"Epoch: {epoch}: Time Elapsed:{epoch_time} Steps/sec: {steps / epoch_time} Loss: {epoch_loss_avg.result()} Validation Loss: {validation_loss_avg.result()}")
+
+        # test losses and ranking metrics on the evaluation schedule and after the last epoch
+        if epoch % args.eval_every == 0 or epoch == epochs:
+            with instrumentation.timer("evaluate"):
+                epoch_info.update(evaluate(model, data_module, args))
 
+        epoch_info["profile"] = instrumentation.breakdown()
+        log.debug(f"Epoch {epoch} profile: {epoch_info['profile']}")
         final_info["epoch"].append(epoch_info)
 
+        # swap in the resampled negatives
+        resample = next_train_negatives is not None and epoch % args.resample_every == 0
+        if resample and epoch < epochs:
+            data_module.set_train_negatives(next_train_negatives.result())
+            train_arrays = data_module.train_arrays()
+            next_negatives_state = train_negative_sampler.get_state()
+            next_train_negatives = train_negative_sampler.sample_async()
+
+        stop = False
+        if should_stop_early(final_info["epoch"], args.early_stopping_metric, args.early_stopping_patience):
+            log.info(f"Early stopping after epoch {epoch}: {args.early_stopping_metric} did not improve in the last {args.early_stopping_patience} epochs reporting it")
+            stop = True
+        elif epoch_callback is not None and not epoch_callback(epoch, epoch_info):
+            log.info(f"Training stopped after epoch {epoch} by the epoch callback")
+            stop = True
+
+        # a run stopped between two evaluations still reports the metrics of its last epoch, before they are checkpointed
+        if stop and "test_loss" not in epoch_info:
+            epoch_info.update(evaluate(model, data_module, args))
+
+        if checkpoints is not None:
+            training_state = {
+                "history": final_info["epoch"],
+                "next_negatives_state": next_negatives_state,
+                "resample_pending": resample and epoch == epochs,
+                "neighbor_sampler_state": neighbor_sampler.get_state() if neighbor_sampler is not None else None,
+            }
+            checkpoints.save(epoch, epoch_info, training_state, data_module.train_data["negatives"])
+
+        if stop:
+            final_info["stopped_early"] = True
+            break
+
+    train_negative_sampler.shutdown()
+    if profiler is not None:
+        profiler.stop()
+
+    if checkpoints is not None:
+        best = checkpoints.restore_best() if args.restore_best else None
+        checkpoints.sync()
+        if best is not None:
+            # the final metrics are the ones of the restored weights (and exported with them), not of the last epoch
+            final_info["best_epoch"] = best["epoch"]
+            final_info[f"best_{checkpoints.metric}"] = best[checkpoints.metric]
+            final_info["best_epoch_metrics"] = evaluate(model, data_module, args)
+
+    if args.export_dir:
+        export_embeddings(model, data_module, args.export_dir, model_name=final_info["model"])
+
     if not os.path.isdir("./out"):
         os.makedirs("./out")
 
-    with open(f"./out/{final_info['model']}_dims{dims}_gcn{gcn_layers}_epochs{epochs}_batch{batch_size}_neg{num_negatives}_eval{num_evaluate}_lr{learning_rate}.json", "w") as f:
+    output_name = f"{final_info['model']}_dims{dims}_gcn{gcn_layers}_epochs{epochs}_batch{batch_size}_neg{num_negatives}_eval{num_evaluate}_lr{learning_rate}_{final_info['arguments_digest']}"
+    with open(f"./out/{output_name}.json", "w") as f:
         json.dump(final_info, f)
+    return final_info
+
+
+def main():
+    run(parse_args())
 
 
 if __name__ == "__main__":
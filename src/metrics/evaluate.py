@@ -45,3 +45,153 @@ def evaluate_hit_rate_and_ndcg_2(user_index_dict, positive_ratings, negative_rat
         user_ndcg_values.append(compute_ndcg(relevance_score, sorted(relevance_score, reverse=True)))
 
     return np.mean(user_hit_rates), np.mean(user_ndcg_values)
+
+
+def ranking_keys(scores):
+    """Unique int64 sort keys for a 2-D score matrix, ordered by score then column.
+
+    Equal scores rank the later column first, the order of np.argsort(scores)[::-1] with a stable sort. As
+    positives are laid out before negatives, ties are resolved against the positives.
+    """
+    bits = np.ascontiguousarray(scores, dtype=np.float32).view(np.int32).astype(np.int64)
+    # map the float bit patterns to integers with the same order
+    ordered = np.where(bits < 0, bits ^ 0x7FFFFFFF, bits)
+    width = scores.shape[1]
+    return ordered * width + np.arange(width, dtype=np.int64)
+
+
+class RankingMetrics:
+    """Accumulates hit rate and ndcg at several cutoffs from padded per user score matrices.
+
+    Metrics follow evaluate_hit_rate_and_ndcg_2: hit rate is the number of positives in the top k over
+    min(#positives, k) and ndcg normalizes the dcg of the top k by the ideal dcg of the same number of hits.
+    """
+
+    def __init__(self, cutoffs=(5, 10, 15)):
+        self.cutoffs = sorted(cutoffs)
+        self.max_cutoff = self.cutoffs[-1]
+        # discount of every rank and ideal dcg for any number of hits
+        self.discounts = 1.0 / np.log2(np.arange(self.max_cutoff) + 2)
+        self.ideal_dcg = np.concatenate([[0.0], np.cumsum(self.discounts)])
+        self.reset()
+
+    def reset(self):
+        self.num_users = 0
+        self.hit_rate_sums = {k: 0.0 for k in self.cutoffs}
+        self.ndcg_sums = {k: 0.0 for k in self.cutoffs}
+
+    def update(self, positive_scores, positive_counts, negative_scores):
+        """positive_scores: (users, max #positives) padded with -inf, positive_counts: (users,), negative_scores: (users, #negatives)"""
+        positive_counts = np.asarray(positive_counts)
+        scores = np.concatenate([positive_scores, negative_scores], axis=1)
+        keys = ranking_keys(scores)
+
+        max_cutoff = min(self.max_cutoff, scores.shape[1])
+        top = np.argpartition(-keys, max_cutoff - 1, axis=1)[:, :max_cutoff]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(keys, top, axis=1), axis=1), axis=1)
+        relevance = top < positive_counts[:, None]
+
+        hits = np.cumsum(relevance, axis=1)
+        dcg = np.cumsum(relevance * self.discounts[:max_cutoff], axis=1)
+        for k in self.cutoffs:
+            column = min(k, max_cutoff) - 1
+            hits_k = hits[:, column]
+            ideal_dcg_k = self.ideal_dcg[hits_k]
+            self.hit_rate_sums[k] += float(np.sum(hits_k / np.minimum(positive_counts, k)))
+            self.ndcg_sums[k] += float(np.sum(np.divide(dcg[:, column], ideal_dcg_k, out=np.zeros(len(hits_k)), where=hits_k > 0)))
+        self.num_users += len(positive_counts)
+
+    def result(self) -> dict:
+        """Mean hit rate and ndcg over all users, {k: (hit_rate, ndcg)}"""
+        num_users = max(self.num_users, 1)
+        return {k: (self.hit_rate_sums[k] / num_users, self.ndcg_sums[k] / num_users) for k in self.cutoffs}
+
+
+def pack_scores(user_index_dict, positive_ratings, negative_ratings_user_dict, users=None):
+    """Padded (users, max #positives) positive scores, positive counts and (users, #negatives) negative scores"""
+    users = list(user_index_dict) if users is None else users
+    positive_counts = np.array([len(user_index_dict[user]) for user in users], dtype=np.int64)
+    positive_indices = np.concatenate([user_index_dict[user] for user in users]).astype(np.int64)
+
+    rows = np.repeat(np.arange(len(users)), positive_counts)
+    columns = np.arange(len(positive_indices)) - np.repeat(np.cumsum(positive_counts) - positive_counts, positive_counts)
+    positive_scores = np.full((len(users), positive_counts.max()), -np.inf, dtype=np.float32)
+    positive_scores[rows, columns] = np.reshape(positive_ratings, [-1])[positive_indices]
+
+    negative_scores = np.stack([np.reshape(negative_ratings_user_dict[user], [-1]) for user in users]).astype(np.float32)
+    return positive_scores, positive_counts, negative_scores
+
+
+def evaluate_hit_rate_and_ndcg_at_k(user_index_dict, positive_ratings, negative_ratings_user_dict, cutoffs=(5, 10, 15), users_per_chunk=4096):
+    """Hit rate and ndcg for all cutoffs in one ranking pass, {k: (hit_rate, ndcg)}"""
+    metrics = RankingMetrics(cutoffs)
+    users = list(user_index_dict)
+    for start in range(0, len(users), users_per_chunk):
+        metrics.update(*pack_scores(user_index_dict, positive_ratings, negative_ratings_user_dict, users[start : start + users_per_chunk]))
+    return metrics.result()
+
+
+# scoring the whole catalog with one matmul and picking the scores of the ids beats gathering the ids' embeddings
+# for catalogs of up to about this many times the ids per user
+DENSE_SCORING_RATIO = 32
+
+
+def score_items(user_embeddings, item_embeddings, item_ids, dense=False):
+    """Predictions of a block of (users, n) item ids for the rows of user_embeddings.
+
+    Either the embeddings of the ids are gathered and multiplied with the users' in an einsum, or with dense the
+    users are scored against all items in a matmul and the scores of the ids are gathered.
+    """
+    if dense:
+        logits = tf.gather(tf.matmul(user_embeddings, item_embeddings, transpose_b=True), item_ids, batch_dims=1)
+    else:
+        logits = tf.einsum("ud,und->un", user_embeddings, tf.gather(item_embeddings, item_ids))
+    return tf.math.sigmoid(logits)
+
+
+def evaluate_sampled_ranking(user_gcn_embeddings, item_gcn_embeddings, test_ratings, test_negatives, cutoffs=(5, 10, 15), max_chunk_values=2**24):
+    """Hit rate and ndcg against the sampled negatives and the errors of the test ratings, from the gcn embedding tables.
+
+    Scores are the predictions of the model for the test ratings (test_ratings is a DataModule ratings dict) and the
+    (users, num_evaluate) test_negatives of every test user, computed in bulk by score_items. Users are scored in
+    chunks of at most about max_chunk_values intermediate values, the scores of a chunk go straight to a
+    RankingMetrics, so memory does not grow with the number of test users. Returns hr_k and ndcg_k for every cutoff,
+    test_loss, mse and rmse.
+    """
+    offsets = np.asarray(test_ratings["offsets"], dtype=np.int64)
+    test_users = np.flatnonzero(np.diff(offsets))
+    num_items, dims = item_gcn_embeddings.shape
+    num_negatives = max(test_negatives.shape[1], 1)
+    dense = num_items <= DENSE_SCORING_RATIO * num_negatives
+    users_per_chunk = max(1, max_chunk_values // (num_items if dense else num_negatives * dims))
+
+    metrics = RankingMetrics(cutoffs)
+    squared_error_sum = 0.0
+    for start in range(0, len(test_users), users_per_chunk):
+        users = test_users[start : start + users_per_chunk]
+        user_embeddings = tf.gather(user_gcn_embeddings, users)
+
+        # positives padded to the most of any user in the chunk, the chunk's ratings are one slice of the CSR
+        positions = slice(offsets[users[0]], offsets[users[-1] + 1])
+        items, labels = np.asarray(test_ratings["items"][positions], dtype=np.int64), np.asarray(test_ratings["values"][positions], dtype=np.float64)
+        positive_counts = offsets[users + 1] - offsets[users]
+        rows = np.repeat(np.arange(len(users)), positive_counts)
+        columns = np.arange(len(rows)) - np.repeat(np.cumsum(positive_counts) - positive_counts, positive_counts)
+        positive_items = np.zeros((len(users), positive_counts.max()), dtype=np.int64)
+        positive_items[rows, columns] = items
+        item_ids = np.concatenate([positive_items, np.asarray(test_negatives[users], dtype=np.int64)], axis=1)
+        scores = score_items(user_embeddings, item_gcn_embeddings, item_ids, dense=dense).numpy()
+        positive_scores, negative_scores = scores[:, : positive_items.shape[1]], scores[:, positive_items.shape[1] :]
+        squared_error_sum += float(np.sum(np.square(labels - positive_scores[rows, columns])))
+        positive_scores[np.arange(positive_items.shape[1]) >= positive_counts[:, None]] = -np.inf
+        metrics.update(positive_scores, positive_counts, negative_scores)
+
+    results = {}
+    for k, (hit_rate, ndcg) in metrics.result().items():
+        results[f"hr_{k}"] = hit_rate
+        results[f"ndcg_{k}"] = ndcg
+    num_ratings = max(int(offsets[-1]), 1)
+    results["test_loss"] = squared_error_sum / 2
+    results["mse"] = squared_error_sum / num_ratings
+    results["rmse"] = math.sqrt(squared_error_sum / num_ratings)
+    return results
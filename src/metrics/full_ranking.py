@@ -0,0 +1,73 @@
+import numpy as np
+import tensorflow as tf
+
+from util.graph_builder import csr_rows
+
+
+def positive_csr(ratings):
+    """CSR of the positive (rating > 0) items of every user from a DataModule ratings dict"""
+    offsets = np.asarray(ratings["offsets"], dtype=np.int64)
+    positive = np.asarray(ratings["values"]) > 0
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))[positive]
+    counts = np.bincount(rows, minlength=len(offsets) - 1)
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64), np.asarray(ratings["items"])[positive]
+
+
+def evaluate_full_ranking(user_gcn_embeddings, item_gcn_embeddings, test_ratings, train_ratings, cutoffs=(5, 10, 15), users_per_chunk=1024):
+    """Rank all items for every test user and report HR@k, NDCG@k, Recall@k and MRR.
+
+    Scores are the dot products of the final gcn embeddings (the sigmoid does not change the ranking). Users are
+    scored in chunks of users_per_chunk against all items, so at most a (users_per_chunk, num_items) score matrix
+    exists at a time. Training positives are masked out and never count as hits. HR@k is hits / min(#positives, k) as in the sampled
+    protocol, Recall@k is hits / #positives and NDCG@k is normalized by the ideal dcg of min(#positives, k) hits.
+    """
+    cutoffs = sorted(cutoffs)
+    num_items = int(item_gcn_embeddings.shape[0])
+    max_cutoff = min(cutoffs[-1], num_items)
+    discounts = 1.0 / np.log2(np.arange(max_cutoff) + 2)
+    ideal_dcg = np.concatenate([[0.0], np.cumsum(discounts)])
+
+    test_offsets, test_items = positive_csr(test_ratings)
+    train_offsets = np.asarray(train_ratings["offsets"], dtype=np.int64)
+    train_items = train_ratings["items"]
+    test_users = np.flatnonzero(np.diff(test_offsets))
+
+    sums = {f"{name}_{k}": 0.0 for name in ["hr", "ndcg", "recall"] for k in cutoffs}
+    sums["mrr"] = 0.0
+    for start in range(0, len(test_users), users_per_chunk):
+        users = test_users[start : start + users_per_chunk]
+        scores = tf.matmul(tf.gather(user_gcn_embeddings, users), item_gcn_embeddings, transpose_b=True)
+
+        # mask training positives
+        mask_rows, mask_items = csr_rows(train_offsets, train_items, users)
+        if len(mask_rows):
+            mask_indices = np.stack([mask_rows, mask_items], axis=1)
+            scores = tf.tensor_scatter_nd_update(scores, mask_indices, tf.fill([len(mask_rows)], float("-inf")))
+
+        top_scores, top_items = tf.math.top_k(scores, k=max_cutoff)
+
+        # test positives as sorted (row, item) keys
+        positive_rows, positive_items = csr_rows(test_offsets, test_items, users)
+        positive_keys = positive_rows * num_items + positive_items
+        positive_counts = np.diff(test_offsets)[users]
+
+        top_keys = np.arange(len(users), dtype=np.int64)[:, None] * num_items + top_items.numpy()
+        position = np.minimum(np.searchsorted(positive_keys, top_keys), len(positive_keys) - 1)
+        # users with fewer than k unmasked items get masked items in their top k, those are no candidates
+        relevance = (positive_keys[position] == top_keys) & np.isfinite(top_scores.numpy())
+
+        hits = np.cumsum(relevance, axis=1)
+        dcg = np.cumsum(relevance * discounts, axis=1)
+        for k in cutoffs:
+            column = min(k, max_cutoff) - 1
+            sums[f"hr_{k}"] += float(np.sum(hits[:, column] / np.minimum(positive_counts, k)))
+            sums[f"recall_{k}"] += float(np.sum(hits[:, column] / positive_counts))
+            sums[f"ndcg_{k}"] += float(np.sum(dcg[:, column] / ideal_dcg[np.minimum(positive_counts, column + 1)]))
+
+        # reciprocal rank of the best ranked positive over the whole catalog
+        best_positive_scores = tf.math.unsorted_segment_max(tf.gather_nd(scores, np.stack([positive_rows, positive_items], axis=1)), positive_rows, len(users))
+        ranks = tf.reduce_sum(tf.cast(scores > best_positive_scores[:, None], tf.int64), axis=1) + 1
+        sums["mrr"] += float(tf.reduce_sum(1.0 / tf.cast(ranks, tf.float64)))
+
+    num_users = max(len(test_users), 1)
+    return {name: value / num_users for name, value in sums.items()}
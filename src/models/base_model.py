@@ -0,0 +1,306 @@
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+from layers.sparse_aggregation import make_aggregation, segment_matmul, segment_softmax
+from util.instrumentation import Instrumentation
+from util.neighbor_sampler import NeighborSampler
+from util.tf_helper import normalize_with_moments
+
+log = logging.getLogger(__name__)
+
+PRECISIONS = ["float32", "bfloat16"]
+
+
+def dense_policy(precision):
+    """Keras dtype policy of the dense review embedding layers (dim reduction and fusion) for a precision"""
+    if precision == "float32":
+        return "float32"
+    if precision == "bfloat16":
+        return "mixed_bfloat16"
+    raise ValueError(f"Unknown precision: {precision}")
+
+
+class GCNBaseModel(tf.keras.Model):
+    """Common prediction path of the GCN models.
+
+    Subclasses implement `propagate` which runs the graph convolution over all users and items and returns the
+    final (concatenated over layers) user and item embedding tables. Predictions only gather rows of these
+    tables, so in inference mode the tables are computed once and cached until the weights change. Given a
+    subgraph sampled by util.neighbor_sampler, `propagate` only runs over its nodes and edges and returns the
+    embeddings of the batch nodes (see `call_subgraph`).
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super(GCNBaseModel, self).__init__(*args, **kwargs)
+        # bumped by every training forward pass, a cached propagation is only reused for the same version
+        self.weights_version = tf.Variable(0, dtype=tf.int64, trainable=False, name="weights_version")
+        self.gcn_embeddings_cache = None
+        self.gcn_embeddings_cache_version = None
+        # (mean, variance) over all nodes of the reduced review embeddings, normalizes the nodes of sampled subgraphs
+        self.user_review_moments = tf.Variable([0.0, 1.0], trainable=False, name="user_review_moments")
+        self.item_review_moments = tf.Variable([0.0, 1.0], trainable=False, name="item_review_moments")
+        self.review_moments_version = None
+        # review embedding tensors of compiled full graph steps, see reduced_review_embeddings
+        self.user_review_table = None
+        self.item_review_table = None
+        # timers of the propagation stages, replaced by the one of the training run
+        self.instrumentation = Instrumentation()
+
+    def propagate(self, training=False, subgraph=None):
+        raise NotImplementedError
+
+    def node_attention_layers(self, name):
+        """Dense(1) node attention layers for an edge set, one shared by all gcn layers or one per gcn layer with per_layer_attention"""
+        num_layers = self.gcn_layers if self.per_layer_attention else 1
+        return [tf.keras.layers.Dense(1, activation=tf.nn.sigmoid, name=name if layer == 0 else f"{name}_gcn_{layer}") for layer in range(num_layers)]
+
+    def edge_sets(self):
+        """{edge set: (graph, destination node type, source node type)} of the edge sets aggregated in every gcn layer.
+
+        Every edge set has the attributes {edge set}_sparse_values, _attention_layers and _aggregation.
+        """
+        raise NotImplementedError
+
+    def node_attention_values(self, edge_values, attention_layer):
+        # generate trained weights for each edge
+        values = tf.reshape(edge_values, [-1, 1])
+        values = attention_layer(values)
+        return tf.reduce_sum(tf.math.exp(values), axis=1)
+
+    def node_attention_matrices(self, edge_values, attention_layers, aggregation):
+        """Row softmax normalized attention of every attention layer, in the representation of the aggregation backend"""
+        return [aggregation.softmax(self.node_attention_values(edge_values, attention_layer)) for attention_layer in attention_layers]
+
+    def layer_attention(self, attention_matrices, layer):
+        return attention_matrices[layer if self.per_layer_attention else 0]
+
+    def edge_attention(self, subgraph=None):
+        """Normalized attention of every edge set over the full graph.
+
+        The attention only depends on the trainable edge values, not on the embeddings, so it is computed once per
+        forward pass before the gcn layer loop. Over a sampled subgraph the edges differ per layer and the
+        attention is computed in `aggregate`.
+        """
+        if subgraph is not None:
+            return None
+        with self.instrumentation.timer("sparse_attention"):
+            return {
+                edge: self.node_attention_matrices(getattr(self, f"{edge}_sparse_values"), getattr(self, f"{edge}_attention_layers"), getattr(self, f"{edge}_aggregation"))
+                for edge in self.edge_sets()
+            }
+
+    def aggregate(self, edge, attention, layer, embeddings, subgraph=None):
+        """Attention weighted sum of the source node embeddings over the edges of every destination node of a layer"""
+        with self.instrumentation.timer("sparse_aggregation"):
+            if subgraph is None:
+                return getattr(self, f"{edge}_aggregation").matmul(self.layer_attention(attention[edge], layer), embeddings)
+
+            # softmax over the sampled edges of every destination node
+            block = subgraph["blocks"][layer][edge]
+            _, destination_type, _ = self.edge_sets()[edge]
+            num_rows = tf.shape(subgraph[f"{destination_type}s"][layer + 1])[0]
+            attention_layer = self.layer_attention(getattr(self, f"{edge}_attention_layers"), layer)
+            values = self.node_attention_values(tf.gather(getattr(self, f"{edge}_sparse_values"), block["edges"]), attention_layer)
+            return segment_matmul(segment_softmax(values, block["rows"], num_rows), embeddings, block["rows"], block["cols"], num_rows)
+
+    def review_layers(self):
+        """{node type: (review embeddings, dim reduction layer, fusion layer)} of the layer 0 embeddings.
+
+        The review embeddings are the normalized float32 numpy arrays of the DataModule, memory-mapped from the
+        dataset cache. They are not converted as a whole, see review_rows and reduced_review_embeddings.
+        """
+        raise NotImplementedError
+
+    def review_rows(self, node_type, nodes):
+        """Review embeddings of the given nodes, read from the numpy array"""
+        review_embeddings, _, _ = self.review_layers()[node_type]
+        rows = tf.numpy_function(lambda nodes: np.asarray(review_embeddings[nodes], dtype=np.float32), [nodes], tf.float32, stateful=False)
+        rows.set_shape([None, review_embeddings.shape[1]])
+        return rows
+
+    def reduced_review_embeddings(self, node_type, rows_per_chunk=65536):
+        """Dim reduction of the review embeddings of all nodes.
+
+        Eagerly the numpy array is reduced a chunk of rows at a time. A compiled step reads all rows on every call,
+        so its first trace converts the array once into a tensor of the compute dtype of the dim reduction, which
+        is kept and captured by the step.
+        """
+        review_embeddings, reduce_dims_layer, _ = self.review_layers()[node_type]
+        if tf.executing_eagerly():
+            chunks = [reduce_dims_layer(review_embeddings[start : start + rows_per_chunk]) for start in range(0, len(review_embeddings), rows_per_chunk)]
+            return tf.concat(chunks, 0)
+
+        table = getattr(self, f"{node_type}_review_table")
+        if table is None:
+            with tf.init_scope():
+                # cast while reading the array, without a float32 copy next to a bfloat16 one
+                table = tf.convert_to_tensor(np.asarray(review_embeddings, dtype=tf.as_dtype(reduce_dims_layer.compute_dtype).as_numpy_dtype))
+            setattr(self, f"{node_type}_review_table", table)
+        return reduce_dims_layer(table)
+
+    def input_embeddings(self, subgraph=None):
+        """Layer 0 (fusion) embeddings of the nodes propagated over, all nodes or the outermost level of the subgraph.
+
+        The reduced review embeddings are normalized with their moments over all nodes. Over a subgraph only the
+        review embeddings of its nodes are read, reduced and fused, normalized with the moments of
+        update_review_moments, so a sampled step runs no dense layer over all nodes (and does not differentiate
+        through the moments).
+        """
+        embeddings = []
+        with self.instrumentation.timer("dense_fusion"):
+            for node_type, (review_embeddings, reduce_dims_layer, fusion_layer) in self.review_layers().items():
+                if subgraph is None:
+                    # reduce the dims of the normalized review embeddings
+                    review_embeddings_norm = normalize_with_moments(tf.cast(self.reduced_review_embeddings(node_type), tf.float32), axes=[0, 1])
+                    # fusion layer
+                    embeddings.append(tf.cast(fusion_layer(review_embeddings_norm), tf.float32))
+                    continue
+
+                nodes = subgraph[f"{node_type}s"][0]
+                moments = tf.unstack(getattr(self, f"{node_type}_review_moments"))
+                review_embeddings_norm = normalize_with_moments(tf.cast(reduce_dims_layer(self.review_rows(node_type, nodes)), tf.float32), axes=[0, 1], moments=moments)
+                if not fusion_layer.built:
+                    # the free embeddings are a row per node
+                    fusion_layer.build(tf.TensorShape([review_embeddings.shape[0], reduce_dims_layer.units]))
+                embeddings.append(tf.cast(fusion_layer(review_embeddings_norm, nodes=nodes), tf.float32))
+        return tuple(embeddings)
+
+    def update_review_moments(self):
+        """Store the moments over all nodes of the reduced review embeddings for the current weights, sampled steps
+        normalize with them. main updates them once per epoch of neighbor sampled training.
+        """
+        for node_type in self.review_layers():
+            moments = tf.nn.moments(tf.cast(self.reduced_review_embeddings(node_type), tf.float32), axes=[0, 1])
+            getattr(self, f"{node_type}_review_moments").assign(tf.stack(moments))
+        self.review_moments_version = int(self.weights_version.numpy())
+
+    def destination_embeddings(self, embeddings, node_type, layer, subgraph=None):
+        """Previous layer embeddings of the nodes updated by a layer, over a subgraph the first nodes of the level"""
+        if subgraph is None:
+            return embeddings
+        return embeddings[: tf.shape(subgraph[f"{node_type}s"][layer + 1])[0]]
+
+    def output_embeddings(self, layer_embeddings, node_type, subgraph=None):
+        """Concatenation of the embeddings of all layers, over a subgraph of the batch nodes"""
+        if subgraph is not None:
+            num_nodes = tf.shape(subgraph[f"{node_type}s"][-1])[0]
+            layer_embeddings = [embeddings[:num_nodes] for embeddings in layer_embeddings]
+        return tf.concat(layer_embeddings, 1)
+
+    def get_gcn_embeddings(self):
+        """Final user and item gcn embedding tables for the current weights"""
+        if not tf.executing_eagerly():
+            return self.propagate(training=False)
+
+        if not self.has_current_gcn_embeddings():
+            with self.instrumentation.timer("propagate"):
+                self.gcn_embeddings_cache = self.propagate(training=False)
+            self.gcn_embeddings_cache_version = int(self.weights_version.numpy())
+        return self.gcn_embeddings_cache
+
+    def has_current_gcn_embeddings(self):
+        return self.gcn_embeddings_cache is not None and self.gcn_embeddings_cache_version == int(self.weights_version.numpy())
+
+    def invalidate_gcn_embeddings(self):
+        """Drop the cached embedding tables, required after weights are changed outside of training (e.g. restore)"""
+        self.gcn_embeddings_cache = None
+        self.gcn_embeddings_cache_version = None
+
+    def extend_edge_set(self, edge, graph, order):
+        """Replace the graph of an edge set by graph, its edges followed by new ones and laid out by order (see
+        util.graph_builder.extend_adjacency).
+
+        The trainable edge values are grown the same way, trained values are kept and new edges start at the mean
+        trained value. The cached embedding tables are kept, refresh_gcn_embeddings updates the affected nodes.
+        """
+        current_graph, destination_type, source_type = self.edge_sets()[edge]
+        # through the tracked wrapper of the graph dict, it fails checkpoints when the dict is changed behind it
+        current_graph.update(graph)
+
+        edge_values = getattr(self, f"{edge}_sparse_values")
+        num_new_edges = len(order) - edge_values.shape[0]
+        initial_value = tf.reduce_mean(edge_values) if edge_values.shape[0] else 0.0
+        values = tf.gather(tf.concat([edge_values, tf.fill([num_new_edges], initial_value)], 0), order)
+        setattr(self, f"{edge}_sparse_values", tf.Variable(values, trainable=True, name=edge_values.name.split(":")[0]))
+
+        num_nodes = {"user": self.num_users, "item": self.num_items}
+        setattr(self, f"{edge}_aggregation", make_aggregation(self.aggregation, graph["indices"], [num_nodes[destination_type], num_nodes[source_type]]))
+
+    def affected_nodes(self, new_edges):
+        """Users and items whose final embeddings change with new edges, given as {edge set: (destinations, sources)}.
+
+        An edge changes the layer 1 embedding of its destination. A node changed at layer l changes at layer l + 1
+        itself and the destinations of its edges as a source. The final embeddings concatenate all layers, so
+        the nodes changed at the last layer are the affected ones.
+        """
+        changed = {"user": np.zeros(self.num_users, dtype=bool), "item": np.zeros(self.num_items, dtype=bool)}
+        if self.gcn_layers == 0:
+            return np.flatnonzero(changed["user"]), np.flatnonzero(changed["item"])
+
+        for edge, (destinations, _) in new_edges.items():
+            _, destination_type, _ = self.edge_sets()[edge]
+            changed[destination_type][np.asarray(destinations, dtype=np.int64)] = True
+        for _ in range(self.gcn_layers - 1):
+            next_changed = {node_type: nodes.copy() for node_type, nodes in changed.items()}
+            for graph, destination_type, source_type in self.edge_sets().values():
+                indices = np.asarray(graph["indices"])
+                next_changed[destination_type][indices[changed[source_type][indices[:, 1]], 0]] = True
+            changed = next_changed
+        return np.flatnonzero(changed["user"]), np.flatnonzero(changed["item"])
+
+    def refresh_gcn_embeddings(self, users, items, nodes_per_batch=4096):
+        """Recompute the rows of the given users and items in the cached embedding tables, e.g. the affected_nodes
+        of new edges.
+
+        Every batch of nodes is propagated over its full L-hop neighborhood, a NeighborSampler keeping all
+        neighbors, which gives the embeddings of a full propagation. Without cached tables of the current weights
+        all embeddings are propagated.
+        """
+        if not self.has_current_gcn_embeddings():
+            return self.get_gcn_embeddings()
+
+        if self.review_moments_version != int(self.weights_version.numpy()):
+            self.update_review_moments()
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        sampler = NeighborSampler(self.edge_sets(), self.num_users, self.num_items, [0] * self.gcn_layers)
+        user_gcn_embeddings, item_gcn_embeddings = (np.array(embeddings) for embeddings in self.gcn_embeddings_cache)
+        for start in range(0, max(len(users), len(items)), nodes_per_batch):
+            subgraph = sampler.sample(users[start : start + nodes_per_batch], items[start : start + nodes_per_batch])
+            batch_user_embeddings, batch_item_embeddings = self.propagate(training=False, subgraph=subgraph)
+            user_gcn_embeddings[subgraph["users"][-1]] = batch_user_embeddings.numpy()
+            item_gcn_embeddings[subgraph["items"][-1]] = batch_item_embeddings.numpy()
+
+        self.gcn_embeddings_cache = (tf.convert_to_tensor(user_gcn_embeddings), tf.convert_to_tensor(item_gcn_embeddings))
+        return self.gcn_embeddings_cache
+
+    def predict_from_embeddings(self, user_gcn_embeddings, item_gcn_embeddings, user_input, item_input):
+        user_input_latent_embeddings = tf.gather_nd(user_gcn_embeddings, user_input)
+        item_input_latent_embeddings = tf.gather_nd(item_gcn_embeddings, item_input)
+
+        # prediction
+        predict_vector = tf.multiply(
+            user_input_latent_embeddings,
+            item_input_latent_embeddings,
+            name="prediction_vector",
+        )
+        return tf.math.sigmoid(tf.math.reduce_sum(predict_vector, 1, keepdims=True), name="prediction")
+
+    def call(self, inputs, training=False):
+        user_input, item_input = inputs
+        if training:
+            # weights are updated after every training pass
+            self.weights_version.assign_add(1)
+            user_gcn_embeddings, item_gcn_embeddings = self.propagate(training=True)
+        else:
+            user_gcn_embeddings, item_gcn_embeddings = self.get_gcn_embeddings()
+        return self.predict_from_embeddings(user_gcn_embeddings, item_gcn_embeddings, user_input, item_input)
+
+    def call_subgraph(self, subgraph, training=False):
+        """Predictions for the inputs a subgraph was sampled for, propagating over the subgraph only"""
+        if training:
+            self.weights_version.assign_add(1)
+        user_gcn_embeddings, item_gcn_embeddings = self.propagate(training=training, subgraph=subgraph)
+        return self.predict_from_embeddings(user_gcn_embeddings, item_gcn_embeddings, subgraph["user_positions"], subgraph["item_positions"])
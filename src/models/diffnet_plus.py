@@ -3,7 +3,8 @@ import logging
 import tensorflow as tf
 
 from layers.fusion_layer import FusionLayer
-from util.tf_helper import normalize_with_moments
+from layers.sparse_aggregation import make_aggregation
+from models.base_model import GCNBaseModel, dense_policy
 
 # from memory_profiler import profile
 
@@ -12,7 +13,7 @@ log = logging.getLogger(__name__)
 # fp = open("memory_reports/diffnet.log", "w+")
 
 
-class DiffnetPlus(tf.keras.Model):
+class DiffnetPlus(GCNBaseModel):
     def __init__(
         self,
         gcn_layers,
@@ -25,6 +26,9 @@ class DiffnetPlus(tf.keras.Model):
         user_links,
         item_consumed_users,
         item_links,
+        per_layer_attention=False,
+        aggregation="coo",
+        precision="float32",
         *args,
         **kwargs,
     ) -> None:
@@ -33,8 +37,18 @@ class DiffnetPlus(tf.keras.Model):
         self.low_att_std = 1.0
         self.dims = dims
         self.gcn_layers = gcn_layers
+        # a separate node attention layer per gcn layer instead of one shared by all layers
+        self.per_layer_attention = per_layer_attention
+        # sparse softmax and aggregation backend of the edge sets, see layers.sparse_aggregation
+        self.aggregation = aggregation
+        # the dense review embedding layers run under the mixed precision policy of precision, the propagation,
+        # sparse softmax and loss stay float32
+        self.precision = precision
+        dense_dtype = dense_policy(precision)
         self.num_users = num_users
         self.num_items = num_items
+        # review embeddings come normalized (see DataModule) and possibly memory-mapped, they stay numpy arrays
+        # that the model reads rows of (see GCNBaseModel.review_layers)
         self.user_review_embeddings = user_review_embeddings
         self.item_review_embeddings = item_review_embeddings
         self.user_consumed_items = user_consumed_items
@@ -72,17 +86,20 @@ class DiffnetPlus(tf.keras.Model):
         self.user_embeddings_reduce_dims = tf.keras.layers.Dense(
             self.dims,
             activation=tf.keras.activations.sigmoid,
+            dtype=dense_dtype,
             name="user_embeddings_reduce_dims",
         )
 
         ## Embedding layer
-        self.user_fusion_layer = FusionLayer(name="user_fusion_layer")
+        self.user_fusion_layer = FusionLayer(name="user_fusion_layer", dtype=dense_dtype)
 
         ## Node attention
         # consumed items
-        self.user_consumed_items_attention_layer_1 = tf.keras.layers.Dense(1, activation=tf.nn.sigmoid, name="user_consumed_items_attention_layer_1")
+        self.user_consumed_items_attention_layers = self.node_attention_layers("user_consumed_items_attention_layer_1")
+        self.user_consumed_items_aggregation = make_aggregation(aggregation, self.user_consumed_items["indices"], [self.num_users, self.num_items])
         # neighbor users
-        self.user_neighbors_attention_layer_1 = tf.keras.layers.Dense(1, activation=tf.nn.sigmoid, name="user_neighbors_attention_layer_1")
+        self.user_neighbors_attention_layers = self.node_attention_layers("user_neighbors_attention_layer_1")
+        self.user_neighbors_aggregation = make_aggregation(aggregation, self.user_links["indices"], [self.num_users, self.num_users])
 
         ## Graph attention
 
@@ -117,13 +134,15 @@ class DiffnetPlus(tf.keras.Model):
         self.item_embedding_reduce_dims = tf.keras.layers.Dense(
             self.dims,
             activation=tf.keras.activations.sigmoid,
+            dtype=dense_dtype,
             name="item_embedding_reduce_dims",
         )
         # Embedding layer
-        self.item_fusion_layer = FusionLayer(name="item_fusion_layer")
+        self.item_fusion_layer = FusionLayer(name="item_fusion_layer", dtype=dense_dtype)
 
         # Node attention
-        self.item_consumed_users_attention_layer_1 = tf.keras.layers.Dense(1, activation=tf.nn.sigmoid, name="item_consumed_users_attention_layer_1")
+        self.item_consumed_users_attention_layers = self.node_attention_layers("item_consumed_users_attention_layer_1")
+        self.item_consumed_users_aggregation = make_aggregation(aggregation, self.item_consumed_users["indices"], [self.num_items, self.num_users])
 
         # Graph attention
         self.item_consumed_users_graph_attention_layer_1 = tf.keras.layers.Dense(1, activation=tf.nn.tanh, name="item_consumed_users_graph_attention_layer_1")
@@ -136,148 +155,103 @@ class DiffnetPlus(tf.keras.Model):
         self.item_item_graph_attention_layer_1 = tf.keras.layers.Dense(1, activation=tf.nn.tanh, name="item_item_graph_attention_layer_1")
         self.item_item_graph_attention_layer_2 = tf.keras.layers.Dense(1, activation=tf.nn.leaky_relu, name="item_item_graph_attention_layer_2")
 
+    def review_layers(self):
+        return {
+            "user": (self.user_review_embeddings, self.user_embeddings_reduce_dims, self.user_fusion_layer),
+            "item": (self.item_review_embeddings, self.item_embedding_reduce_dims, self.item_fusion_layer),
+        }
+
+    def edge_sets(self):
+        return {
+            "user_consumed_items": (self.user_consumed_items, "user", "item"),
+            "user_neighbors": (self.user_links, "user", "user"),
+            "item_consumed_users": (self.item_consumed_users, "item", "user"),
+        }
+
     # @tf.function
 
     # @profile(stream=fp)
-    def call(self, inputs, training=False):
-        user_input, item_input = inputs
-        ## user embeddings
-
-        # normalize user review embeddings
-        user_review_embeddings_norm = normalize_with_moments(self.user_review_embeddings, axes=[0, 1])
-        user_review_embeddings_norm = self.user_embeddings_reduce_dims(user_review_embeddings_norm)
-        user_review_embeddings_norm = normalize_with_moments(user_review_embeddings_norm, axes=[0, 1])
-        # fusion layer
-        user_fusion_embeddings = self.user_fusion_layer(user_review_embeddings_norm)
-
-        ## item embeddings
-
-        # normalize item review embeddings
-        item_review_embeddings_norm = normalize_with_moments(self.item_review_embeddings, axes=[0, 1])
-        item_review_embeddings_norm = self.item_embedding_reduce_dims(item_review_embeddings_norm)
-        item_review_embeddings_norm = normalize_with_moments(item_review_embeddings_norm, axes=[0, 1])
-        # fusion layer
-        item_fusion_embeddings = self.item_fusion_layer(item_review_embeddings_norm)
+    def propagate(self, training=False, subgraph=None):
+        # fused review embeddings of the nodes propagated over
+        user_fusion_embeddings, item_fusion_embeddings = self.input_embeddings(subgraph)
 
         user_gcn_layer_embeddings_list = [user_fusion_embeddings]
         item_gcn_layer_embeddings_list = [item_fusion_embeddings]
 
+        ## node attention of every edge set
+        edge_attention = self.edge_attention(subgraph)
+
         current_gcn_layer = 0
         current_user_gcn_embeddings = user_fusion_embeddings
         current_item_gcn_embeddings = item_fusion_embeddings
         while current_gcn_layer < self.gcn_layers:
-            ## user consumed items node attention
-            # generate trained weights for each user consumed item
-            user_consumed_items_values = tf.reshape(self.user_consumed_items_sparse_values, [-1, 1])
-            user_consumed_items_values = self.user_consumed_items_attention_layer_1(user_consumed_items_values)
-            user_consumed_items_values = tf.reduce_sum(tf.math.exp(user_consumed_items_values), axis=1)
-
-            # convert to sparse tensor
-            user_consumed_items_sparse_matrix = tf.SparseTensor(
-                indices=self.user_consumed_items["indices"],
-                values=user_consumed_items_values,
-                dense_shape=[self.num_users, self.num_items],
-            )
-            # softmax values
-            user_consumed_items_attention_matrix = tf.sparse.softmax(user_consumed_items_sparse_matrix)
-
-            # matrix multiply user_consumed_items_attention_matrix with item_fusion_embeddings to get the updated updated user_embeddings based on consumed items
-            user_embeddings_from_consumed_items = tf.sparse.sparse_dense_matmul(user_consumed_items_attention_matrix, current_item_gcn_embeddings)
-
-            ## user social neighbors node attention
-            # generate trained weights fro each user neighbors
-            user_neighbors_values = tf.reshape(self.user_neighbors_sparse_values, [-1, 1])
-            user_neighbors_values = self.user_neighbors_attention_layer_1(user_neighbors_values)
-            user_neighbors_values = tf.reduce_sum(tf.math.exp(user_neighbors_values), axis=1)
-
-            # convert to sparse tensor
-            user_neighbors_sparse_matrix = tf.SparseTensor(
-                indices=self.user_links["indices"],
-                values=user_neighbors_values,
-                dense_shape=[self.num_users, self.num_users],
-            )
-            # softmax values
-            user_neighbors_sparse_attention_matrix = tf.sparse.softmax(user_neighbors_sparse_matrix)
-
-            # matrix multiply user_neighbors_sparse_attention_matrix with user_fusion_embeddings to get the updated user_embeddings based on user links/connections/neighbors
-            user_embeddings_from_user_links = tf.sparse.sparse_dense_matmul(user_neighbors_sparse_attention_matrix, current_user_gcn_embeddings)
-
-            user_consumed_items_graph_attention_embeddings = tf.concat([current_user_gcn_embeddings + user_embeddings_from_consumed_items], 1)
-            user_consumed_items_graph_attention_embeddings = self.user_consumed_items_graph_attention_layer_1(user_consumed_items_graph_attention_embeddings)
-            user_consumed_items_graph_attention_embeddings = self.user_consumed_items_graph_attention_layer_2(user_consumed_items_graph_attention_embeddings)
-            user_consumed_items_graph_attention_embeddings = tf.math.exp(user_consumed_items_graph_attention_embeddings) + 0.7  # TODO try removing bias factor
-
-            user_neighbors_graph_attention_embeddings = tf.concat([current_user_gcn_embeddings, user_embeddings_from_user_links], 1)
-            user_neighbors_graph_attention_embeddings = self.user_neighbors_graph_attention_layer_1(user_neighbors_graph_attention_embeddings)
-            user_neighbors_graph_attention_embeddings = self.user_neighbors_graph_attention_layer_2(user_neighbors_graph_attention_embeddings)
-            user_neighbors_graph_attention_embeddings = tf.math.exp(user_neighbors_graph_attention_embeddings) + 0.3  # TODO try removing bias factor
-
-            # compute weight/factor for consumed_items and neighbors
-            user_total_attention_embeddings = user_consumed_items_graph_attention_embeddings + user_neighbors_graph_attention_embeddings
-            user_consumed_items_attention_weight = user_consumed_items_graph_attention_embeddings / user_total_attention_embeddings
-            user_neighbors_attention_weight = user_neighbors_graph_attention_embeddings / user_total_attention_embeddings
-
-            # final user gcn embeddings
-            user_gcn_embedding = 0.5 * current_user_gcn_embeddings + 0.5 * (
-                user_consumed_items_attention_weight * user_embeddings_from_consumed_items + user_neighbors_attention_weight * user_embeddings_from_user_links
-            )
-
-            ## item node attention
-
-            # item item attention embeddings
-            item_item_graph_attention_embeddings = self.item_item_graph_attention_layer_1(current_item_gcn_embeddings)
-            item_item_graph_attention_embeddings = self.item_item_graph_attention_layer_2(item_item_graph_attention_embeddings) + 1.0  # TODO check on bias
-
-            # item consumed users embeddings
-            item_consumed_users_values = tf.reshape(self.item_consumed_users_sparse_values, [-1, 1])
-            item_consumed_users_values = self.item_consumed_users_attention_layer_1(item_consumed_users_values)
-            item_consumed_users_values = tf.reduce_sum(tf.math.exp(item_consumed_users_values), axis=1)
-
-            # convert to sparse tensor
-            item_consumed_users_sparse_matrix = tf.SparseTensor(
-                indices=self.item_consumed_users["indices"],
-                values=item_consumed_users_values,
-                dense_shape=[self.num_items, self.num_users],
-            )
-            # softmax values
-            item_consumed_users_sparse_attention_matrix = tf.sparse.softmax(item_consumed_users_sparse_matrix)
-
-            # multiply item_consumed_users_sparse_attention_matrix with user_fusion_embeddings to get the updated item_embeddings based on users
-            item_embeddings_from_consumed_users = tf.sparse.sparse_dense_matmul(item_consumed_users_sparse_attention_matrix, current_user_gcn_embeddings)
-
-            # compute attention embeddings for items based on users
-            item_consumed_users_graph_attention_embeddings = self.item_consumed_users_graph_attention_layer_1(item_embeddings_from_consumed_users)
-            item_consumed_users_graph_attention_embeddings = self.item_consumed_users_graph_attention_layer_2(item_consumed_users_graph_attention_embeddings)
-            item_consumed_users_graph_attention_embeddings = tf.math.exp(item_consumed_users_graph_attention_embeddings) + 1.0  # TODO check bias weight later
-
-            # compute weight/factor for consumed_users and items
-            item_total_attention_embeddings = item_item_graph_attention_embeddings + item_consumed_users_graph_attention_embeddings
-            item_consumed_users_attention_weight = item_consumed_users_graph_attention_embeddings / item_total_attention_embeddings
-            item_item_attention_weight = item_item_graph_attention_embeddings / item_total_attention_embeddings
-
-            item_gcn_embedding = item_item_attention_weight * current_item_gcn_embeddings + item_consumed_users_attention_weight * item_embeddings_from_consumed_users
-
-            # update gcn embeddings
-            user_gcn_layer_embeddings_list.append(user_gcn_embedding)
-            item_gcn_layer_embeddings_list.append(item_gcn_embedding)
-
-            current_user_gcn_embeddings = user_gcn_embedding
-            current_item_gcn_embeddings = item_gcn_embedding
+            with self.instrumentation.timer(f"gcn_layer_{current_gcn_layer + 1}"):
+                # previous layer embeddings of the nodes updated by this layer
+                current_user_self_embeddings = self.destination_embeddings(current_user_gcn_embeddings, "user", current_gcn_layer, subgraph)
+                current_item_self_embeddings = self.destination_embeddings(current_item_gcn_embeddings, "item", current_gcn_layer, subgraph)
+
+                ## user consumed items node attention
+                # matrix multiply user_consumed_items_attention_matrix with item_fusion_embeddings to get the updated updated user_embeddings based on consumed items
+                user_embeddings_from_consumed_items = self.aggregate("user_consumed_items", edge_attention, current_gcn_layer, current_item_gcn_embeddings, subgraph)
+
+                ## user social neighbors node attention
+                # matrix multiply user_neighbors_sparse_attention_matrix with user_fusion_embeddings to get the updated user_embeddings based on user links/connections/neighbors
+                user_embeddings_from_user_links = self.aggregate("user_neighbors", edge_attention, current_gcn_layer, current_user_gcn_embeddings, subgraph)
+
+                user_consumed_items_graph_attention_embeddings = tf.concat([current_user_self_embeddings + user_embeddings_from_consumed_items], 1)
+                user_consumed_items_graph_attention_embeddings = self.user_consumed_items_graph_attention_layer_1(user_consumed_items_graph_attention_embeddings)
+                user_consumed_items_graph_attention_embeddings = self.user_consumed_items_graph_attention_layer_2(user_consumed_items_graph_attention_embeddings)
+                user_consumed_items_graph_attention_embeddings = tf.math.exp(user_consumed_items_graph_attention_embeddings) + 0.7  # TODO try removing bias factor
+
+                user_neighbors_graph_attention_embeddings = tf.concat([current_user_self_embeddings, user_embeddings_from_user_links], 1)
+                user_neighbors_graph_attention_embeddings = self.user_neighbors_graph_attention_layer_1(user_neighbors_graph_attention_embeddings)
+                user_neighbors_graph_attention_embeddings = self.user_neighbors_graph_attention_layer_2(user_neighbors_graph_attention_embeddings)
+                user_neighbors_graph_attention_embeddings = tf.math.exp(user_neighbors_graph_attention_embeddings) + 0.3  # TODO try removing bias factor
+
+                # compute weight/factor for consumed_items and neighbors
+                user_total_attention_embeddings = user_consumed_items_graph_attention_embeddings + user_neighbors_graph_attention_embeddings
+                user_consumed_items_attention_weight = user_consumed_items_graph_attention_embeddings / user_total_attention_embeddings
+                user_neighbors_attention_weight = user_neighbors_graph_attention_embeddings / user_total_attention_embeddings
+
+                # final user gcn embeddings
+                user_gcn_embedding = 0.5 * current_user_self_embeddings + 0.5 * (
+                    user_consumed_items_attention_weight * user_embeddings_from_consumed_items + user_neighbors_attention_weight * user_embeddings_from_user_links
+                )
+
+                ## item node attention
+
+                # item item attention embeddings
+                item_item_graph_attention_embeddings = self.item_item_graph_attention_layer_1(current_item_self_embeddings)
+                item_item_graph_attention_embeddings = self.item_item_graph_attention_layer_2(item_item_graph_attention_embeddings) + 1.0  # TODO check on bias
+
+                # item consumed users embeddings
+                # multiply item_consumed_users_sparse_attention_matrix with user_fusion_embeddings to get the updated item_embeddings based on users
+                item_embeddings_from_consumed_users = self.aggregate("item_consumed_users", edge_attention, current_gcn_layer, current_user_gcn_embeddings, subgraph)
+
+                # compute attention embeddings for items based on users
+                item_consumed_users_graph_attention_embeddings = self.item_consumed_users_graph_attention_layer_1(item_embeddings_from_consumed_users)
+                item_consumed_users_graph_attention_embeddings = self.item_consumed_users_graph_attention_layer_2(item_consumed_users_graph_attention_embeddings)
+                item_consumed_users_graph_attention_embeddings = tf.math.exp(item_consumed_users_graph_attention_embeddings) + 1.0  # TODO check bias weight later
+
+                # compute weight/factor for consumed_users and items
+                item_total_attention_embeddings = item_item_graph_attention_embeddings + item_consumed_users_graph_attention_embeddings
+                item_consumed_users_attention_weight = item_consumed_users_graph_attention_embeddings / item_total_attention_embeddings
+                item_item_attention_weight = item_item_graph_attention_embeddings / item_total_attention_embeddings
+
+                item_gcn_embedding = item_item_attention_weight * current_item_self_embeddings + item_consumed_users_attention_weight * item_embeddings_from_consumed_users
+
+                # update gcn embeddings
+                user_gcn_layer_embeddings_list.append(user_gcn_embedding)
+                item_gcn_layer_embeddings_list.append(item_gcn_embedding)
+
+                current_user_gcn_embeddings = user_gcn_embedding
+                current_item_gcn_embeddings = item_gcn_embedding
             current_gcn_layer += 1
 
-        user_gcn_embeddings_final = tf.concat(user_gcn_layer_embeddings_list, 1)
-        item_gcn_embeddings_final = tf.concat(item_gcn_layer_embeddings_list, 1)
+        user_gcn_embeddings_final = self.output_embeddings(user_gcn_layer_embeddings_list, "user", subgraph)
+        item_gcn_embeddings_final = self.output_embeddings(item_gcn_layer_embeddings_list, "item", subgraph)
 
-        user_input_latent_embeddings = tf.gather_nd(user_gcn_embeddings_final, user_input)
-        item_input_latent_embeddings = tf.gather_nd(item_gcn_embeddings_final, item_input)
-
-        # prediction
-        predict_vector = tf.multiply(
-            user_input_latent_embeddings,
-            item_input_latent_embeddings,
-            name="prediction_vector",
-        )
-        return tf.math.sigmoid(tf.math.reduce_sum(predict_vector, 1, keepdims=True), name="prediction")
+        return user_gcn_embeddings_final, item_gcn_embeddings_final
 
     def train_step(self, data):
         x, y = data
@@ -0,0 +1,119 @@
+import argparse
+import json
+import logging
+import logging.config
+import os
+import signal
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from serving.recommender import Recommender
+
+log = logging.getLogger(__name__)
+
+MAX_USERS_PER_REQUEST = 10000
+# the scores of a request are (#users, n + #consumed) matrices
+MAX_N = 1000
+
+
+class RecommendationHandler(BaseHTTPRequestHandler):
+    """POST /recommend {"user_ids": [...], "n": 10, "filter_consumed": true} and GET /health"""
+
+    recommender = None
+
+    def __send_json__(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.__send_json__(200, {"status": "ok", "model": self.recommender.manifest["model"]})
+        else:
+            self.__send_json__(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/recommend":
+            self.__send_json__(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            user_ids = request["user_ids"]
+            n = request.get("n", 10)
+            filter_consumed = request.get("filter_consumed", True)
+        except (ValueError, KeyError, TypeError) as e:
+            self.__send_json__(400, {"error": f"invalid request: {e}"})
+            return
+        if not isinstance(user_ids, list) or len(user_ids) > MAX_USERS_PER_REQUEST:
+            self.__send_json__(400, {"error": f"user_ids must be a list of at most {MAX_USERS_PER_REQUEST} ids"})
+            return
+        if not isinstance(n, int) or isinstance(n, bool) or not 0 < n <= MAX_N:
+            self.__send_json__(400, {"error": f"n must be an integer from 1 to {MAX_N}"})
+            return
+        # a JSON boolean, bool("false") is True
+        if not isinstance(filter_consumed, bool):
+            self.__send_json__(400, {"error": "filter_consumed must be true or false"})
+            return
+        # raw ids are matched by their string form, lists and objects are no ids
+        if not all(isinstance(user_id, (str, int)) and not isinstance(user_id, bool) for user_id in user_ids):
+            self.__send_json__(400, {"error": "user_ids must be strings or integers"})
+            return
+
+        self.__send_json__(200, {"recommendations": self.recommender.recommend(user_ids, n=n, filter_consumed=filter_consumed)})
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class RecommendationServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections under concurrent load, each retry costing a second
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve(export_dir, host="127.0.0.1", port=8080, workers=1, ann_index=None, num_probes=None):
+    RecommendationHandler.recommender = Recommender(export_dir, ann_index=ann_index, num_probes=num_probes)
+    server = RecommendationServer((host, port), RecommendationHandler)
+    log.info(f"Serving recommendations from {export_dir} on {host}:{port} with {workers} worker(s)")
+
+    # turn SIGTERM into SystemExit so that the parent stops its workers on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # pre-fork workers accepting on the shared socket, the memory-mapped tables are shared between them
+    children = []
+    for _ in range(workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            children = []
+            break
+        children.append(pid)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve top-N recommendations from exported embeddings")
+    parser.add_argument("--export_dir", type=str, required=True, help="directory written by main.py --export_dir")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to bind")
+    parser.add_argument("--port", type=int, default=8080, metavar="N", help="port to bind")
+    parser.add_argument("--workers", type=int, default=1, metavar="N", help="number of worker processes")
+    parser.add_argument("--ann_index", type=str, default=None, help="approximate index written by build_ann_index.py, exact scan if not set")
+    parser.add_argument("--num_probes", type=int, default=None, metavar="N", help="inverted lists scanned per query, overrides the index setting")
+    args = parser.parse_args()
+
+    serve(args.export_dir, host=args.host, port=args.port, workers=args.workers, ann_index=args.ann_index, num_probes=args.num_probes)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s")
+    main()
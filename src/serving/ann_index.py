@@ -0,0 +1,175 @@
+import json
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def kmeans(data, num_clusters, iterations=20, seed=None, chunk_size=65536):
+    """Lloyd's k-means with randomly chosen initial centroids, empty clusters are reseeded with random points"""
+    rng = np.random.default_rng(seed)
+    num_clusters = min(num_clusters, len(data))
+    centroids = data[rng.choice(len(data), num_clusters, replace=False)].astype(np.float32)
+    assignments = np.zeros(len(data), dtype=np.int64)
+    for _ in range(iterations):
+        assignments = assign(data, centroids, chunk_size)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        empty = counts == 0
+        # cluster sums with one reduceat over the points sorted by cluster
+        order = np.argsort(assignments, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(data[order], starts, axis=0) / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), int(empty.sum()), replace=False)]
+    return centroids, assignments
+
+
+def assign(data, centroids, chunk_size=65536):
+    """Index of the nearest (l2) centroid of every row"""
+    centroid_norms = np.sum(centroids * centroids, axis=1)
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[start : start + chunk_size], dtype=np.float32)
+        assignments[start : start + chunk_size] = np.argmin(centroid_norms - 2.0 * chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def top_k(scores, k):
+    """Indices and values of the k largest scores of every row, best first"""
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+class IVFIndex:
+    """Inverted file index for maximum inner product search over item embeddings.
+
+    Items are augmented with sqrt(max_norm^2 - |x|^2) so that the inner product order of a query equals the l2
+    order in the augmented space, then clustered with k-means into num_lists inverted lists. A query scans the
+    num_probes closest lists. With pq_subspaces > 0 the candidates are scored from product quantization codes of
+    their residual to the list centroid and only the best rerank * k are scored exactly, otherwise all
+    candidates are scored exactly.
+    """
+
+    def __init__(self, num_lists=256, num_probes=8, pq_subspaces=0, pq_centroids=256, rerank=4, seed=None):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.pq_subspaces = pq_subspaces
+        self.pq_centroids = pq_centroids
+        self.rerank = rerank
+        self.seed = seed
+        self.item_embeddings = None
+
+    def __augment__(self, vectors):
+        norms = np.sum(vectors * vectors, axis=1)
+        return np.concatenate([vectors, np.sqrt(np.maximum(self.max_norm**2 - norms, 0.0))[:, None]], axis=1).astype(np.float32)
+
+    def build(self, item_embeddings, iterations=20, train_size=None):
+        """Cluster the items, k-means is trained on train_size random items (default 64 per list)"""
+        self.item_embeddings = item_embeddings
+        items = np.asarray(item_embeddings, dtype=np.float32)
+        self.max_norm = float(np.sqrt(np.max(np.sum(items * items, axis=1))))
+        augmented = self.__augment__(items)
+
+        rng = np.random.default_rng(self.seed)
+        train_size = train_size or 64 * self.num_lists
+        train = augmented[rng.choice(len(augmented), min(train_size, len(augmented)), replace=False)]
+        self.centroids, _ = kmeans(train, self.num_lists, iterations=iterations, seed=self.seed)
+        assignments = assign(augmented, self.centroids)
+
+        # inverted lists as CSR
+        self.list_items = np.argsort(assignments, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))]).astype(np.int64)
+
+        self.codebooks = None
+        self.codes = None
+        if self.pq_subspaces > 0:
+            residuals = items - self.centroids[assignments, :-1]
+            self.__train_product_quantizer__(residuals, train_size, iterations, rng)
+        log.info(f"Built IVF index with {len(self.centroids)} lists over {len(items)} items")
+        return self
+
+    def __train_product_quantizer__(self, residuals, train_size, iterations, rng):
+        dims = residuals.shape[1]
+        if dims % self.pq_subspaces != 0:
+            raise ValueError(f"pq_subspaces={self.pq_subspaces} must divide the embedding size {dims}")
+        sub_dims = dims // self.pq_subspaces
+        train = residuals[rng.choice(len(residuals), min(max(train_size, 64 * self.pq_centroids), len(residuals)), replace=False)]
+
+        self.codebooks = np.zeros((self.pq_subspaces, min(self.pq_centroids, len(train)), sub_dims), dtype=np.float32)
+        self.codes = np.zeros((len(residuals), self.pq_subspaces), dtype=np.uint8 if self.pq_centroids <= 256 else np.uint16)
+        for subspace in range(self.pq_subspaces):
+            columns = slice(subspace * sub_dims, (subspace + 1) * sub_dims)
+            self.codebooks[subspace], _ = kmeans(np.ascontiguousarray(train[:, columns]), self.pq_centroids, iterations=iterations, seed=self.seed)
+            self.codes[:, subspace] = assign(np.ascontiguousarray(residuals[:, columns]), self.codebooks[subspace])
+
+    def search(self, queries, k):
+        """Approximate top k items by inner product for every query, (items, scores) of shape (queries, k) best first.
+
+        Rows with fewer than k candidates are padded with item -1 and score -inf.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        num_probes = min(self.num_probes, len(self.centroids))
+        # l2 distance to the augmented centroids up to a per query constant, the query's extra coordinate is 0
+        centroid_scores = 2.0 * queries @ self.centroids[:, :-1].T - np.sum(self.centroids * self.centroids, axis=1)
+        probes, _ = top_k(centroid_scores, num_probes)
+        list_sizes = np.diff(self.list_offsets)
+
+        if self.codebooks is not None:
+            # per query lookup tables of the inner products with every sub codeword
+            sub_dims = self.codebooks.shape[2]
+            lookup_tables = np.einsum("qsd,scd->qsc", queries.reshape(len(queries), self.pq_subspaces, sub_dims), self.codebooks)
+
+        top_items = np.full((len(queries), k), -1, dtype=np.int64)
+        top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, query in enumerate(queries):
+            candidates = np.concatenate([self.list_items[self.list_offsets[p] : self.list_offsets[p + 1]] for p in probes[row]])
+            if len(candidates) == 0:
+                continue
+            if self.codebooks is not None and len(candidates) > self.rerank * k:
+                # q . x = q . centroid + q . residual
+                centroid_dots = np.repeat(queries[row] @ self.centroids[probes[row], :-1].T, list_sizes[probes[row]])
+                approximate_scores = centroid_dots + lookup_tables[row][np.arange(self.pq_subspaces), self.codes[candidates]].sum(axis=1)
+                shortlist, _ = top_k(approximate_scores[None, :], self.rerank * k)
+                candidates = candidates[shortlist[0]]
+            # sorted ids read the (possibly memory-mapped) table sequentially
+            candidates = np.sort(candidates)
+            scores = np.asarray(self.item_embeddings[candidates], dtype=np.float32) @ query
+            best, best_scores = top_k(scores[None, :], k)
+            top_items[row, : best.shape[1]] = candidates[best[0]]
+            top_scores[row, : best.shape[1]] = best_scores[0]
+        return top_items, top_scores
+
+    def save(self, path):
+        config = {
+            "num_lists": self.num_lists,
+            "num_probes": self.num_probes,
+            "pq_subspaces": self.pq_subspaces,
+            "pq_centroids": self.pq_centroids,
+            "rerank": self.rerank,
+            "seed": self.seed,
+            "max_norm": self.max_norm,
+        }
+        arrays = {"centroids": self.centroids, "list_items": self.list_items, "list_offsets": self.list_offsets}
+        if self.codebooks is not None:
+            arrays.update(codebooks=self.codebooks, codes=self.codes)
+        np.savez(path, config=np.array(json.dumps(config)), **arrays)
+
+    @classmethod
+    def load(cls, path, item_embeddings):
+        """Load an index saved with save(), item_embeddings are the (possibly memory-mapped) table it was built on"""
+        with np.load(path) as data:
+            config = json.loads(str(data["config"]))
+            max_norm = config.pop("max_norm")
+            index = cls(**config)
+            index.max_norm = max_norm
+            index.centroids = data["centroids"]
+            index.list_items = data["list_items"]
+            index.list_offsets = data["list_offsets"]
+            index.codebooks = data["codebooks"] if "codebooks" in data else None
+            index.codes = data["codes"] if "codes" in data else None
+        index.item_embeddings = item_embeddings
+        return index
@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from data.dataset_type import DatasetType
+
+log = logging.getLogger(__name__)
+
+EXPORT_VERSION = 1
+USER_EMBEDDINGS_FILE = "user_embeddings.npy"
+ITEM_EMBEDDINGS_FILE = "item_embeddings.npy"
+CONSUMED_OFFSETS_FILE = "consumed_offsets.npy"
+CONSUMED_ITEMS_FILE = "consumed_items.npy"
+MANIFEST_FILE = "manifest.json"
+
+
+def consumed_items_csr(data_module):
+    """Deduplicated positive items of every user over all splits, as (offsets, items) sorted by user then item"""
+    num_users = len(data_module.user_map)
+    num_items = len(data_module.item_map)
+    keys = []
+    for data in [data_module.train_data, data_module.validation_data, data_module.test_data]:
+        ratings = data["ratings"]
+        offsets = np.asarray(ratings["offsets"][: num_users + 1], dtype=np.int64)
+        users = np.repeat(np.arange(num_users, dtype=np.int64), np.diff(offsets))
+        positive = np.asarray(ratings["values"][: offsets[-1]]) > 0
+        keys.append(users[positive] * num_items + np.asarray(ratings["items"][: offsets[-1]], dtype=np.int64)[positive])
+
+    keys = np.unique(np.concatenate(keys))
+    counts = np.bincount(keys // num_items, minlength=num_users)
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64), (keys % num_items).astype(np.int32)
+
+
+def export_embeddings(model, data_module, export_dir, model_name=None):
+    """Write the final gcn embedding tables, the id maps and the consumed items of a trained model to export_dir"""
+    os.makedirs(export_dir, exist_ok=True)
+    user_gcn_embeddings, item_gcn_embeddings = model.get_gcn_embeddings()
+    np.save(os.path.join(export_dir, USER_EMBEDDINGS_FILE), np.asarray(user_gcn_embeddings, dtype=np.float32))
+    np.save(os.path.join(export_dir, ITEM_EMBEDDINGS_FILE), np.asarray(item_gcn_embeddings, dtype=np.float32))
+
+    consumed_offsets, consumed_items = consumed_items_csr(data_module)
+    np.save(os.path.join(export_dir, CONSUMED_OFFSETS_FILE), consumed_offsets)
+    np.save(os.path.join(export_dir, CONSUMED_ITEMS_FILE), consumed_items)
+
+    for name, mapping in [("user", data_module.user_map), ("item", data_module.item_map)]:
+        with open(os.path.join(export_dir, f"{name}_map.json"), "w") as f:
+            json.dump(mapping, f)
+
+    manifest = {
+        "version": EXPORT_VERSION,
+        "model": model_name or type(model).__name__,
+        "num_users": int(user_gcn_embeddings.shape[0]),
+        "num_items": int(item_gcn_embeddings.shape[0]),
+        "dims": int(user_gcn_embeddings.shape[1]),
+        "data_dir": data_module.data_dir,
+        "splits": [dataset_type.value for dataset_type in DatasetType],
+        "created": time.time(),
+    }
+    with open(os.path.join(export_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f)
+    log.info(f"Exported embeddings to {export_dir}")
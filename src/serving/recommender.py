@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from serving.export import (
+    CONSUMED_ITEMS_FILE,
+    CONSUMED_OFFSETS_FILE,
+    EXPORT_VERSION,
+    ITEM_EMBEDDINGS_FILE,
+    MANIFEST_FILE,
+    USER_EMBEDDINGS_FILE,
+)
+from serving.ann_index import IVFIndex, top_k
+from util.graph_builder import csr_rows
+
+log = logging.getLogger(__name__)
+
+
+class Recommender:
+    """Top-N recommendations from exported embedding tables.
+
+    The tables are opened memory-mapped, worker processes serving the same export share one copy through the
+    page cache. Maps are expected as {raw id: index}, as written by the DataModule preprocessing. With ann_index
+    (a file written by IVFIndex.save) candidates come from the approximate index instead of a full scan.
+    """
+
+    def __init__(self, export_dir, ann_index=None, num_probes=None):
+        with open(os.path.join(export_dir, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest["version"] != EXPORT_VERSION:
+            raise ValueError(f"Unsupported export version {self.manifest['version']} in {export_dir}")
+
+        self.user_embeddings = np.load(os.path.join(export_dir, USER_EMBEDDINGS_FILE), mmap_mode="r")
+        self.item_embeddings = np.load(os.path.join(export_dir, ITEM_EMBEDDINGS_FILE), mmap_mode="r")
+        self.consumed_offsets = np.load(os.path.join(export_dir, CONSUMED_OFFSETS_FILE), mmap_mode="r")
+        self.consumed_items = np.load(os.path.join(export_dir, CONSUMED_ITEMS_FILE), mmap_mode="r")
+
+        with open(os.path.join(export_dir, "user_map.json")) as f:
+            self.user_map = json.load(f)
+        with open(os.path.join(export_dir, "item_map.json")) as f:
+            item_map = json.load(f)
+        self.item_ids = np.empty(len(self.item_embeddings), dtype=object)
+        for raw_id, index in item_map.items():
+            self.item_ids[index] = raw_id
+
+        self.item_index = None
+        if ann_index is not None:
+            self.item_index = IVFIndex.load(ann_index, self.item_embeddings)
+            if num_probes is not None:
+                self.item_index.num_probes = num_probes
+
+    def __score__(self, users, n, filter_consumed):
+        """Top n (items, scores) rows for user indices, best first"""
+        user_embeddings = np.asarray(self.user_embeddings[users])
+        num_consumed = 0
+        if filter_consumed:
+            num_consumed = int(np.max(self.consumed_offsets[users + 1] - self.consumed_offsets[users], initial=0))
+
+        if self.item_index is not None:
+            return self.__search__(users, user_embeddings, n, num_consumed)
+
+        scores = user_embeddings @ np.asarray(self.item_embeddings).T
+        if filter_consumed and num_consumed:
+            rows, items = csr_rows(self.consumed_offsets, self.consumed_items, users)
+            scores[rows, items] = -np.inf
+        return top_k(scores, n)
+
+    def __search__(self, users, user_embeddings, n, num_consumed):
+        """Top n from the approximate index, asking for n + the most consumed items of the batch so that n are left after filtering"""
+        candidates, scores = self.item_index.search(user_embeddings, n + num_consumed)
+        if num_consumed:
+            rows, items = csr_rows(self.consumed_offsets, self.consumed_items, users)
+            num_items = len(self.item_embeddings)
+            consumed = np.isin(np.arange(len(users))[:, None] * num_items + candidates, rows * num_items + items)
+            scores = np.where(consumed, -np.inf, scores)
+        top, top_scores = top_k(scores, n)
+        return np.take_along_axis(candidates, top, axis=1), top_scores
+
+    def recommend(self, user_ids, n=10, filter_consumed=True):
+        """Top n items for every raw user id, [{"user_id", "items", "scores"}] with an "error" for unknown users"""
+        known = [user_id for user_id in user_ids if str(user_id) in self.user_map]
+        results = {}
+        if known:
+            users = np.array([self.user_map[str(user_id)] for user_id in known], dtype=np.int64)
+            top_items, top_scores = self.__score__(users, n, filter_consumed)
+            for user_id, items, scores in zip(known, top_items, top_scores):
+                valid = np.isfinite(scores)
+                results[user_id] = {
+                    "user_id": user_id,
+                    "items": self.item_ids[items[valid]].tolist(),
+                    # sigmoid of the dot product, the prediction of the model
+                    "scores": (1.0 / (1.0 + np.exp(-scores[valid]))).tolist(),
+                }
+        return [results.get(user_id, {"user_id": user_id, "error": "unknown user"}) for user_id in user_ids]
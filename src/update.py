@@ -0,0 +1,108 @@
+"""Apply new ratings and links to a trained model without retraining from scratch, arguments not listed here go to
+main.py and must describe the trained model (--model_name, --dims, --gcn_layers, ...).
+
+    python src/update.py --new_ratings=new.ratings --new_user_links=new.links --checkpoint_dir=./checkpoints --export_dir=./export
+
+The model is restored from the latest checkpoint of --checkpoint_dir. The new edges are added to the graphs, then
+either the embeddings of the affected nodes are recomputed, or with --fine_tune_epochs the model is first trained
+briefly on the rows of the users with new edges and all embeddings are recomputed.
+"""
+import argparse
+import logging
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from data.key_type import KeyType
+from main import build_model, load_data_module, make_train_step, parse_args, setup_logging, train_epoch
+from serving.export import export_embeddings
+from util.checkpointing import TrainingCheckpoints
+from util.graph_builder import read_edge_list
+from util.incremental_update import IncrementalUpdater
+from util.input_pipeline import make_train_dataset
+
+log = logging.getLogger(__name__)
+
+
+def fine_tune(model, data_module, users, optimizer, epochs, batch_size, seed=None):
+    """Train epochs over the training rows (ratings and negatives) of the given users only"""
+    input_users, input_items, label_ratings, _ = data_module.train_arrays()
+    rows = np.isin(input_users, users)
+    input_users, input_items, label_ratings = input_users[rows], input_items[rows], label_ratings[rows]
+    if len(input_users) == 0:
+        return
+
+    # rows are grouped by user, batches of batch_size users
+    user_starts = np.flatnonzero(np.diff(input_users, prepend=-1))
+    batch_offsets = np.append(user_starts[::batch_size], len(input_users))
+    epoch_loss_avg = tf.keras.metrics.Mean()
+    train_step = make_train_step(model, optimizer, epoch_loss_avg)
+    for epoch in range(1, epochs + 1):
+        epoch_loss_avg.reset_state()
+        start_time = time.time()
+        epoch_seed = None if seed is None else seed + epoch
+        steps = train_epoch(epoch, train_step, make_train_dataset(input_users, input_items, label_ratings, batch_offsets, shuffle=True, seed=epoch_seed))
+        log.info(f"Fine-tune epoch {epoch}: {steps} steps in {time.time() - start_time:.2f}s Loss: {epoch_loss_avg.result()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add new ratings and links to a trained model and refresh its embeddings")
+    parser.add_argument("--new_ratings", type=str, default=None, help="file of user,item,rating lines to add to the training ratings")
+    parser.add_argument("--new_user_links", type=str, default=None, help="file of user,user,reverse_connection lines")
+    parser.add_argument("--new_item_links", type=str, default=None, help="file of item,item,reverse_connection lines")
+    parser.add_argument("--fine_tune_epochs", type=int, default=0, metavar="N", help="epochs over the rows of the users with new edges, 0 only refreshes the affected embeddings")
+    parser.add_argument("--fine_tune_lr", type=float, default=0.0001, metavar="LR", help="learning rate of the fine-tuning")
+    parser.add_argument("--refresh_batch_nodes", type=int, default=4096, metavar="N", help="nodes propagated at a time by the refresh")
+    parser.add_argument(
+        "--persist", action="store_true", help="append the new edges to the files of --data_dir and checkpoint the updated model, a later run loads both consistently"
+    )
+    update_args, run_arguments = parser.parse_known_args()
+    args = parse_args(run_arguments)
+    if not args.checkpoint_dir:
+        log.error("An update needs the --checkpoint_dir of the trained model")
+        sys.exit(1)
+
+    data_module = load_data_module(args)
+    model = build_model(args, data_module)
+    # a fresh optimizer, the edge values it trains are replaced by grown variables
+    optimizer = tf.keras.optimizers.Adam(learning_rate=update_args.fine_tune_lr)
+    checkpoints = TrainingCheckpoints(args.checkpoint_dir, model, optimizer, keep_best=args.keep_best)
+    restored = checkpoints.restore_latest()
+    if restored is None:
+        log.error(f"No checkpoint found in {args.checkpoint_dir}")
+        sys.exit(1)
+    epoch, training_state, _ = restored
+    # a restored learning rate would override the fine-tuning one
+    optimizer.learning_rate = update_args.fine_tune_lr
+
+    if update_args.fine_tune_epochs == 0:
+        start_time = time.time()
+        model.get_gcn_embeddings()
+        log.info(f"Propagated the embeddings of the restored model in {time.time() - start_time:.2f}s")
+
+    updater = IncrementalUpdater(data_module, model, persist=update_args.persist)
+    if update_args.new_ratings:
+        ratings = read_edge_list(update_args.new_ratings, num_columns=3)
+        updater.add_ratings(ratings[:, 0], ratings[:, 1], ratings[:, 2])
+    for key_type, path in [(KeyType.USER, update_args.new_user_links), (KeyType.ITEM, update_args.new_item_links)]:
+        if path:
+            links = read_edge_list(path, num_columns=3)
+            updater.add_links(links[:, 0], links[:, 1], links[:, 2], key_type=key_type)
+
+    if update_args.fine_tune_epochs > 0:
+        fine_tune(model, data_module, updater.updated_users(), optimizer, update_args.fine_tune_epochs, args.batch_size, seed=args.seed)
+    # after fine-tuning every embedding changed and the refresh propagates in full
+    updater.refresh(nodes_per_batch=update_args.refresh_batch_nodes)
+
+    if update_args.persist:
+        checkpoints.save(epoch, {}, training_state, data_module.train_data["negatives"])
+        checkpoints.sync()
+    if args.export_dir:
+        export_embeddings(model, data_module, args.export_dir)
+
+
+if __name__ == "__main__":
+    setup_logging()
+    main()
@@ -0,0 +1,10 @@
+import numpy as np
+
+
+def bucket_boundaries(lengths, num_buckets):
+    """Padded sizes of at most num_buckets buckets covering all lengths, taken at evenly spaced quantiles"""
+    if num_buckets <= 0 or len(lengths) == 0:
+        return None
+    quantiles = np.linspace(0.0, 1.0, num_buckets + 1)[1:]
+    return np.unique(np.ceil(np.quantile(np.asarray(lengths), quantiles)).astype(np.int64))
+
@@ -0,0 +1,117 @@
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+import tensorflow as tf
+
+log = logging.getLogger(__name__)
+
+LATEST_DIR = "latest"
+BEST_DIR = "best"
+BEST_INDEX_FILE = "best.json"
+
+
+def async_checkpoint_options():
+    """CheckpointOptions writing in a background thread, synchronous where this TF version has no async support"""
+    for option in ["enable_async", "experimental_enable_async_checkpoint"]:
+        try:
+            return tf.train.CheckpointOptions(**{option: True})
+        except TypeError:
+            continue
+    log.warning("Async checkpoints are not supported by this TensorFlow version, checkpoints are written synchronously")
+    return tf.train.CheckpointOptions()
+
+
+class TrainingCheckpoints:
+    """Checkpoints of the model, the optimizer and the training state of every epoch in checkpoint_dir.
+
+    latest/ is managed by a CheckpointManager and holds the last epoch for resuming. best/ holds the keep_best
+    epochs with the best metric (the lowest with minimize, the highest otherwise), indexed in best.json. The training state that lives outside of TF (sampler
+    RNG states, the epoch history) is stored as a JSON string variable and the current training negatives as
+    an int64 variable, so that async writes snapshot them together with the weights.
+    """
+
+    def __init__(self, checkpoint_dir, model, optimizer, keep_best=3, metric="val_loss", minimize=True, async_writes=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.model = model
+        self.keep_best = keep_best
+        self.metric = metric
+        self.minimize = minimize
+        self.options = async_checkpoint_options() if async_writes else tf.train.CheckpointOptions()
+
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False, name="epoch")
+        self.state = tf.Variable("{}", dtype=tf.string, trainable=False, name="training_state")
+        self.negatives = tf.Variable(np.zeros((0, 0), dtype=np.int64), shape=tf.TensorShape(None), trainable=False, name="train_negatives")
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, epoch=self.epoch, state=self.state, negatives=self.negatives)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, os.path.join(checkpoint_dir, LATEST_DIR), max_to_keep=1)
+
+        self.best_index_path = os.path.join(checkpoint_dir, BEST_INDEX_FILE)
+        self.best = []
+        if os.path.isfile(self.best_index_path):
+            with open(self.best_index_path) as f:
+                self.best = json.load(f)
+        # an earlier run may have ranked its best epochs by another metric
+        if any(self.metric not in entry for entry in self.best):
+            log.warning(f"Best checkpoints in {self.best_index_path} are not ranked by {self.metric}, they are no longer tracked")
+            self.best = []
+
+    def __rank_value__(self, value):
+        # larger is better
+        return -value if self.minimize else value
+
+    def save(self, epoch, metrics, state, negatives):
+        """Checkpoint the end of epoch, also as one of the best epochs when metrics[metric] ranks in the top keep_best"""
+        self.epoch.assign(epoch)
+        self.state.assign(json.dumps(state))
+        self.negatives.assign(np.asarray(negatives, dtype=np.int64))
+        path = self.manager.save(checkpoint_number=epoch, options=self.options)
+        log.info(f"Saved checkpoint for epoch {epoch}: {path}")
+
+        value = metrics.get(self.metric)
+        if self.keep_best <= 0 or value is None:
+            return
+        # a resumed run may checkpoint an epoch again
+        entries = [entry for entry in self.best if entry["epoch"] != epoch]
+        if len(entries) >= self.keep_best and self.__rank_value__(value) <= min(self.__rank_value__(entry[self.metric]) for entry in entries):
+            return
+        prefix = os.path.join(self.checkpoint_dir, BEST_DIR, f"ckpt-{epoch}")
+        self.checkpoint.write(prefix, options=self.options)
+        entries.append({"epoch": epoch, self.metric: float(value), "path": prefix})
+        entries.sort(key=lambda entry: self.__rank_value__(entry[self.metric]), reverse=True)
+        for evicted in entries[self.keep_best :]:
+            for filename in glob.glob(f"{evicted['path']}.*"):
+                os.remove(filename)
+        self.best = entries[: self.keep_best]
+        with open(self.best_index_path, "w") as f:
+            json.dump(self.best, f)
+        log.info(f"Epoch {epoch} is among the {self.keep_best} best by {self.metric}: {value}")
+
+    def __restore__(self, path):
+        # model and optimizer variables created later (e.g. optimizer slots) are restored when they are created
+        self.checkpoint.restore(path)
+        self.model.invalidate_gcn_embeddings()
+        return int(self.epoch.numpy()), json.loads(self.state.numpy().decode("utf-8")), self.negatives.numpy()
+
+    def restore_latest(self):
+        """(epoch, state, negatives) of the latest checkpoint, None if there is none"""
+        if self.manager.latest_checkpoint is None:
+            return None
+        log.info(f"Restoring checkpoint: {self.manager.latest_checkpoint}")
+        return self.__restore__(self.manager.latest_checkpoint)
+
+    def restore_best(self):
+        """Restore the weights of the best epoch, returns its index entry or None if there is none"""
+        self.sync()
+        if not self.best:
+            return None
+        log.info(f"Restoring best checkpoint of epoch {self.best[0]['epoch']}: {self.best[0]['path']}")
+        self.__restore__(self.best[0]["path"])
+        return self.best[0]
+
+    def sync(self):
+        """Wait for pending async writes"""
+        # older TF versions write synchronously and have no sync()
+        if hasattr(self.checkpoint, "sync"):
+            self.checkpoint.sync()
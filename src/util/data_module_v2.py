@@ -1,44 +1,98 @@
-import bisect
 import json
 import logging
 import math
-from collections import defaultdict
 from operator import index
 
 import numpy as np
 
 from data.dataset_type import DatasetType
 from data.key_type import KeyType
+from util.dataset_cache import DatasetCache
+from util.graph_builder import build_adjacency, build_csr, compact_labels, extend_adjacency, format_edge_list, index_dtype, read_edge_list, symmetrize_edges
+from util.negative_sampler import NegativeSampler
+from util.tf_helper import normalize_with_moments_numpy
 
 log = logging.getLogger(__name__)
 
 
 class DataModule:
-    def __init__(self, data_dir, num_negatives=8, num_evaluate=1000, batch_size=32):
+    def __init__(self, data_dir, num_negatives=8, num_evaluate=1000, batch_size=32, use_cache=True, negative_sampler="uniform", seed=None):
         self.data_dir = data_dir
         self.batch_size = batch_size
         self.num_negatives = num_negatives
         self.num_evaluate = num_evaluate
+        self.use_cache = use_cache
+        self.negative_sampler = negative_sampler
+        self.seed_sequence = np.random.SeedSequence(seed)
 
     def load(self):
-        # load user and item embeddings
-        self.user_embeddings = self.__load_numpy_file__(KeyType.USER)
-        self.item_embeddings = self.__load_numpy_file__(KeyType.ITEM)
+        # compiled arrays either come memory-mapped from the binary cache or are parsed from the source files
+        cache = DatasetCache(self.data_dir, self.__source_files__())
+        if self.use_cache and cache.is_valid():
+            log.info(f"Loading compiled dataset from cache: {cache.cache_dir}")
+            arrays, maps = cache.load()
+        else:
+            arrays, maps = self.__compile__()
+            if self.use_cache:
+                cache.save(arrays, maps)
+                # drop the compiled arrays for their memory-mapped copies
+                arrays, maps = cache.load()
+
+        # review embeddings with the first normalization stage of the models already applied
+        self.user_embeddings = arrays[f"{KeyType.USER.value}.embeddings.normalized"]
+        self.item_embeddings = arrays[f"{KeyType.ITEM.value}.embeddings.normalized"]
 
         # load user and item mappings
-        self.user_map = self.__load_mapper_json__(KeyType.USER)
-        self.item_map = self.__load_mapper_json__(KeyType.ITEM)
+        self.user_map = maps[KeyType.USER.value]
+        self.item_map = maps[KeyType.ITEM.value]
 
-        self.user_links = self.__load_key_type_links__(KeyType.USER)
-        self.item_links = self.__load_key_type_links__(KeyType.ITEM)
+        self.user_links = self.__graph_from_arrays__(arrays, f"{KeyType.USER.value}.links")
+        self.item_links = self.__graph_from_arrays__(arrays, f"{KeyType.ITEM.value}.links")
 
         # load data and their respective links
-        self.train_data = self.__load_ratings__(DatasetType.Train)
-        self.validation_data = self.__load_ratings__(DatasetType.Validation)
-        self.test_data = self.__load_ratings__(DatasetType.Test)
+        self.train_data = self.__load_ratings__(DatasetType.Train, arrays)
+        self.validation_data = self.__load_ratings__(DatasetType.Validation, arrays)
+        self.test_data = self.__load_ratings__(DatasetType.Test, arrays)
+
+    def build_cache(self):
+        """Compile the data directory into the dataset cache unless it is up to date, e.g. once before parallel runs"""
+        cache = DatasetCache(self.data_dir, self.__source_files__())
+        if not cache.is_valid():
+            cache.save(*self.__compile__())
+        return cache
+
+    def __source_files__(self):
+        files = [f"{key_type.value}_map.json" for key_type in KeyType]
+        files += [f"{key_type.value}.embeddings.npy" for key_type in KeyType]
+        files += [f"{key_type.value}.links" for key_type in KeyType]
+        files += [f"{dataset_type.value}.ratings" for dataset_type in DatasetType]
+        return files
+
+    def __compile__(self):
+        """Parse the source files into flat arrays, the layout stored by the dataset cache"""
+        maps = {key_type.value: self.__load_mapper_json__(key_type) for key_type in KeyType}
+        num_users = len(maps[KeyType.USER.value])
+        num_items = len(maps[KeyType.ITEM.value])
+
+        arrays = {}
+        for key_type in KeyType:
+            arrays[f"{key_type.value}.embeddings.normalized"] = normalize_with_moments_numpy(self.__load_numpy_file__(key_type))
+
+            links = self.__load_key_type_links__(key_type)
+            arrays[f"{key_type.value}.links.indices"] = links["indices"]
+            arrays[f"{key_type.value}.links.values"] = links["values"]
+
+        for dataset_type in DatasetType:
+            for name, array in self.__parse_ratings__(dataset_type, num_users, num_items).items():
+                arrays[f"{dataset_type.value}.{name}"] = array
+        return arrays, maps
+
+    @staticmethod
+    def __graph_from_arrays__(arrays, prefix):
+        return {"indices": arrays[f"{prefix}.indices"], "values": arrays[f"{prefix}.values"]}
 
     def __load_numpy_file__(self, key_type: KeyType):
-        return np.load(f"{self.data_dir}/{key_type.value}.embeddings.npy")
+        return np.load(f"{self.data_dir}/{key_type.value}.embeddings.npy", mmap_mode="r")
 
     def __load_mapper_json__(self, key_type: KeyType) -> dict:
         with open(f"{self.data_dir}/{key_type.value}_map.json") as f:
@@ -46,193 +100,234 @@ class DataModule:
         return data
 
     def __load_key_type_links__(self, key_type: KeyType):
-        links = defaultdict(list)
-        with open(f"{self.data_dir}/{key_type.value}.links", "r") as f:
-            for line in f:
-                neighbor1, neighbor2, reverse_connection = [int(x.strip()) for x in line.strip().split(",")]
-                bisect.insort_left(links[neighbor1], neighbor2)
-                if reverse_connection:
-                    bisect.insort_left(links[neighbor2], neighbor1)
-
-        # covert to indices and values for above links
-        indices = []
-        values = []
-
-        for n1, neighbors in links.items():
-            for n2 in neighbors:
-                indices.append([n1, n2])
-                values.append(1.0 / len(neighbors))
-
-        indices = np.array(indices).astype(np.int64)
-        values = np.array(values).astype(np.float32)
-        return {"indices": indices, "values": values}
-
-    def __load_ratings__(self, dataset_type: DatasetType):
-        ratings_by_user = defaultdict(list)
-        user_consumed_items = defaultdict(list)
-        item_consumed_users = defaultdict(list)
-        user_items_dict = defaultdict(list)
-        with open(f"{self.data_dir}/{dataset_type.value}.ratings", "r") as f:
-            for line in f:
-                user, item, rating = [int(x.strip()) for x in line.strip().split(",")]
-                # user -> items dict
-                user_items_dict[user].append(item)
-                # add user, item , rating info to ratings
-                ratings_by_user[user].append((item, rating))
-                # if item1, item3 is rated by user1 then user_consumed_items is {user1: [item1, item3 ]}
-                bisect.insort_left(user_consumed_items[user], item)
-                # if item1 is rated by user1 and user2 then item_consumed_users is {item1: [user1,user2]}
-                bisect.insort_left(item_consumed_users[item], user)
-
-        user_consumed_items_indices = []
-        user_consumed_items_values = []
-        for user, items in user_consumed_items.items():
-            for item in items:
-                user_consumed_items_indices.append([user, item])
-                user_consumed_items_values.append(1.0 / len(items))
-
-        user_consumed_items_indices = np.array(user_consumed_items_indices).astype(np.int64)
-        user_consumed_items_values = np.array(user_consumed_items_values).astype(np.float32)
-
-        item_consumed_users_indices = []
-        item_consumed_users_values = []
-        for item, users in item_consumed_users.items():
-            for user in users:
-                item_consumed_users_indices.append([item, user])
-                item_consumed_users_values.append(1.0)
-
-        item_consumed_users_indices = np.array(item_consumed_users_indices).astype(np.int64)
-        item_consumed_users_values = np.array(item_consumed_users_values).astype(np.float32)
-
-        # sort each user's items
-        for value in ratings_by_user.values():
-            value.sort(key=lambda v: v[0])
-
-        # add negatives
+        edges = read_edge_list(f"{self.data_dir}/{key_type.value}.links", num_columns=3)
+        neighbor1, neighbor2 = symmetrize_edges(edges[:, 0], edges[:, 1], edges[:, 2])
+        return build_adjacency(neighbor1, neighbor2)
+
+    def __parse_ratings__(self, dataset_type: DatasetType, num_users, num_items):
+        ratings = read_edge_list(f"{self.data_dir}/{dataset_type.value}.ratings", num_columns=3)
+        users, items, values = ratings[:, 0], ratings[:, 1], ratings[:, 2]
+
+        # if item1, item3 is rated by user1 then user_consumed_items is {user1: [item1, item3 ]}
+        user_consumed_items = build_adjacency(users, items)
+        # if item1 is rated by user1 and user2 then item_consumed_users is {item1: [user1,user2]}
+        item_consumed_users = build_adjacency(items, users, normalize=False)
+
+        # per user ratings sorted by item, stored as CSR: ratings of user u are items[offsets[u]:offsets[u + 1]], with
+        # int32 items and int8 labels for the usual ids and ratings
+        num_users = max(num_users, int(users.max(initial=-1)) + 1)
+        offsets, rating_items, rating_values = build_csr(users, items, values, num_users)
+        rating_items = rating_items.astype(index_dtype(max(num_items, int(items.max(initial=-1)) + 1)))
+        rating_values = compact_labels(rating_values)
+
+        return {
+            "user_consumed_items.indices": user_consumed_items["indices"],
+            "user_consumed_items.values": user_consumed_items["values"],
+            "item_consumed_users.indices": item_consumed_users["indices"],
+            "item_consumed_users.values": item_consumed_users["values"],
+            "ratings.offsets": offsets,
+            "ratings.items": rating_items,
+            "ratings.values": rating_values,
+        }
+
+    def __load_ratings__(self, dataset_type: DatasetType, arrays):
+        prefix = dataset_type.value
+        offsets = arrays[f"{prefix}.ratings.offsets"]
+
+        # add negatives, training negatives follow the configured distribution while evaluation ones stay uniform
         num_negatives = self.num_negatives
         if dataset_type == DatasetType.Test:
             num_negatives = self.num_evaluate
 
-        user_negative_items_dict = defaultdict(list)
-        num_items = len(self.item_map)
-        for user, items in user_items_dict.items():
-            for _ in range(num_negatives):
-                j = np.random.randint(num_items)
-                if j in items:
-                    j = np.random.randint(num_items)
-                user_negative_items_dict[user].append(j)
+        negative_sampler = NegativeSampler(
+            len(self.item_map),
+            offsets,
+            arrays[f"{prefix}.ratings.items"],
+            num_negatives,
+            distribution=self.negative_sampler if dataset_type == DatasetType.Train else "uniform",
+            seed=self.seed_sequence.spawn(1)[0],
+            dtype=index_dtype(len(self.item_map)),
+        )
+        negatives = negative_sampler.sample()
+        # only the training negatives are resampled, the other samplers and their positive keys are dropped
+        if dataset_type != DatasetType.Train:
+            negative_sampler = None
         return {
-            "ratings_by_user": ratings_by_user,
-            "user_consumed_items": {
-                "indices": user_consumed_items_indices,
-                "values": user_consumed_items_values,
-            },
-            "item_consumed_items": {
-                "indices": item_consumed_users_indices,
-                "values": item_consumed_users_values,
+            "ratings": {
+                "offsets": offsets,
+                "items": arrays[f"{prefix}.ratings.items"],
+                "values": arrays[f"{prefix}.ratings.values"],
             },
-            "user_items_dict": user_items_dict,
-            "user_negative_items_dict": user_negative_items_dict,
+            "user_consumed_items": self.__graph_from_arrays__(arrays, f"{prefix}.user_consumed_items"),
+            "item_consumed_items": self.__graph_from_arrays__(arrays, f"{prefix}.item_consumed_users"),
+            "negative_sampler": negative_sampler,
+            "negatives": negatives,
         }
 
+    def set_train_negatives(self, negatives):
+        """Replace the training negatives, e.g. with the result of train_data["negative_sampler"].sample()"""
+        self.train_data["negatives"] = np.asarray(negatives, dtype=index_dtype(len(self.item_map)))
+
+    def resample_train_negatives(self):
+        self.set_train_negatives(self.train_data["negative_sampler"].sample())
+
+    def append_train_ratings(self, users, items, ratings=None, persist=False):
+        """Add training ratings of existing users and items, returns the edge order of the extended
+        user_consumed_items and item_consumed_items graphs (see graph_builder.extend_adjacency).
+
+        The graphs are replaced by new dicts instead of being edited in place, models track the dicts they were built
+        with. The training negatives are resampled. With persist the ratings are appended to train.ratings, a
+        reload then gives the same layout.
+        """
+        users, items = self.__check_ids__(users, KeyType.USER), self.__check_ids__(items, KeyType.ITEM)
+        prefix = DatasetType.Train.value
+        ratings_csr = self.train_data["ratings"]
+        offsets = np.asarray(ratings_csr["offsets"], dtype=np.int64)
+        ratings = np.ones(len(users), dtype=ratings_csr["values"].dtype) if ratings is None else np.asarray(ratings)
+        if len(ratings) != len(users) or len(items) != len(users):
+            raise ValueError("Ratings need a user, an item and a rating each")
+
+        rating_users = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+        offsets, rating_items, rating_values = build_csr(
+            np.concatenate([rating_users, users]), np.concatenate([ratings_csr["items"], items]), np.concatenate([ratings_csr["values"], ratings]), len(offsets) - 1
+        )
+        user_consumed_items, user_consumed_items_order = extend_adjacency(self.train_data["user_consumed_items"], users, items)
+        item_consumed_users, item_consumed_users_order = extend_adjacency(self.train_data["item_consumed_items"], items, users, normalize=False)
+        arrays = {
+            f"{prefix}.ratings.offsets": offsets,
+            f"{prefix}.ratings.items": rating_items.astype(index_dtype(len(self.item_map))),
+            f"{prefix}.ratings.values": compact_labels(rating_values),
+            f"{prefix}.user_consumed_items.indices": user_consumed_items["indices"],
+            f"{prefix}.user_consumed_items.values": user_consumed_items["values"],
+            f"{prefix}.item_consumed_users.indices": item_consumed_users["indices"],
+            f"{prefix}.item_consumed_users.values": item_consumed_users["values"],
+        }
+        self.train_data["negative_sampler"].shutdown()
+        self.train_data = self.__load_ratings__(DatasetType.Train, arrays)
+
+        if persist:
+            self.__append_edge_list__(f"{self.data_dir}/{prefix}.ratings", [users, items, ratings])
+        return {"user_consumed_items": user_consumed_items_order, "item_consumed_items": item_consumed_users_order}
+
+    def append_links(self, key_type: KeyType, rows, cols, reverse_connection=None, persist=False):
+        """Add links between existing users or items, reverse_connection flags the links that also go the other way
+        (all by default). Returns the edge order of the extended links graph, see append_train_ratings."""
+        rows, cols = self.__check_ids__(rows, key_type), self.__check_ids__(cols, key_type)
+        reverse_connection = np.ones(len(rows), dtype=np.int64) if reverse_connection is None else np.asarray(reverse_connection, dtype=np.int64)
+        if len(cols) != len(rows) or len(reverse_connection) != len(rows):
+            raise ValueError("Links need two nodes and a reverse connection flag each")
+
+        neighbor1, neighbor2 = symmetrize_edges(rows, cols, reverse_connection)
+        links, order = extend_adjacency(getattr(self, f"{key_type.value}_links"), neighbor1, neighbor2)
+        setattr(self, f"{key_type.value}_links", links)
+
+        if persist:
+            self.__append_edge_list__(f"{self.data_dir}/{key_type.value}.links", [rows, cols, reverse_connection])
+        return order
+
+    @staticmethod
+    def __append_edge_list__(path, columns):
+        with open(path, "ab+") as f:
+            # the last line of the file may have no line break
+            f.seek(0, 2)
+            if f.tell() > 0:
+                f.seek(-1, 2)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write(format_edge_list(columns))
+
+    def __check_ids__(self, ids, key_type: KeyType):
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        num_nodes = len(self.user_map if key_type == KeyType.USER else self.item_map)
+        if len(ids) and (ids.min() < 0 or ids.max() >= num_nodes):
+            raise ValueError(f"Unknown {key_type.value} ids, new edges can only connect the {num_nodes} {key_type.value}s of the dataset")
+        return ids
+
     def train_data_batch_generator(self):
+        """Training batches of batch_size users, the rows of train_arrays"""
+        input_users, input_items, label_ratings, batch_offsets = self.train_arrays()
+        for start, end in zip(batch_offsets[:-1], batch_offsets[1:]):
+            yield np.reshape(input_users[start:end], [-1, 1]), np.reshape(input_items[start:end], [-1, 1]), np.reshape(label_ratings[start:end], [-1, 1])
+
+    @staticmethod
+    def __rows_with_negatives__(offsets, rating_items, rating_values, negatives, negative_users):
+        """Flat rows of the CSR ratings of every user followed by its negatives (for the users flagged in negative_users).
+
+        Returns users, items and labels (0 for the negatives) and the row offsets of the users.
+        """
+        num_users = len(offsets) - 1
+        num_negatives = negatives.shape[1]
+        rating_counts = np.diff(offsets)
+        num_ratings = int(offsets[-1])
+        negative_counts = np.where(negative_users, num_negatives, 0)
+
+        row_counts = rating_counts + negative_counts
+        row_offsets = np.concatenate([[0], np.cumsum(row_counts)]).astype(np.int64)
+        num_rows = int(row_offsets[-1])
+
+        input_users = np.repeat(np.arange(num_users, dtype=np.int64), row_counts)
+        input_items = np.empty(num_rows, dtype=np.int64)
+        label_ratings = np.zeros(num_rows, dtype=np.float32)
+
+        # ratings take the first rows of every user
+        rating_rows = np.repeat(row_offsets[:-1] - offsets[:-1], rating_counts) + np.arange(num_ratings)
+        input_items[rating_rows] = rating_items[:num_ratings]
+        label_ratings[rating_rows] = rating_values[:num_ratings]
+
+        # followed by the negatives
+        negative_users = np.flatnonzero(negative_counts)
+        negative_rows = (row_offsets[negative_users] + rating_counts[negative_users])[:, None] + np.arange(num_negatives)
+        input_items[negative_rows] = negatives[negative_users]
+        return input_users, input_items, label_ratings, row_offsets
+
+    def train_arrays(self):
+        """Flat training rows, batches of batch_size users.
+
+        Returns users, items and labels with one row per rating or negative, every user's ratings followed by its
+        negatives, and the row offsets of the batches (batch i is rows batch_offsets[i]:batch_offsets[i + 1]).
+        """
+        num_users = len(self.user_map)
+        ratings = self.train_data["ratings"]
+        offsets = np.asarray(ratings["offsets"][: num_users + 1], dtype=np.int64)
+        input_users, input_items, label_ratings, row_offsets = self.__rows_with_negatives__(
+            offsets, ratings["items"], ratings["values"], self.train_data["negatives"], np.diff(offsets) > 0
+        )
+        batch_offsets = np.append(row_offsets[0:num_users:self.batch_size], row_offsets[-1])
+        return input_users, input_items, label_ratings, batch_offsets
+
+    def get_validation_data(self):
+        """Validation ratings of every user followed by the user's training negatives"""
         num_users = len(self.user_map)
-        num_items = len(self.item_map)
-        users_list = list(range(num_users))
-        user_batches = [users_list[i : i + self.batch_size] for i in range(0, num_users, self.batch_size)]
-
-        ratings_by_user = self.train_data["ratings_by_user"]
-        user_negative_items_dict = self.train_data["user_negative_items_dict"]
-        for user_batch in user_batches:
-            input_users = []
-            input_items = []
-            label_ratings = []
-            for user in user_batch:
-                if user not in ratings_by_user:
-                    continue
-                for item_rating in ratings_by_user[user]:
-                    input_users.append(user)
-                    input_items.append(item_rating[0])
-                    label_ratings.append(item_rating[1])
-
-                # add negative data points
-                user_negative_items = user_negative_items_dict[user]
-                for item in user_negative_items:
-                    input_users.append(user)
-                    input_items.append(item)
-                    label_ratings.append(0)
-
-            input_users = np.reshape(np.array(input_users).astype(np.int64), [-1, 1])
-            input_items = np.reshape(np.array(input_items).astype(np.int64), [-1, 1])
-            label_ratings = np.reshape(np.array(label_ratings).astype(np.float32), [-1, 1])
-
-            yield input_users, input_items, label_ratings
-
-    def get_validation_data(self):  # sourcery skip: class-extract-method
-        ratings_by_user = self.validation_data["ratings_by_user"]
-        input_users = []
-        input_items = []
-        label_ratings = []
-
-        user_negative_items_dict = self.train_data["user_negative_items_dict"]
-        for user, item_ratings in ratings_by_user.items():
-            for item_rating in item_ratings:
-                input_users.append(user)
-                input_items.append(item_rating[0])
-                label_ratings.append(item_rating[1])
-
-            # add negative data points
-            user_negative_items = user_negative_items_dict[user]
-            for item in user_negative_items:
-                input_users.append(user)
-                input_items.append(item)
-                label_ratings.append(0)
-
-        input_users = np.reshape(np.array(input_users).astype(np.int64), [-1, 1])
-        input_items = np.reshape(np.array(input_items).astype(np.int64), [-1, 1])
-        label_ratings = np.reshape(np.array(label_ratings).astype(np.float32), [-1, 1])
-
-        return input_users, input_items, label_ratings
+        ratings = self.validation_data["ratings"]
+        offsets = np.asarray(ratings["offsets"][: num_users + 1], dtype=np.int64)
+        train_offsets = np.asarray(self.train_data["ratings"]["offsets"][: num_users + 1], dtype=np.int64)
+        negative_users = (np.diff(offsets) > 0) & (np.diff(train_offsets) > 0)
+        input_users, input_items, label_ratings, _ = self.__rows_with_negatives__(
+            offsets, ratings["items"], ratings["values"], self.train_data["negatives"], negative_users
+        )
+        return np.reshape(input_users, [-1, 1]), np.reshape(input_items, [-1, 1]), np.reshape(label_ratings, [-1, 1])
 
     def get_test_data_positive(self):
-        ratings_by_user = self.test_data["ratings_by_user"]
-        input_users = []
-        input_items = []
-        label_ratings = []
-        user_index_dict = defaultdict(list)
-        index_counter = 0
-        for user, item_ratings in ratings_by_user.items():
-            for item_rating in item_ratings:
-                input_users.append(user)
-                input_items.append(item_rating[0])
-                label_ratings.append(item_rating[1])
-                user_index_dict[user].append(index_counter)
-                index_counter += 1
-
-        input_users = np.reshape(np.array(input_users).astype(np.int64), [-1, 1])
-        input_items = np.reshape(np.array(input_items).astype(np.int64), [-1, 1])
-        label_ratings = np.reshape(np.array(label_ratings).astype(np.float32), [-1, 1])
-
-        return input_users, input_items, label_ratings, user_index_dict
+        """Test ratings in CSR order and {user: positions of the user's rows}"""
+        ratings = self.test_data["ratings"]
+        offsets = np.asarray(ratings["offsets"], dtype=np.int64)
+        rating_counts = np.diff(offsets)
+        num_ratings = int(offsets[-1])
+
+        input_users = np.repeat(np.arange(len(rating_counts), dtype=np.int64), rating_counts)
+        input_items = np.asarray(ratings["items"][:num_ratings], dtype=np.int64)
+        label_ratings = np.asarray(ratings["values"][:num_ratings], dtype=np.float32)
+        user_index_dict = {user: np.arange(offsets[user], offsets[user + 1]) for user in np.flatnonzero(rating_counts).tolist()}
+
+        return np.reshape(input_users, [-1, 1]), np.reshape(input_items, [-1, 1]), np.reshape(label_ratings, [-1, 1]), user_index_dict
 
     def get_test_data_negative(self):
-        user_negative_items_dict = self.test_data["user_negative_items_dict"]
-        users_list = list(user_negative_items_dict.keys())
-        user_batches = [users_list[i : i + self.batch_size] for i in range(0, len(users_list), self.batch_size)]
-
-        for user_batch in user_batches:
-            input_users = []
-            input_items = []
-            for user in user_batch:
-                if user not in user_negative_items_dict:
-                    continue
-                # add negative data points
-                user_negative_items = user_negative_items_dict[user]
-                for item in user_negative_items:
-                    input_users.append(user)
-                    input_items.append(item)
-
-            input_users = np.reshape(np.array(input_users).astype(np.int64), [-1, 1])
-            input_items = np.reshape(np.array(input_items).astype(np.int64), [-1, 1])
-
-            yield input_users, input_items, user_batch
+        """Sampled test negatives of batch_size test users at a time"""
+        negatives = self.test_data["negatives"]
+        users = np.flatnonzero(np.diff(self.test_data["ratings"]["offsets"]))
+        for start in range(0, len(users), self.batch_size):
+            user_batch = users[start : start + self.batch_size]
+            input_users = np.repeat(user_batch, negatives.shape[1]).astype(np.int64)
+            input_items = negatives[user_batch].astype(np.int64)
+
+            yield np.reshape(input_users, [-1, 1]), np.reshape(input_items, [-1, 1]), user_batch.tolist()
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# bump whenever the layout or the content of the cached arrays changes
+CACHE_VERSION = 3
+CACHE_DIR_NAME = ".cache"
+MANIFEST_FILE = "manifest.json"
+MAPS_FILE = "maps.npz"
+
+
+class DatasetCache:
+    """Binary cache of a compiled data directory.
+
+    Every array is stored as its own `.npy` file so that it can be opened with `np.load(mmap_mode="r")`,
+    the id maps are stored together in a `.npz` file. The manifest records the cache version and the
+    size/mtime of every source file, a mismatch on any of them invalidates the cache.
+    """
+
+    def __init__(self, data_dir, source_files, cache_dir=None):
+        self.data_dir = data_dir
+        self.source_files = sorted(source_files)
+        self.cache_dir = cache_dir or os.path.join(data_dir, CACHE_DIR_NAME, f"v{CACHE_VERSION}")
+
+    def __source_stats__(self) -> dict:
+        stats = {}
+        for filename in self.source_files:
+            stat = os.stat(os.path.join(self.data_dir, filename))
+            stats[filename] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        return stats
+
+    def __read_manifest__(self):
+        try:
+            with open(os.path.join(self.cache_dir, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_valid(self) -> bool:
+        manifest = self.__read_manifest__()
+        if manifest is None or manifest.get("version") != CACHE_VERSION:
+            return False
+        try:
+            return manifest["sources"] == self.__source_stats__()
+        except OSError:
+            return False
+
+    def load(self, mmap_mode="r"):
+        manifest = self.__read_manifest__()
+        arrays = {name: np.load(os.path.join(self.cache_dir, f"{name}.npy"), mmap_mode=mmap_mode) for name in manifest["arrays"]}
+
+        maps = {}
+        with np.load(os.path.join(self.cache_dir, MAPS_FILE)) as data:
+            for name in manifest["maps"]:
+                maps[name] = dict(zip(data[f"{name}.keys"].tolist(), data[f"{name}.values"].tolist()))
+        return arrays, maps
+
+    def save(self, arrays: dict, maps: dict):
+        # stats are taken before writing so that a source modified meanwhile invalidates the new cache
+        manifest = {
+            "version": CACHE_VERSION,
+            "sources": self.__source_stats__(),
+            "arrays": sorted(arrays),
+            "maps": sorted(maps),
+        }
+
+        # write into a temporary directory and move it in place, concurrent runs never see a partial cache
+        parent_dir = os.path.dirname(self.cache_dir)
+        os.makedirs(parent_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp-")
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+
+            map_arrays = {}
+            for name, mapping in maps.items():
+                map_arrays[f"{name}.keys"] = np.array(list(mapping.keys()))
+                map_arrays[f"{name}.values"] = np.array(list(mapping.values()))
+            np.savez(os.path.join(tmp_dir, MAPS_FILE), **map_arrays)
+
+            with open(os.path.join(tmp_dir, MANIFEST_FILE), "w") as f:
+                json.dump(manifest, f)
+
+            if os.path.isdir(self.cache_dir):
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.replace(tmp_dir, self.cache_dir)
+            log.info(f"Dataset cache written to {self.cache_dir}")
+        except OSError as e:
+            # another process won the race, its cache is just as good
+            log.warning(f"Could not write dataset cache to {self.cache_dir}: {e}")
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
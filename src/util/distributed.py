@@ -0,0 +1,25 @@
+import logging
+
+import tensorflow as tf
+
+log = logging.getLogger(__name__)
+
+
+def cpu_replica_strategy(num_replicas):
+    """MirroredStrategy over num_replicas logical devices of the first CPU.
+
+    The logical devices can only be configured before the TensorFlow runtime is initialized (before the first op or
+    variable), in a process that already initialized it the existing logical CPU devices are used.
+    """
+    cpus = tf.config.list_physical_devices("CPU")
+    try:
+        tf.config.set_logical_device_configuration(cpus[0], [tf.config.LogicalDeviceConfiguration() for _ in range(num_replicas)])
+    except RuntimeError:
+        log.warning("The TensorFlow runtime is already initialized, the logical CPU devices are not reconfigured")
+    devices = [device.name for device in tf.config.list_logical_devices("CPU")]
+    if len(devices) < num_replicas:
+        raise ValueError(f"{num_replicas} replicas need as many logical CPU devices, there are {len(devices)}")
+    # NCCL all-reduce is GPU only, the replicas of a host reduce on one device
+    strategy = tf.distribute.MirroredStrategy(devices[:num_replicas], cross_device_ops=tf.distribute.ReductionToOneDevice())
+    log.info(f"Data parallel training over {strategy.num_replicas_in_sync} replicas: {devices[:num_replicas]}")
+    return strategy
@@ -0,0 +1,135 @@
+import numpy as np
+
+
+def read_edge_list(path, num_columns):
+    """Read a comma separated file of integers into a (num_rows, num_columns) int64 array"""
+    with open(path, "r") as f:
+        text = f.read().strip()
+    if not text:
+        return np.zeros((0, num_columns), dtype=np.int64)
+
+    data = np.fromstring(text.replace("\n", ","), dtype=np.int64, sep=",")
+    if len(data) % num_columns != 0:
+        raise ValueError(f"{path}: expected {num_columns} values per line")
+    return data.reshape(-1, num_columns)
+
+
+def format_edge_list(columns):
+    """Comma separated lines of equal length non-negative integer columns as bytes, the format read by read_edge_list.
+
+    Digits are written into one byte buffer with array ops, far faster than per-row string formatting.
+    """
+    columns = [np.asarray(column, dtype=np.int64) for column in columns]
+    num_rows = len(columns[0])
+    if num_rows == 0:
+        return b""
+    if any(column.min() < 0 for column in columns):
+        raise ValueError("Only non-negative values can be formatted")
+
+    # decimal digits of every value
+    widths = []
+    for column in columns:
+        width = np.ones(num_rows, dtype=np.int64)
+        power = 10
+        while power <= column.max():
+            width += column >= power
+            power *= 10
+        widths.append(width)
+    line_lengths = np.sum(widths, axis=0) + len(columns)
+    buffer = np.empty(int(line_lengths.sum()), dtype=np.uint8)
+
+    # digits from the last one, every value followed by a separator
+    positions = np.cumsum(line_lengths) - line_lengths
+    for column, width in zip(columns, widths):
+        ends = positions + width
+        values = column.copy()
+        digit_positions = ends - 1
+        for digit in range(int(width.max())):
+            rows = width > digit
+            buffer[digit_positions[rows]] = ord("0") + values[rows] % 10
+            values //= 10
+            digit_positions -= 1
+        buffer[ends] = ord(",")
+        positions = ends + 1
+    buffer[positions - 1] = ord("\n")
+    return buffer.tobytes()
+
+
+def symmetrize_edges(rows, cols, reverse_connection):
+    """Append (col, row) right after every (row, col) flagged with reverse_connection, in file order"""
+    all_rows = np.stack([rows, cols], axis=1).ravel()
+    all_cols = np.stack([cols, rows], axis=1).ravel()
+    keep = np.stack([np.ones_like(reverse_connection, dtype=bool), reverse_connection != 0], axis=1).ravel()
+    return all_rows[keep], all_cols[keep]
+
+
+def build_adjacency(rows, cols, normalize=True):
+    """Build the COO indices and values of the adjacency given by the edges (rows[i], cols[i]).
+
+    Rows are laid out in order of their first appearance in the edge list and the columns of every row are
+    sorted, duplicates are kept. Values are 1 / degree of the row when normalize is set, 1.0 otherwise.
+    """
+    return build_adjacency_with_order(rows, cols, normalize)[0]
+
+
+def build_adjacency_with_order(rows, cols, normalize=True):
+    """build_adjacency and the position in the edge list of every edge of the adjacency"""
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+
+    unique_rows, first_index, inverse, counts = np.unique(rows, return_index=True, return_inverse=True, return_counts=True)
+    # position of every distinct row in order of first appearance
+    row_rank = np.empty(len(unique_rows), dtype=np.int64)
+    row_rank[np.argsort(first_index)] = np.arange(len(unique_rows))
+
+    order = np.lexsort((cols, row_rank[inverse]))
+    indices = np.stack([rows[order], cols[order]], axis=1)
+
+    if normalize:
+        values = (1.0 / counts[inverse[order]]).astype(np.float32)
+    else:
+        values = np.ones(len(order), dtype=np.float32)
+    return {"indices": indices, "values": values}, order
+
+
+def extend_adjacency(graph, rows, cols, normalize=True):
+    """build_adjacency over the edges of graph followed by the new edges (rows[i], cols[i]).
+
+    An adjacency lists its rows in order of first appearance and keeps the order of duplicates, so the result is
+    the adjacency of the original edge list with the new edges appended. Also returns the position of every edge
+    in the edges of graph followed by the new ones, to lay out per edge arrays the same way.
+    """
+    indices = np.asarray(graph["indices"], dtype=np.int64).reshape(-1, 2)
+    return build_adjacency_with_order(np.concatenate([indices[:, 0], rows]), np.concatenate([indices[:, 1], cols]), normalize)
+
+
+def build_csr(rows, cols, data, num_rows):
+    """Sort (cols, data) by row then column and return them with the row offsets, ties keep input order"""
+    rows = np.asarray(rows, dtype=np.int64)
+    order = np.lexsort((cols, rows))
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num_rows))]).astype(np.int64)
+    return offsets, np.asarray(cols)[order], np.asarray(data)[order]
+
+
+def index_dtype(num_nodes):
+    """int32 for the ids of up to 2**31 nodes, int64 beyond"""
+    return np.int32 if num_nodes <= 2**31 else np.int64
+
+
+def compact_labels(values):
+    """Rating values as int8 when they are small integers, as float16 when it holds them exactly, as float32 otherwise"""
+    values = np.asarray(values)
+    if len(values) == 0 or (np.all(np.mod(values, 1) == 0) and values.min() >= -128 and values.max() <= 127):
+        return values.astype(np.int8)
+    if np.array_equal(values.astype(np.float16), values):
+        return values.astype(np.float16)
+    return values.astype(np.float32)
+
+
+def csr_rows(offsets, items, users):
+    """Local row (position in users) and item of every entry of the given users in a CSR"""
+    starts = np.asarray(offsets[users], dtype=np.int64)
+    counts = np.asarray(offsets[users + 1], dtype=np.int64) - starts
+    rows = np.repeat(np.arange(len(users), dtype=np.int64), counts)
+    positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum(), dtype=np.int64)
+    return rows, np.asarray(items[positions], dtype=np.int64)
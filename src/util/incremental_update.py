@@ -0,0 +1,73 @@
+import logging
+import time
+
+import numpy as np
+
+from data.key_type import KeyType
+from util.graph_builder import symmetrize_edges
+
+log = logging.getLogger(__name__)
+
+
+class IncrementalUpdater:
+    """Applies new ratings and links to a loaded DataModule and a model trained on it.
+
+    add_ratings and add_links extend the graphs of the DataModule and the model, and the model's trainable edge
+    values, right away. refresh then recomputes the cached embeddings of the nodes affected by the edges added
+    since the last refresh, over their L-hop neighborhoods only. updated_users are the users with new edges, e.g.
+    to fine-tune on.
+    """
+
+    def __init__(self, data_module, model, persist=False):
+        self.data_module = data_module
+        self.model = model
+        self.persist = persist
+        # {edge set: [(destinations, sources)]} added since the last refresh
+        self.pending_edges = {}
+        self.users = []
+
+    def add_ratings(self, users, items, ratings=None):
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        items = np.asarray(items, dtype=np.int64).reshape(-1)
+        orders = self.data_module.append_train_ratings(users, items, ratings, persist=self.persist)
+        train_data = self.data_module.train_data
+        self.__extend__("user_consumed_items", train_data["user_consumed_items"], orders["user_consumed_items"], users, items)
+        self.__extend__("item_consumed_users", train_data["item_consumed_items"], orders["item_consumed_items"], items, users)
+        self.users.append(users)
+        log.info(f"Added {len(users)} ratings")
+
+    def add_links(self, rows, cols, reverse_connection=None, key_type=KeyType.USER):
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        cols = np.asarray(cols, dtype=np.int64).reshape(-1)
+        order = self.data_module.append_links(key_type, rows, cols, reverse_connection, persist=self.persist)
+        reverse_connection = np.ones(len(rows), dtype=np.int64) if reverse_connection is None else np.asarray(reverse_connection)
+        neighbor1, neighbor2 = symmetrize_edges(rows, cols, reverse_connection)
+        self.__extend__(f"{key_type.value}_neighbors", getattr(self.data_module, f"{key_type.value}_links"), order, neighbor1, neighbor2)
+        if key_type == KeyType.USER:
+            self.users.append(neighbor1)
+        log.info(f"Added {len(rows)} {key_type.value} links")
+
+    def __extend__(self, edge, graph, order, destinations, sources):
+        # DiffnetPlus has no item links
+        if edge not in self.model.edge_sets():
+            return
+        self.model.extend_edge_set(edge, graph, order)
+        self.pending_edges.setdefault(edge, []).append((destinations, sources))
+
+    def updated_users(self):
+        return np.unique(np.concatenate(self.users + [np.zeros(0, dtype=np.int64)]))
+
+    def refresh(self, nodes_per_batch=4096):
+        """Recompute the cached embeddings of the nodes affected by the new edges, returns the affected users and items"""
+        start_time = time.time()
+        new_edges = {edge: tuple(np.concatenate(arrays) for arrays in zip(*edges)) for edge, edges in self.pending_edges.items()}
+        users, items = self.model.affected_nodes(new_edges)
+        # after the weights changed, e.g. by fine-tuning, all embeddings are propagated
+        incremental = self.model.has_current_gcn_embeddings()
+        self.model.refresh_gcn_embeddings(users, items, nodes_per_batch=nodes_per_batch)
+        self.pending_edges = {}
+        if incremental:
+            log.info(f"Refreshed the embeddings of {len(users)} users and {len(items)} items in {time.time() - start_time:.2f}s")
+        else:
+            log.info(f"Propagated all embeddings in {time.time() - start_time:.2f}s, {len(users)} users and {len(items)} items are affected by the new edges")
+        return users, items
@@ -0,0 +1,90 @@
+import numpy as np
+import tensorflow as tf
+
+
+def pad_to_bucket(input_users, input_items, label_ratings, boundaries):
+    """Pad a batch to the smallest bucket that fits it, padded rows get a zero label weight"""
+    batch_length = tf.shape(input_users, out_type=tf.int64)[0]
+    padded_length = batch_length
+    if boundaries is not None:
+        bucket = tf.searchsorted(boundaries, tf.reshape(batch_length, [1]))[0]
+        padded_length = tf.gather(tf.concat([boundaries, tf.reshape(batch_length, [1])], 0), bucket)
+
+    padding = [[0, padded_length - batch_length], [0, 0]]
+    label_weights = tf.pad(tf.ones([batch_length, 1], dtype=tf.float32), padding)
+    return (
+        tf.pad(input_users, padding),
+        tf.pad(input_items, padding),
+        tf.pad(label_ratings, padding),
+        label_weights,
+    )
+
+
+def make_train_dataset(input_users, input_items, label_ratings, batch_offsets, boundaries=None, shuffle=False, seed=None):
+    """tf.data pipeline over flat training rows, batch i is rows batch_offsets[i]:batch_offsets[i + 1].
+
+    Batches are kept as they are laid out in the flat rows (grouped by user), shuffle only changes their order.
+    Every element is (input_users, input_items, label_ratings, label_weights), columns of shape [batch, 1].
+    """
+    input_users = tf.constant(np.reshape(input_users, [-1, 1]), dtype=tf.int64)
+    input_items = tf.constant(np.reshape(input_items, [-1, 1]), dtype=tf.int64)
+    label_ratings = tf.constant(np.reshape(label_ratings, [-1, 1]), dtype=tf.float32)
+    if boundaries is not None:
+        boundaries = tf.constant(boundaries, dtype=tf.int64)
+
+    batch_offsets = np.asarray(batch_offsets, dtype=np.int64)
+    dataset = tf.data.Dataset.from_tensor_slices((batch_offsets[:-1], batch_offsets[1:]))
+    if shuffle:
+        dataset = dataset.shuffle(len(batch_offsets) - 1, seed=seed, reshuffle_each_iteration=True)
+
+    def assemble_batch(start, end):
+        return pad_to_bucket(input_users[start:end], input_items[start:end], label_ratings[start:end], boundaries)
+
+    dataset = dataset.map(assemble_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def subgraph_signature(neighbor_sampler):
+    """Nested TensorSpecs of the subgraphs sampled by a NeighborSampler"""
+    levels = tuple(tf.TensorSpec([None], tf.int64) for _ in range(len(neighbor_sampler.fanouts) + 1))
+    block = {
+        name: {"rows": tf.TensorSpec([None], tf.int32), "cols": tf.TensorSpec([None], tf.int32), "edges": tf.TensorSpec([None], tf.int64)}
+        for name in neighbor_sampler.edge_types
+    }
+    return {
+        "users": levels,
+        "items": levels,
+        "blocks": tuple(block for _ in neighbor_sampler.fanouts),
+        "user_positions": tf.TensorSpec([None, 1], tf.int64),
+        "item_positions": tf.TensorSpec([None, 1], tf.int64),
+    }
+
+
+def make_sampled_train_dataset(input_users, input_items, label_ratings, batch_offsets, neighbor_sampler, shuffle=False, seed=None):
+    """tf.data pipeline over flat training rows with the computation subgraph of every batch.
+
+    Subgraphs are sampled with numpy in the generator, prefetching samples the next batches while the current one
+    is trained on. Every element is (input_users, input_items, label_ratings, label_weights, subgraph).
+    """
+    input_users = np.reshape(input_users, [-1, 1]).astype(np.int64)
+    input_items = np.reshape(input_items, [-1, 1]).astype(np.int64)
+    label_ratings = np.reshape(label_ratings, [-1, 1]).astype(np.float32)
+    batch_offsets = np.asarray(batch_offsets, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+
+    def generate_batches():
+        num_batches = len(batch_offsets) - 1
+        for batch in rng.permutation(num_batches) if shuffle else range(num_batches):
+            rows = slice(batch_offsets[batch], batch_offsets[batch + 1])
+            subgraph = neighbor_sampler.sample(input_users[rows], input_items[rows])
+            yield input_users[rows], input_items[rows], label_ratings[rows], np.ones_like(label_ratings[rows]), subgraph
+
+    output_signature = (
+        tf.TensorSpec([None, 1], tf.int64),
+        tf.TensorSpec([None, 1], tf.int64),
+        tf.TensorSpec([None, 1], tf.float32),
+        tf.TensorSpec([None, 1], tf.float32),
+        subgraph_signature(neighbor_sampler),
+    )
+    dataset = tf.data.Dataset.from_generator(generate_batches, output_signature=output_signature)
+    return dataset.prefetch(tf.data.AUTOTUNE)
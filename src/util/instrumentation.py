@@ -0,0 +1,99 @@
+import contextlib
+import logging
+import os
+import time
+
+import tensorflow as tf
+
+log = logging.getLogger(__name__)
+
+
+class Instrumentation:
+    """Named wall clock timers and counters.
+
+    Timers nest, a timer is named by the path of the timers it runs in, e.g. train/step/forward/gcn_layer_1. They
+    only measure what runs eagerly: the block of a timer in a traced tf.function runs once while tracing, there it
+    only opens a tf.name_scope of the same name, which labels the ops of the block in a profiler trace.
+    """
+
+    def __init__(self):
+        self.scopes = []
+        self.reset()
+
+    def reset(self):
+        # {path: [total seconds, calls]}
+        self.timers = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        with tf.name_scope(name):
+            if not tf.executing_eagerly():
+                yield
+                return
+            self.scopes.append(name)
+            path = "/".join(self.scopes)
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                timer = self.timers.setdefault(path, [0.0, 0])
+                timer[0] += time.perf_counter() - start_time
+                timer[1] += 1
+                self.scopes.pop()
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def breakdown(self) -> dict:
+        """{"timers": {path: {"total", "self", "calls"}}, "counters": {name: value}}, self excludes the nested timers"""
+        timers = {}
+        for path, (total, calls) in sorted(self.timers.items()):
+            nested = sum(self.timers[child][0] for child in self.timers if child.startswith(f"{path}/") and "/" not in child[len(path) + 1 :])
+            timers[path] = {"total": total, "self": total - nested, "calls": calls}
+        return {"timers": timers, "counters": dict(self.counters)}
+
+
+def parse_step_range(text):
+    """First and last step of a "first:last" range, both included"""
+    try:
+        first, last = (int(step) for step in text.split(":"))
+    except ValueError:
+        raise ValueError(f"A step range is two steps as first:last: {text}")
+    if first < 1 or last < first:
+        raise ValueError(f"A step range needs 1 <= first <= last: {text}")
+    return first, last
+
+
+class StepProfiler:
+    """Captures a tf.profiler trace of the training steps first to last of a run, counted over all epochs"""
+
+    def __init__(self, first_step, last_step, log_dir):
+        self.first_step = first_step
+        self.last_step = last_step
+        self.log_dir = log_dir
+        self.steps = 0
+        self.active = False
+
+    @contextlib.contextmanager
+    def step(self):
+        self.steps += 1
+        if self.steps == self.first_step:
+            log.info(f"Starting the profiler trace of steps {self.first_step} to {self.last_step} in {self.log_dir}")
+            os.makedirs(self.log_dir, exist_ok=True)
+            tf.profiler.experimental.start(self.log_dir)
+            self.active = True
+        if self.active:
+            with tf.profiler.experimental.Trace("train", step_num=self.steps, _r=1):
+                yield
+        else:
+            yield
+        if self.steps == self.last_step:
+            self.stop()
+
+    def stop(self):
+        """Write the trace, also when training ends inside the step range"""
+        if self.active:
+            tf.profiler.experimental.stop()
+            self.active = False
+            log.info(f"Saved the profiler trace to {self.log_dir}")
@@ -0,0 +1,97 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+SAMPLER_DISTRIBUTIONS = ["uniform", "popularity"]
+
+
+class NegativeSampler:
+    """Vectorized negative item sampler.
+
+    Positives are given as a per user CSR (offsets, items) with the items of every user sorted, so that the
+    (user, item) keys user * num_items + item are globally sorted and a candidate is rejected exactly with one
+    searchsorted. Candidates that collide with a positive are redrawn until none is left.
+    """
+
+    def __init__(
+        self, num_items, offsets, items, num_negatives, distribution="uniform", popularity_exponent=0.75, seed=None, max_rounds=100, dtype=np.int64, candidates_per_chunk=2**20
+    ):
+        if distribution not in SAMPLER_DISTRIBUTIONS:
+            raise ValueError(f"Unknown negative sampler distribution: {distribution}")
+        self.num_items = num_items
+        self.num_negatives = num_negatives
+        self.distribution = distribution
+        self.max_rounds = max_rounds
+        # of the sampled negatives matrix
+        self.dtype = dtype
+        self.candidates_per_chunk = candidates_per_chunk
+        self.rng = np.random.default_rng(seed)
+
+        offsets = np.asarray(offsets, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        counts = np.diff(offsets)
+        self.num_users = len(counts)
+        self.users = np.flatnonzero(counts)
+        self.positive_keys = np.repeat(np.arange(self.num_users, dtype=np.int64), counts) * num_items + items
+
+        self.cdf = None
+        if distribution == "popularity":
+            weights = np.bincount(items, minlength=num_items).astype(np.float64) ** popularity_exponent
+            self.cdf = np.cumsum(weights / weights.sum())
+
+        self.executor = None
+
+    def __draw__(self, size):
+        if self.cdf is None:
+            return self.rng.integers(self.num_items, size=size, dtype=np.int64)
+        return np.minimum(np.searchsorted(self.cdf, self.rng.random(size), side="right"), self.num_items - 1)
+
+    def __is_positive__(self, users, items):
+        keys = users * self.num_items + items
+        position = np.minimum(np.searchsorted(self.positive_keys, keys), len(self.positive_keys) - 1)
+        return self.positive_keys[position] == keys
+
+    def sample(self):
+        """Draw a (num_users, num_negatives) matrix of negatives, rows of users without positives are left zero"""
+        negatives = np.zeros((self.num_users, self.num_negatives), dtype=self.dtype)
+        if len(self.users) == 0 or self.num_negatives == 0:
+            return negatives
+
+        # a chunk of users at a time, the int64 candidates and keys of all negatives at once would dwarf the result
+        users_per_chunk = max(1, self.candidates_per_chunk // self.num_negatives)
+        num_pending = 0
+        for start in range(0, len(self.users), users_per_chunk):
+            chunk_users = self.users[start : start + users_per_chunk]
+            users = np.repeat(chunk_users, self.num_negatives)
+            items = self.__draw__(len(users))
+            pending = np.flatnonzero(self.__is_positive__(users, items))
+            for _ in range(self.max_rounds):
+                if len(pending) == 0:
+                    break
+                items[pending] = self.__draw__(len(pending))
+                pending = pending[self.__is_positive__(users[pending], items[pending])]
+            num_pending += len(pending)
+            negatives[chunk_users] = items.reshape(-1, self.num_negatives)
+        if num_pending:
+            log.warning(f"{num_pending} negatives still collide with positives after {self.max_rounds} rounds")
+        return negatives
+
+    def sample_async(self):
+        """Draw the next negatives in a background thread, returns a Future of sample()"""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="negative-sampler")
+        return self.executor.submit(self.sample)
+
+    def get_state(self) -> dict:
+        return self.rng.bit_generator.state
+
+    def set_state(self, state: dict):
+        self.rng.bit_generator.state = state
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
@@ -0,0 +1,100 @@
+import numpy as np
+
+from util.graph_builder import csr_rows
+
+
+def local_ids(destinations, sources):
+    """Nodes of the next level, destinations first then new source nodes in order of first appearance, and the
+    position of every source node in it"""
+    nodes = np.concatenate([destinations, sources])
+    unique_nodes, first_index, inverse = np.unique(nodes, return_index=True, return_inverse=True)
+    rank = np.empty(len(unique_nodes), dtype=np.int64)
+    rank[np.argsort(first_index)] = np.arange(len(unique_nodes))
+    level = np.empty(len(unique_nodes), dtype=np.int64)
+    level[rank] = unique_nodes
+    return level, rank[inverse[len(destinations) :]]
+
+
+class NeighborSampler:
+    """Samples the L-hop computation subgraph of a batch of users and items, GraphSAGE style.
+
+    Edge sets are given as {name: (graph, destination type, source type)} with the COO graphs of the model, the
+    types being "user" or "item". fanouts[h] is the maximum number of neighbors sampled per node and edge set at
+    hop h + 1 from the batch, without replacement; a fanout <= 0 keeps all neighbors.
+
+    The subgraph is a dict of numpy arrays:
+      users, items: global ids of the nodes of every level, level 0 is the outermost hop and level L the batch.
+        The nodes of level l + 1 are the first nodes of level l, so their previous layer embeddings are a prefix.
+      blocks: for every layer l (level l -> l + 1) and edge set, the destination rows (in level l + 1), source
+        cols (in level l) and ids (position in the COO graph, i.e. in the trainable edge values) of the edges.
+      user_positions, item_positions: [batch, 1] position of every input row in the batch level.
+    """
+
+    def __init__(self, edge_sets, num_users, num_items, fanouts, seed=None):
+        num_nodes = {"user": num_users, "item": num_items}
+        self.fanouts = list(fanouts)
+        self.rng = np.random.default_rng(seed)
+        self.edge_types = {}
+        self.csr = {}
+        for name, (graph, destination_type, source_type) in edge_sets.items():
+            indices = np.asarray(graph["indices"], dtype=np.int64)
+            # per destination CSR, ties keep COO order
+            order = np.argsort(indices[:, 0], kind="stable")
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(indices[:, 0], minlength=num_nodes[destination_type]))]).astype(np.int64)
+            self.csr[name] = (offsets, indices[order, 1], order)
+            self.edge_types[name] = (destination_type, source_type)
+
+    def __sample_neighbors__(self, name, destinations, fanout):
+        """(local destination row, source node, edge id) of the sampled edges of destinations"""
+        offsets, sources, edge_ids = self.csr[name]
+        rows, positions = csr_rows(offsets, np.arange(len(sources), dtype=np.int64), destinations)
+        if fanout > 0 and len(positions):
+            degrees = np.bincount(rows, minlength=len(destinations))
+            if degrees.max() > fanout:
+                # rows come grouped, a random key in [0, 1) added to the row shuffles every row in place, then
+                # keep the first fanout edges of every row
+                order = np.argsort(rows + self.rng.random(len(positions)))
+                rows, positions = rows[order], positions[order]
+                row_starts = np.repeat(np.cumsum(degrees) - degrees, degrees)
+                keep = np.arange(len(rows)) - row_starts < fanout
+                rows, positions = rows[keep], positions[keep]
+        return rows, sources[positions], edge_ids[positions]
+
+    def get_state(self) -> dict:
+        return self.rng.bit_generator.state
+
+    def set_state(self, state: dict):
+        self.rng.bit_generator.state = state
+
+    def sample(self, input_users, input_items):
+        input_users = np.asarray(input_users, dtype=np.int64).reshape(-1)
+        input_items = np.asarray(input_items, dtype=np.int64).reshape(-1)
+        batch_users, user_positions = np.unique(input_users, return_inverse=True)
+        batch_items, item_positions = np.unique(input_items, return_inverse=True)
+
+        levels = {"user": [batch_users], "item": [batch_items]}
+        blocks = []
+        for fanout in self.fanouts:
+            destinations = {"user": levels["user"][-1], "item": levels["item"][-1]}
+            sampled = {name: self.__sample_neighbors__(name, destinations[destination_type], fanout) for name, (destination_type, _) in self.edge_types.items()}
+
+            # next (outer) level of every node type and the local ids of the sampled sources in it
+            block = {}
+            for node_type in ["user", "item"]:
+                names = [name for name, (_, source_type) in self.edge_types.items() if source_type == node_type]
+                level, cols = local_ids(destinations[node_type], np.concatenate([sampled[name][1] for name in names] + [np.zeros(0, dtype=np.int64)]))
+                levels[node_type].append(level)
+                for name in names:
+                    rows, sources, edge_ids = sampled[name]
+                    block[name] = {"rows": rows.astype(np.int32), "cols": cols[: len(sources)].astype(np.int32), "edges": edge_ids}
+                    cols = cols[len(sources) :]
+            blocks.append(block)
+
+        # tuples, tf.data would convert lists to tensors
+        return {
+            "users": tuple(levels["user"][::-1]),
+            "items": tuple(levels["item"][::-1]),
+            "blocks": tuple(blocks[::-1]),
+            "user_positions": user_positions.reshape(-1, 1).astype(np.int64),
+            "item_positions": item_positions.reshape(-1, 1).astype(np.int64),
+        }
@@ -0,0 +1,176 @@
+import logging
+import os
+
+import numpy as np
+
+from util.graph_builder import format_edge_list
+
+log = logging.getLogger(__name__)
+
+DEGREE_DISTRIBUTIONS = ["uniform", "powerlaw"]
+
+
+def node_degrees(num_nodes, mean_degree, distribution, exponent, rng, min_degree=1):
+    """Degree of every node with the given mean, uniform or power-law (Pareto tailed) distributed"""
+    if distribution == "uniform":
+        degrees = rng.integers(min_degree, max(min_degree, 2 * mean_degree - min_degree) + 1, size=num_nodes)
+    elif distribution == "powerlaw":
+        if exponent <= 1.0:
+            raise ValueError(f"The power-law exponent must be greater than 1 for a finite mean degree: {exponent}")
+        # Pareto with tail exponent `exponent` scaled to the mean
+        samples = rng.pareto(exponent, size=num_nodes) + 1.0
+        degrees = np.floor(samples * (mean_degree - min_degree + 1) * (exponent - 1) / exponent) + min_degree - 1
+    else:
+        raise ValueError(f"Unknown degree distribution: {distribution}")
+    return np.maximum(degrees.astype(np.int64), min_degree)
+
+
+def popularity_weights(num_nodes, distribution, exponent, rng):
+    """Unnormalized probability of every node to be picked as a neighbor, Zipf over a random node order for powerlaw"""
+    if distribution == "uniform":
+        return np.ones(num_nodes)
+    weights = np.empty(num_nodes)
+    weights[rng.permutation(num_nodes)] = 1.0 / np.arange(1, num_nodes + 1) ** (1.0 / exponent)
+    return weights
+
+
+class NeighborDistribution:
+    """Draws neighbors by popularity, either over all nodes or over the nodes of a source's community.
+
+    Nodes are laid out sorted by community with the cumulative popularity over that order, a community is a
+    contiguous range of it and a draw is one binary search.
+    """
+
+    def __init__(self, weights, communities=None):
+        num_nodes = len(weights)
+        if communities is None:
+            communities = np.zeros(num_nodes, dtype=np.int64)
+        self.communities = communities
+        self.nodes = np.argsort(communities, kind="stable")
+        self.bounds = np.searchsorted(communities[self.nodes], np.arange(communities.max(initial=0) + 2))
+        self.cumulative = np.concatenate([[0.0], np.cumsum(weights[self.nodes])])
+
+    def draw(self, rng, size=None, sources=None):
+        """Neighbors of size random sources, or of every given source within its community"""
+        if sources is None:
+            low = np.zeros(size)
+            high = np.full(size, self.cumulative[-1])
+        else:
+            community = self.communities[sources]
+            low = self.cumulative[self.bounds[community]]
+            high = self.cumulative[self.bounds[community + 1]]
+        positions = np.searchsorted(self.cumulative, low + rng.random(len(low)) * (high - low), side="right") - 1
+        return self.nodes[np.clip(positions, 0, len(self.nodes) - 1)]
+
+
+def node_communities(num_nodes, community_size, distribution, exponent, rng):
+    """Community of every node, about community_size nodes each and skewed sizes for powerlaw"""
+    num_communities = max(1, num_nodes // max(1, community_size))
+    weights = popularity_weights(num_communities, distribution, exponent, rng)
+    return NeighborDistribution(weights).draw(rng, size=num_nodes)
+
+
+def chunks(num_nodes, chunk_size):
+    for start in range(0, num_nodes, chunk_size):
+        yield start, min(num_nodes, start + chunk_size)
+
+
+def write_map(path, key_type, num_nodes, chunk_size):
+    # the json object of {"{key_type}_{node}": node} written a chunk at a time
+    with open(path, "w") as f:
+        f.write("{")
+        for start, end in chunks(num_nodes, chunk_size):
+            f.write(", " * (start > 0) + ", ".join(f'"{key_type}_{node}": {node}' for node in range(start, end)))
+        f.write("}")
+
+
+def write_embeddings(path, num_nodes, review_dims, chunk_size, rng):
+    embeddings = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(num_nodes, review_dims))
+    for start, end in chunks(num_nodes, chunk_size):
+        embeddings[start:end] = rng.standard_normal((end - start, review_dims), dtype=np.float32)
+    embeddings.flush()
+    del embeddings
+
+
+def generate_dataset(
+    data_dir,
+    num_users,
+    num_items,
+    ratings_per_user=10,
+    links_per_user=5,
+    links_per_item=3,
+    review_dims=150,
+    degree_distribution="powerlaw",
+    exponent=2.0,
+    community_size=100,
+    mixing=0.1,
+    reciprocity=0.5,
+    chunk_size=100000,
+    seed=None,
+):
+    """Write a synthetic dataset in the data directory format read by DataModule.
+
+    Users rate ratings_per_user items on average, the last rating of a user (in file order) goes to the test
+    split and the one before to the validation split for users with at least three distinct items. Degrees of users
+    and popularities of items and link targets follow degree_distribution. Users and items are grouped into
+    communities of about community_size nodes, a link leaves its source's community with probability mixing and is
+    flagged as reciprocal with probability reciprocity.
+
+    Nodes are generated chunk_size at a time and every chunk is appended to the files, memory is bounded by the
+    chunk and the per-node arrays.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+
+    for key_type, num_nodes in [("user", num_users), ("item", num_items)]:
+        write_map(os.path.join(data_dir, f"{key_type}_map.json"), key_type, num_nodes, chunk_size)
+        write_embeddings(os.path.join(data_dir, f"{key_type}.embeddings.npy"), num_nodes, review_dims, chunk_size, rng)
+
+    # ratings, distinct items per user
+    item_distribution = NeighborDistribution(popularity_weights(num_items, degree_distribution, exponent, rng))
+    num_ratings = 0
+    split_files = {split: open(os.path.join(data_dir, f"{split}.ratings"), "wb") for split in ["train", "validation", "test"]}
+    try:
+        for start, end in chunks(num_users, chunk_size):
+            degrees = node_degrees(end - start, ratings_per_user, degree_distribution, exponent, rng, min_degree=3)
+            users = np.repeat(np.arange(start, end, dtype=np.int64), degrees)
+            items = item_distribution.draw(rng, size=len(users))
+            _, first = np.unique(users * num_items + items, return_index=True)
+            keep = np.zeros(len(users), dtype=bool)
+            keep[first] = True
+            users, items = users[keep], items[keep]
+            num_ratings += len(users)
+
+            # position of every rating from the end of its user's ratings
+            counts = np.bincount(users - start, minlength=end - start)
+            from_end = np.repeat(np.cumsum(counts), counts) - np.arange(len(users)) - 1
+            held_out = counts[users - start] >= 3
+            splits = {"train": ~held_out | (from_end >= 2), "validation": held_out & (from_end == 1), "test": held_out & (from_end == 0)}
+            for split, mask in splits.items():
+                split_files[split].write(format_edge_list([users[mask], items[mask], np.ones(mask.sum(), dtype=np.int64)]))
+    finally:
+        for f in split_files.values():
+            f.close()
+
+    # user and item links within and across communities
+    num_links = 0
+    for key_type, num_nodes, mean_degree in [("user", num_users, links_per_user), ("item", num_items, links_per_item)]:
+        weights = popularity_weights(num_nodes, degree_distribution, exponent, rng)
+        global_distribution = NeighborDistribution(weights)
+        community_distribution = NeighborDistribution(weights, node_communities(num_nodes, community_size, degree_distribution, exponent, rng))
+        with open(os.path.join(data_dir, f"{key_type}.links"), "wb") as f:
+            for start, end in chunks(num_nodes, chunk_size):
+                sources = np.repeat(np.arange(start, end, dtype=np.int64), node_degrees(end - start, mean_degree, degree_distribution, exponent, rng))
+                targets = community_distribution.draw(rng, sources=sources)
+                mixed = rng.random(len(sources)) < mixing
+                targets[mixed] = global_distribution.draw(rng, size=int(mixed.sum()))
+                # without self loops and repeated links of a source
+                _, first = np.unique(sources * num_nodes + targets, return_index=True)
+                keep = np.zeros(len(sources), dtype=bool)
+                keep[first] = True
+                keep &= sources != targets
+                flags = (rng.random(int(keep.sum())) < reciprocity).astype(np.int64)
+                f.write(format_edge_list([sources[keep], targets[keep], flags]))
+                num_links += int(keep.sum())
+
+    log.info(f"Generated {num_ratings} ratings and {num_links} links for {num_users} users and {num_items} items in {data_dir}")
@@ -1,6 +1,38 @@
+import os
+
+import numpy as np
 import tensorflow as tf
 
 
-def normalize_with_moments(x, axes):
-    mean, variance = tf.nn.moments(x, axes=axes, name="normalization")
+def normalize_with_moments(x, axes, moments=None):
+    """Normalize x with its moments over axes, or with given (mean, variance) moments"""
+    mean, variance = tf.nn.moments(x, axes=axes, name="normalization") if moments is None else moments
     return (x - mean) * 0.2 / tf.sqrt(variance)
+
+
+def normalize_with_moments_numpy(x, chunk_size=65536):
+    """normalize_with_moments over all axes of a 2d (possibly memory-mapped) array, as float32.
+
+    Moments are accumulated in float64 over chunks of rows so the input is never copied as a whole.
+    """
+    total = sum(np.sum(x[start : start + chunk_size], dtype=np.float64) for start in range(0, len(x), chunk_size))
+    mean = total / x.size
+    squared = sum(np.sum(np.square(x[start : start + chunk_size] - mean), dtype=np.float64) for start in range(0, len(x), chunk_size))
+    scale = 0.2 / np.sqrt(squared / x.size)
+    normalized = np.empty(x.shape, dtype=np.float32)
+    for start in range(0, len(x), chunk_size):
+        normalized[start : start + chunk_size] = (x[start : start + chunk_size] - mean) * scale
+    return normalized
+
+
+def enable_xla_autoclustering():
+    """Let XLA compile the clusters of XLA compatible ops in tf.functions, CPU clustering is opt-in.
+
+    CPU clustering is enabled by TF_XLA_FLAGS, which TensorFlow reads once when it first lists or initializes its
+    devices. Call this before the first op, variable or device query, in a process that already used TensorFlow
+    export TF_XLA_FLAGS=--tf_xla_cpu_global_jit before starting it.
+    """
+    xla_flags = os.environ.get("TF_XLA_FLAGS", "")
+    if "--tf_xla_cpu_global_jit" not in xla_flags:
+        os.environ["TF_XLA_FLAGS"] = f"{xla_flags} --tf_xla_cpu_global_jit".strip()
+    tf.config.optimizer.set_jit("autoclustering")
@@ -0,0 +1,140 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+import generate_run_script  # noqa: E402
+from main import MINIMIZED_METRICS, parse_args, run  # noqa: E402
+from util.data_module_v2 import DataModule  # noqa: E402
+
+log = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(processName)s - %(name)s - %(funcName)s:%(lineno)d - %(message)s"
+
+
+class MedianStoppingRule:
+    """Stops a configuration whose best metric so far is worse than the median of the running averages of the other
+    configurations after the same number of evaluations, worse is higher with minimize and lower otherwise.
+
+    Every configuration appends its metric of every evaluated epoch to the shared history {config id: [values]}.
+    Nothing is stopped before grace_epochs or while fewer than min_configs other configurations have been evaluated
+    as often.
+    """
+
+    def __init__(self, history, metric="val_loss", minimize=True, grace_epochs=5, min_configs=3):
+        self.history = history
+        self.metric = metric
+        self.minimize = minimize
+        self.grace_epochs = grace_epochs
+        self.min_configs = min_configs
+
+    def should_stop(self, config_id, epoch, epoch_info):
+        value = epoch_info.get(self.metric)
+        if value is None:
+            return False
+        # only this configuration writes its entry, read-modify-write through the proxy is safe
+        values = self.history.get(config_id, []) + [float(value)]
+        self.history[config_id] = values
+        if epoch < self.grace_epochs:
+            return False
+
+        evaluations = len(values)
+        running_averages = sorted(
+            sum(other[:evaluations]) / evaluations for other_id, other in self.history.items() if other_id != config_id and len(other) >= evaluations
+        )
+        if len(running_averages) < self.min_configs:
+            return False
+        middle = len(running_averages) // 2
+        median = running_averages[middle] if len(running_averages) % 2 else (running_averages[middle - 1] + running_averages[middle]) / 2
+        return min(values) > median if self.minimize else max(values) < median
+
+
+def init_worker(intra_op_threads, inter_op_threads):
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    # before the first op of the process creates the TF runtime
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def run_configuration(config_id, arguments, stopping_rule=None):
+    start_time = time.time()
+    args = parse_args(arguments)
+
+    def epoch_callback(epoch, epoch_info):
+        return stopping_rule is None or not stopping_rule.should_stop(config_id, epoch, epoch_info)
+
+    final_info = run(args, epoch_callback=epoch_callback)
+    return {
+        "config_id": config_id,
+        "arguments": arguments,
+        "status": "stopped" if final_info.get("stopped_early") else "completed",
+        "time": time.time() - start_time,
+        "result": final_info,
+    }
+
+
+def sweep(configurations, results_path, workers=1, threads_per_worker=None, stopping_rule_kwargs=None):
+    """Run main.py on every configuration (a list of arguments) in a pool of worker processes and append one JSON
+    line per finished configuration to results_path"""
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+
+    # compile the dataset caches once, the workers memory-map the same arrays instead of every run parsing the sources
+    for data_dir in sorted({parse_args(arguments).data_dir for arguments in configurations}):
+        DataModule(data_dir).build_cache()
+
+    # spawned workers, a forked TF runtime is not safe to use
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        stopping_rule = MedianStoppingRule(manager.dict(), **stopping_rule_kwargs) if stopping_rule_kwargs is not None else None
+        log.info(f"Running {len(configurations)} configurations on {workers} workers with {threads_per_worker} threads each")
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=context, initializer=init_worker, initargs=(threads_per_worker, min(2, threads_per_worker))
+        ) as executor, open(results_path, "a") as results_file:
+            futures = {executor.submit(run_configuration, config_id, arguments, stopping_rule): (config_id, arguments) for config_id, arguments in enumerate(configurations)}
+            for future in as_completed(futures):
+                config_id, arguments = futures[future]
+                try:
+                    record = future.result()
+                except Exception:
+                    record = {"config_id": config_id, "arguments": arguments, "status": "failed", "error": traceback.format_exc()}
+                results_file.write(json.dumps(record) + "\n")
+                results_file.flush()
+                log.info(f"Configuration {config_id} {record['status']}: {' '.join(arguments)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the configurations of generate_run_script.py in parallel, arguments not listed here are passed to every run (e.g. --epochs 3)"
+    )
+    parser.add_argument("--workers", type=int, default=2, metavar="N", help="number of configurations trained at the same time")
+    parser.add_argument("--threads_per_worker", type=int, default=None, metavar="N", help="TF intra-op threads of every worker, default is the cores split over the workers")
+    parser.add_argument("--results", type=str, default="./out/sweep_results.jsonl", help="JSON lines file the results are appended to")
+    parser.add_argument("--no_early_stopping", action="store_true", help="train every configuration for all its epochs")
+    parser.add_argument("--grace_epochs", type=int, default=5, metavar="N", help="epochs every configuration trains before it can be stopped")
+    parser.add_argument("--min_configs", type=int, default=3, metavar="N", help="configurations that must have reached an epoch before others are stopped at it")
+    args, run_arguments = parser.parse_known_args()
+
+    configurations = [arguments + run_arguments for arguments in generate_run_script.configurations()]
+    os.makedirs(os.path.dirname(args.results) or ".", exist_ok=True)
+    # configurations are pruned by the metric the runs select their model with, --early_stopping_metric
+    metric = parse_args(configurations[0]).early_stopping_metric
+    stopping_rule_kwargs = (
+        None
+        if args.no_early_stopping
+        else {"metric": metric, "minimize": metric in MINIMIZED_METRICS, "grace_epochs": args.grace_epochs, "min_configs": args.min_configs}
+    )
+    sweep(configurations, args.results, workers=args.workers, threads_per_worker=args.threads_per_worker, stopping_rule_kwargs=stopping_rule_kwargs)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    main()
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from util.checkpointing import TrainingCheckpoints
+from util.negative_sampler import NegativeSampler
+
+
+class TinyModel(tf.keras.Model):
+    def __init__(self):
+        super(TinyModel, self).__init__()
+        self.weight = tf.Variable(tf.random.normal([4, 2]), name="weight")
+        self.invalidated = False
+
+    def invalidate_gcn_embeddings(self):
+        self.invalidated = True
+
+
+def make_checkpoints(checkpoint_dir, **kwargs):
+    model = TinyModel()
+    return model, TrainingCheckpoints(str(checkpoint_dir), model, tf.keras.optimizers.SGD(0.1), async_writes=False, **kwargs)
+
+
+def make_sampler(seed):
+    # 3 users with sorted positives over 20 items
+    return NegativeSampler(20, [0, 2, 5, 6], [1, 4, 0, 2, 3, 7], num_negatives=5, seed=seed)
+
+
+def test_resume_restores_epoch_history_and_sampler_state(tmp_path):
+    model, checkpoints = make_checkpoints(tmp_path)
+    sampler = make_sampler(seed=0)
+    negatives = sampler.sample()
+    history = [{"train_loss": 3.0, "val_loss": 2.0}, {"train_loss": 2.5, "val_loss": 1.5, "ndcg_10": 0.25}]
+    state = {"history": history, "next_negatives_state": sampler.get_state()}
+    checkpoints.save(2, history[-1], state, negatives)
+    next_negatives = sampler.sample()
+
+    resumed_model, resumed = make_checkpoints(tmp_path)
+    epoch, resumed_state, resumed_negatives = resumed.restore_latest()
+    assert epoch == 2
+    assert resumed_state["history"] == history
+    np.testing.assert_array_equal(resumed_negatives, negatives)
+    np.testing.assert_array_equal(resumed_model.weight.numpy(), model.weight.numpy())
+    assert resumed_model.invalidated
+
+    # a sampler of another seed continues with the draws of the checkpointed one
+    resumed_sampler = make_sampler(seed=1)
+    resumed_sampler.set_state(resumed_state["next_negatives_state"])
+    np.testing.assert_array_equal(resumed_sampler.sample(), next_negatives)
+
+
+def test_no_checkpoint(tmp_path):
+    _, checkpoints = make_checkpoints(tmp_path)
+    assert checkpoints.restore_latest() is None
+    assert checkpoints.restore_best() is None
+
+
+@pytest.mark.parametrize("metric, minimize, best_epochs", [("val_loss", True, [3, 1]), ("ndcg_10", False, [2, 3])])
+def test_best_checkpoints_are_ranked_by_the_metric(tmp_path, metric, minimize, best_epochs):
+    model, checkpoints = make_checkpoints(tmp_path, keep_best=2, metric=metric, minimize=minimize)
+    results = {1: {"val_loss": 1.0, "ndcg_10": 0.1}, 2: {"val_loss": 3.0, "ndcg_10": 0.5}, 3: {"val_loss": 0.5, "ndcg_10": 0.3}}
+    weights = {}
+    for epoch, metrics in results.items():
+        model.weight.assign_add(tf.ones_like(model.weight))
+        weights[epoch] = model.weight.numpy()
+        checkpoints.save(epoch, metrics, {"history": []}, np.zeros((3, 5), dtype=np.int64))
+
+    assert [entry["epoch"] for entry in checkpoints.best] == best_epochs
+    best = checkpoints.restore_best()
+    assert best["epoch"] == best_epochs[0]
+    np.testing.assert_array_equal(model.weight.numpy(), weights[best_epochs[0]])
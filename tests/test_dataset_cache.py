@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pytest
+
+from util.dataset_cache import DatasetCache
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    (tmp_path / "train.ratings").write_text("0\t1\t1\n1\t2\t1\n")
+    (tmp_path / "user.links").write_text("0\t1\n")
+    return str(tmp_path)
+
+
+def build_cache(data_dir):
+    cache = DatasetCache(data_dir, ["train.ratings", "user.links"])
+    cache.save({"offsets": np.array([0, 1, 2], dtype=np.int64)}, {"user_map": {"u0": 0, "u1": 1}})
+    return cache
+
+
+def test_round_trip(data_dir):
+    cache = build_cache(data_dir)
+    assert cache.is_valid()
+    arrays, maps = cache.load()
+    np.testing.assert_array_equal(arrays["offsets"], [0, 1, 2])
+    assert isinstance(arrays["offsets"], np.memmap)
+    assert maps["user_map"] == {"u0": 0, "u1": 1}
+
+
+def test_invalidated_by_source_size(data_dir):
+    cache = build_cache(data_dir)
+    with open(os.path.join(data_dir, "train.ratings"), "a") as f:
+        f.write("2\t3\t1\n")
+    assert not cache.is_valid()
+
+
+def test_invalidated_by_source_mtime(data_dir):
+    cache = build_cache(data_dir)
+    path = os.path.join(data_dir, "user.links")
+    stat = os.stat(path)
+    # same size, touched later
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not cache.is_valid()
+
+
+def test_invalidated_by_missing_source(data_dir):
+    cache = build_cache(data_dir)
+    os.remove(os.path.join(data_dir, "user.links"))
+    assert not cache.is_valid()
+
+
+def test_missing_cache_is_invalid(data_dir):
+    assert not DatasetCache(data_dir, ["train.ratings"]).is_valid()
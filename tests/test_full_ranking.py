@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from metrics.full_ranking import evaluate_full_ranking
+
+
+def ratings(rows):
+    """DataModule ratings dict of {user: [(item, value)]} over range(len(rows)) users"""
+    offsets = np.concatenate([[0], np.cumsum([len(row) for row in rows])]).astype(np.int64)
+    items = np.array([item for row in rows for item, _ in row], dtype=np.int64)
+    values = np.array([value for row in rows for _, value in row], dtype=np.float32)
+    return {"offsets": offsets, "items": items, "values": values}
+
+
+def test_masked_train_items_are_not_hits():
+    # 4 items, user 0 trained on 3 of them, its only unmasked item is its test positive
+    user_embeddings = np.array([[1.0, 0.0]], dtype=np.float32)
+    item_embeddings = np.array([[4.0, 0.0], [3.0, 0.0], [2.0, 0.0], [1.0, 0.0]], dtype=np.float32)
+    train = ratings([[(0, 1.0), (1, 1.0), (2, 1.0)]])
+    # item 1 is a train positive as well as a test positive, masked it must not count
+    test = ratings([[(1, 1.0), (3, 1.0)]])
+    results = evaluate_full_ranking(user_embeddings, item_embeddings, test, train, cutoffs=(1, 2, 3))
+
+    # item 3 is ranked first among the unmasked items
+    assert results["hr_1"] == pytest.approx(1.0)
+    assert results["recall_3"] == pytest.approx(0.5)
+    assert results["hr_3"] == pytest.approx(0.5)
+    assert results["ndcg_3"] == pytest.approx(1.0 / (1.0 + 1.0 / np.log2(3)))
+    assert results["mrr"] == pytest.approx(1.0)
@@ -0,0 +1,64 @@
+import json
+
+import numpy as np
+import pytest
+
+from util.negative_sampler import NegativeSampler
+
+
+def random_positives(num_users, num_items, max_items, seed=0):
+    """Per user CSR of sorted distinct positives, some users have none"""
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, max_items + 1, size=num_users)
+    items = [np.sort(rng.choice(num_items, size=count, replace=False)) for count in counts]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return offsets, np.concatenate(items).astype(np.int64)
+
+
+@pytest.mark.parametrize("distribution", ["uniform", "popularity"])
+def test_no_positives_are_sampled(distribution):
+    num_items = 50
+    # dense users, most of the catalog is positive and collisions are frequent
+    offsets, items = random_positives(200, num_items, 45)
+    sampler = NegativeSampler(num_items, offsets, items, 16, distribution=distribution, seed=1, candidates_per_chunk=512)
+    negatives = sampler.sample()
+
+    assert negatives.shape == (200, 16)
+    for user in range(200):
+        positives = set(items[offsets[user] : offsets[user + 1]].tolist())
+        if positives:
+            assert not positives & set(negatives[user].tolist())
+        else:
+            # rows of users without positives are left zero
+            assert not negatives[user].any()
+    assert negatives.min() >= 0 and negatives.max() < num_items
+
+
+def test_state_reproduces_draws():
+    offsets, items = random_positives(100, 300, 20)
+    sampler = NegativeSampler(300, offsets, items, 8, seed=3)
+    sampler.sample()
+
+    # the state round trips through JSON, as in the checkpoints
+    state = json.loads(json.dumps(sampler.get_state()))
+    expected = [sampler.sample(), sampler.sample()]
+
+    restored = NegativeSampler(300, offsets, items, 8, seed=99)
+    restored.set_state(state)
+    for negatives in expected:
+        np.testing.assert_array_equal(restored.sample(), negatives)
+
+
+def test_async_sample_matches_sample():
+    offsets, items = random_positives(100, 300, 20)
+    sampler = NegativeSampler(300, offsets, items, 8, seed=5)
+    expected = NegativeSampler(300, offsets, items, 8, seed=5).sample()
+    try:
+        np.testing.assert_array_equal(sampler.sample_async().result(), expected)
+    finally:
+        sampler.shutdown()
+
+
+def test_dtype_of_negatives():
+    offsets, items = random_positives(10, 100, 5)
+    assert NegativeSampler(100, offsets, items, 4, seed=0, dtype=np.int32).sample().dtype == np.int32
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from metrics.evaluate import compute_ndcg, evaluate_hit_rate_and_ndcg_2, evaluate_hit_rate_and_ndcg_at_k, ranking_keys
+
+
+def random_scores(num_users, num_negatives, max_positives, seed=0, decimals=None):
+    """user_index_dict, (#positives, 1) positive scores and {user: negative scores} as main.py evaluates them"""
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, max_positives + 1, size=num_users)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    users = rng.permutation(1000)[:num_users]
+    user_index_dict = {int(user): np.arange(offsets[row], offsets[row + 1]) for row, user in enumerate(users)}
+    positive_ratings = rng.random((offsets[-1], 1)).astype(np.float32)
+    negative_ratings = {int(user): rng.random(num_negatives).astype(np.float32) for user in users}
+    if decimals is not None:
+        positive_ratings = np.round(positive_ratings, decimals)
+        negative_ratings = {user: np.round(scores, decimals) for user, scores in negative_ratings.items()}
+    return user_index_dict, positive_ratings, negative_ratings
+
+
+def stable_reference(user_index_dict, positive_ratings, negative_ratings, top_k):
+    """The per user loop of evaluate_hit_rate_and_ndcg_2 with a stable sort, which defines the order of ties"""
+    hit_rates, ndcgs = [], []
+    for user, item_indices in user_index_dict.items():
+        scores = np.concatenate([np.reshape(positive_ratings[item_indices], [-1]), negative_ratings[user]])
+        order = np.argsort(scores, kind="stable")[::-1][:top_k]
+        relevance = [1 if rank < len(item_indices) else 0 for rank in order]
+        hit_rates.append(sum(relevance) / min(len(item_indices), top_k))
+        ndcgs.append(compute_ndcg(relevance, sorted(relevance, reverse=True)))
+    return np.mean(hit_rates), np.mean(ndcgs)
+
+
+def test_matches_per_user_loop():
+    user_index_dict, positive_ratings, negative_ratings = random_scores(300, 100, 20)
+    results = evaluate_hit_rate_and_ndcg_at_k(user_index_dict, positive_ratings, negative_ratings, cutoffs=(5, 10, 15), users_per_chunk=64)
+    for k in (5, 10, 15):
+        hit_rate, ndcg = evaluate_hit_rate_and_ndcg_2(user_index_dict, positive_ratings, negative_ratings, top_k=k)
+        assert results[k][0] == pytest.approx(hit_rate, rel=1e-12)
+        assert results[k][1] == pytest.approx(ndcg, rel=1e-12)
+
+
+def test_ties_rank_like_a_stable_sort():
+    # one decimal, most scores are tied with others
+    user_index_dict, positive_ratings, negative_ratings = random_scores(200, 50, 10, seed=1, decimals=1)
+    results = evaluate_hit_rate_and_ndcg_at_k(user_index_dict, positive_ratings, negative_ratings, cutoffs=(5, 10))
+    for k in (5, 10):
+        hit_rate, ndcg = stable_reference(user_index_dict, positive_ratings, negative_ratings, k)
+        assert results[k][0] == pytest.approx(hit_rate, rel=1e-12)
+        assert results[k][1] == pytest.approx(ndcg, rel=1e-12)
+
+
+def test_ranking_keys_order():
+    scores = np.array([[0.5, -1.0, 0.5, 2.0, -0.0, 0.0]], dtype=np.float32)
+    # descending keys: score first, the later column first among equal scores
+    order = np.argsort(-ranking_keys(scores), axis=1)[0]
+    np.testing.assert_array_equal(order, np.argsort(scores[0], kind="stable")[::-1])
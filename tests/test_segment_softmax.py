@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from layers.sparse_aggregation import make_aggregation, segment_matmul, segment_softmax
+
+
+def random_edges(rng, num_rows, num_cols, num_edges):
+    """Unique (row, col) edges in order of first appearance of the rows, as the graph builder keeps them"""
+    keys = rng.choice(num_rows * num_cols, size=num_edges, replace=False)
+    indices = np.stack([keys // num_cols, keys % num_cols], axis=1)
+    return indices[np.argsort(rng.permutation(num_rows)[indices[:, 0]], kind="stable")]
+
+
+def sparse_softmax(indices, values, dense_shape):
+    """tf.sparse.softmax of the edges, returned in the order of the edges"""
+    order = np.lexsort((indices[:, 1], indices[:, 0]))
+    sparse = tf.sparse.softmax(tf.SparseTensor(indices=indices[order], values=tf.gather(values, order), dense_shape=dense_shape))
+    return tf.scatter_nd(order[:, None], sparse.values, [len(order)]).numpy()
+
+
+def test_segment_softmax_matches_sparse_softmax():
+    rng = np.random.default_rng(0)
+    indices = random_edges(rng, 50, 40, 300)
+    # large values, the row max must be subtracted for the exp not to overflow
+    values = tf.constant(rng.normal(scale=50.0, size=len(indices)).astype(np.float32))
+    result = segment_softmax(values, tf.constant(indices[:, 0]), 50).numpy()
+
+    np.testing.assert_allclose(result, sparse_softmax(indices, values, [50, 40]), rtol=1e-5, atol=1e-7)
+    np.testing.assert_allclose(np.bincount(indices[:, 0], weights=result, minlength=50)[np.unique(indices[:, 0])], 1.0, rtol=1e-5)
+
+
+def test_segment_softmax_rows_without_edges():
+    # rows 1 and 3 have no edges
+    indices = np.array([[2, 0], [0, 1], [2, 1], [0, 0]])
+    values = tf.constant([1.0, 2.0, 3.0, -1.0])
+    result = segment_softmax(values, tf.constant(indices[:, 0]), 4).numpy()
+    np.testing.assert_allclose(result, sparse_softmax(indices, values, [4, 2]), rtol=1e-6)
+
+
+def test_segment_matmul_matches_sparse_dense_matmul():
+    rng = np.random.default_rng(1)
+    indices = random_edges(rng, 30, 20, 120)
+    weights = rng.random(len(indices)).astype(np.float32)
+    embeddings = rng.normal(size=(20, 8)).astype(np.float32)
+    result = segment_matmul(tf.constant(weights), embeddings, tf.constant(indices[:, 0]), tf.constant(indices[:, 1]), 30)
+
+    expected = tf.sparse.sparse_dense_matmul(tf.sparse.reorder(tf.SparseTensor(indices=indices, values=weights, dense_shape=[30, 20])), embeddings)
+    np.testing.assert_allclose(result.numpy(), expected.numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_aggregation_backends_agree():
+    rng = np.random.default_rng(2)
+    indices = random_edges(rng, 30, 25, 150)
+    values = tf.constant(rng.normal(size=len(indices)).astype(np.float32))
+    embeddings = rng.normal(size=(25, 4)).astype(np.float32)
+
+    coo = make_aggregation("coo", indices, [30, 25])
+    segment = make_aggregation("segment", indices, [30, 25])
+    np.testing.assert_allclose(coo.matmul(coo.softmax(values), embeddings).numpy(), segment.matmul(segment.softmax(values), embeddings).numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        make_aggregation("dense", np.zeros((0, 2), dtype=np.int64), [1, 1])